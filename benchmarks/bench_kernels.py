@@ -0,0 +1,329 @@
+""" Micro-benchmarks of the telemetry and matching kernels across input sizes.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.bench_kernels -o kernels.json
+    python -m benchmarks.bench_kernels --kernels findClosestCTS gpsRowLookup --sizes 1e3 1e4 1e5
+    python -m benchmarks.bench_kernels --update-baseline
+
+Each kernel runs at 10^3 to 10^7 elements (samples, frames or images). The time per element is the best of a few
+repeats, and peak memory comes from a second, tracemalloc traced run. A kernel stops growing once its next size would
+blow the --max-seconds budget. Times are divided by a fixed calibration workload, so they can be compared across
+machines with the stored baseline (kernel_baseline.json). The run fails when a kernel is slower than --max-ratio times
+its baseline, when it fails where its baseline ran, or when the baseline has no size long enough to check it against.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from api.telemetry_filters import convertIORItoEuler, quaternionToEuler
+from benchmarks.synthetic_inputs import ORIGIN, walkTrack, writeSyntheticTelemetry
+from code.apply_tags_hero9 import findClosestCTS
+from code.frame_alignment import findClosestIndices
+from code.telemetry_cleaning_hero9 import cleanACCL, cleanGPS, cleanGRAV, cleanGYRO, cleanIORI
+
+SCHEMA_VERSION = 1
+BASELINE_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kernel_baseline.json')
+SIZES = [10**3, 10**4, 10**5, 10**6, 10**7]
+MAX_RATIO = 1.5
+MIN_REPEAT_TIME = 0.2 # s, small sizes are repeated until they have run this long
+MAX_REPEATS = 5
+# baseline runs shorter than this are too noisy to fail a run on
+MIN_CHECKED_TIME = 0.05 # s
+
+def _cts(n, rate, seed=0):
+    """ Sorted, slightly jittered sample times (ms) of a stream recorded at rate (Hz). """
+
+    rng = np.random.default_rng(seed)
+    return np.sort(np.arange(n) * 1000 / rate + rng.uniform(-1, 1, n))
+
+@contextmanager
+def _scratchDir():
+    """ Yields a temporary folder that is removed afterwards. """
+
+    scratch_dir = tempfile.mkdtemp(prefix='gfam_kernel_')
+    try:
+        yield scratch_dir
+    finally:
+        shutil.rmtree(scratch_dir)
+
+# Each kernel is setup(n, scratch_dir) -> state, then run(state). Only run() is timed.
+
+def _setupMatch(n, scratch_dir):
+    frame_cts = _cts(n, 30, seed=1)
+    return {'frame_cts': frame_cts, 'gps_cts': list(_cts(n, 18.0)), 'gps_array': _cts(n, 18.0)}
+
+def _runFindClosestCTS(state):
+    gps_cts = state['gps_cts']
+    return [findClosestCTS(cts, gps_cts) for cts in state['frame_cts']]
+
+def _runFindClosestIndices(state):
+    return findClosestIndices(state['frame_cts'], state['gps_array'])
+
+def _setupRowLookup(n, scratch_dir):
+    # the per frame lookup applyTags() used before the frame table: bisect, then a full column scan for the row
+    gps_cts = _cts(n, 18.0)
+    lat, lon, elev = walkTrack(gps_cts / 1000)
+    gps_df = pd.DataFrame({'cts': gps_cts, 'lat': lat, 'lon': lon, 'elev': elev})
+    return {'frame_cts': _cts(n, 30, seed=1), 'gps_cts': list(gps_cts), 'gps_df': gps_df}
+
+def _runRowLookup(state):
+    gps_df = state['gps_df']
+    rows = []
+    for cts in state['frame_cts']:
+        gps_row = gps_df.loc[gps_df['cts'] == findClosestCTS(cts, state['gps_cts'])]
+        rows.append((gps_row['lat'].iloc[0], gps_row['lon'].iloc[0], gps_row['elev'].iloc[0]))
+    return rows
+
+def _setupCleaner(stream):
+    def setup(n, scratch_dir):
+        stream_csv = os.path.join(scratch_dir, stream + '.csv')
+        rate = {'GPS': 18.0, 'ACCL': 200.0, 'GYRO': 200.0, 'GRAV': 30.0, 'IORI': 30.0}[stream]
+        writeSyntheticTelemetry(n / rate, fps=30, **{'output_' + stream.lower(): stream_csv})
+        return {'csv': stream_csv}
+    return setup
+
+def _runCleaner(cleaner):
+    def run(state):
+        return cleaner(state['csv'])
+    return run
+
+def _setupQuaternions(n, scratch_dir):
+    rng = np.random.default_rng(0)
+    q = rng.normal(0, 1, (n, 4))
+    return {'q': q, 'iori_df': pd.DataFrame(q, columns=['w', 'x', 'y', 'z'])}
+
+def _runQuaternionToEuler(state):
+    return [quaternionToEuler(w, x, y, z) for w, x, y, z in state['q'].tolist()]
+
+def _runConvertIORItoEuler(state):
+    return convertIORItoEuler(state['iori_df'].copy())
+
+def _setupPhotos(n, scratch_dir):
+    # tiny geotagged JPEGs laid out along the synthetic walk
+    from PIL import Image
+    from code.jpeg_metadata import buildGPSExif, insertSegments
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8)).save(buffer, format='JPEG')
+    jpeg = buffer.getvalue()
+    lat, lon, elev = walkTrack(np.arange(n) * 2.0)
+    for i in range(n):
+        with open(os.path.join(scratch_dir, f'frame_{i:07d}.jpg'), 'wb') as frame_file:
+            frame_file.write(insertSegments(jpeg, [buildGPSExif(lat[i], lon[i], elev[i], west_hem=lon[i] < 0)]))
+    return {'dir': scratch_dir, 'center': _cellCenter(ORIGIN)}
+
+def _cellCenter(origin):
+    from pyproj import Transformer
+    from code.photo_selection_tools import SOURCE_EPSG, TARGET_EPSG
+    transformer = Transformer.from_crs(SOURCE_EPSG, TARGET_EPSG, always_xy=True)
+    return transformer.transform(origin[1], origin[0])
+
+def _runSelectPhotosWithinCell(state):
+    from code.photo_selection_tools import selectPhotosWithinCell
+    x, y = state['center']
+    return selectPhotosWithinCell(x + 50, y + 50, 10, 10, state['dir'])
+
+def _setupCoords(n, scratch_dir):
+    lat, lon, _ = walkTrack(np.arange(n) * 2.0)
+    from pyproj import Transformer
+    from code.photo_selection_tools import SOURCE_EPSG, TARGET_EPSG
+    x, y = Transformer.from_crs(SOURCE_EPSG, TARGET_EPSG, always_xy=True).transform(lon, lat)
+    img_coords = {f'frame_{i:07d}.jpg': (lon[i], lat[i], x[i], y[i]) for i in range(n)}
+    return {'coords': img_coords, 'center': _cellCenter(ORIGIN)}
+
+def _runSelectCoordsWithinCell(state):
+    from code.photo_selection_tools import selectCoordsWithinCell
+    x, y = state['center']
+    return selectCoordsWithinCell(x + 50, y + 50, 10, 10, state['coords'])
+
+# name: (setup, run, whether run() consumes its state, e.g. a cleaner rewriting its CSV)
+KERNELS = {
+    'findClosestCTS': (_setupMatch, _runFindClosestCTS, False),
+    'findClosestIndices': (_setupMatch, _runFindClosestIndices, False),
+    'gpsRowLookup': (_setupRowLookup, _runRowLookup, False),
+    'cleanGPS': (_setupCleaner('GPS'), _runCleaner(cleanGPS), True),
+    'cleanACCL': (_setupCleaner('ACCL'), _runCleaner(cleanACCL), True),
+    'cleanGYRO': (_setupCleaner('GYRO'), _runCleaner(cleanGYRO), True),
+    'cleanGRAV': (_setupCleaner('GRAV'), _runCleaner(cleanGRAV), True),
+    'cleanIORI': (_setupCleaner('IORI'), _runCleaner(cleanIORI), True),
+    'quaternionToEuler': (_setupQuaternions, _runQuaternionToEuler, False),
+    'convertIORItoEuler': (_setupQuaternions, _runConvertIORItoEuler, False),
+    'selectPhotosWithinCell': (_setupPhotos, _runSelectPhotosWithinCell, False),
+    'selectCoordsWithinCell': (_setupCoords, _runSelectCoordsWithinCell, False)
+}
+
+def calibrate():
+    """ Times a fixed mix of interpreter and numpy work, used to compare timings across machines.
+
+    :return: the best of three runs (s)
+    :rtype: float
+    """
+
+    rng = np.random.default_rng(0)
+    values = rng.random(10**6)
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        sum(i * i for i in range(10**6))
+        np.sort(values)
+        pd.Series(values).astype(str)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def benchmarkKernel(name, n):
+    """ Times one kernel at one size, then measures its peak traced memory in a second run.
+
+    :param name: Key of KERNELS.
+    :type name: str
+    :param n: Number of elements.
+    :type n: int
+
+    :return: seconds per run and per element, peak memory and the number of runs, or the error
+    :rtype: dict
+    """
+
+    setup, run, consumes = KERNELS[name]
+    with _scratchDir() as scratch_dir:
+        try:
+            state = setup(n, scratch_dir)
+            times = []
+            while len(times) < MAX_REPEATS and sum(times) < MIN_REPEAT_TIME:
+                if consumes and times:
+                    state = setup(n, scratch_dir)
+                start = time.perf_counter()
+                run(state)
+                times.append(time.perf_counter() - start)
+            if consumes:
+                state = setup(n, scratch_dir)
+            tracemalloc.start()
+            run(state)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        except Exception as e:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            logging.warning(f"{name} failed at n={n}: {type(e).__name__}: {e}")
+            return {'n': n, 'error': f"{type(e).__name__}: {e}"}
+    best = min(times)
+    return {
+        'n': n,
+        's': best,
+        's_per_element': best / n,
+        'ns_per_element': best / n * 1e9,
+        'peak_mb': peak / 1e6,
+        'runs': len(times)
+    }
+
+def benchmarkKernels(names, sizes, max_seconds):
+    """ Runs each kernel across sizes, stopping a kernel once its next size is expected to take over max_seconds.
+
+    :return: per kernel, the results of each size keyed by str(n)
+    :rtype: dict
+    """
+
+    results = {}
+    for name in names:
+        results[name] = {}
+        previous = None
+        for k, n in enumerate(sizes):
+            result = benchmarkKernel(name, n)
+            results[name][str(n)] = result
+            logging.info(f"{name} n={n}: " + (result['error'] if 'error' in result else f"{result['ns_per_element']:.0f} ns/element, {result['peak_mb']:.1f} MB peak"))
+            if 'error' in result:
+                break
+            # extrapolate with the scaling seen so far (at least linear), twice over for the traced run
+            exponent = 1.0
+            if previous is not None and previous['s'] > 0:
+                exponent = max(np.log(result['s'] / previous['s']) / np.log(n / previous['n']), 1.0)
+            if k + 1 < len(sizes) and 2 * result['s'] * (sizes[k + 1] / n) ** exponent > max_seconds:
+                logging.info(f"Skipping {name} above n={n}, it would take longer than {max_seconds} s.")
+                break
+            previous = result
+    return results
+
+def checkBaseline(results, baseline, max_ratio=MAX_RATIO):
+    """ Compares calibrated times per element against a baseline.
+
+    :param results: Output of a run of this module.
+    :type results: dict
+    :param baseline: Stored results.
+    :type baseline: dict
+    :param max_ratio: Highest accepted slowdown. Defaults to MAX_RATIO.
+    :type max_ratio: float
+
+    :return: ratio per kernel and size, and the (kernel, n, problem) that fail the run, n is None when the whole kernel
+        is concerned
+    :rtype: dict, list of tuple
+    """
+
+    ratios = {}
+    regressions = []
+    for name, sizes in results['kernels'].items():
+        old_sizes = baseline['kernels'].get(name, {})
+        if not any(old.get('s', 0) >= MIN_CHECKED_TIME for old in old_sizes.values()):
+            regressions.append((name, None, f"has no baseline size that ran for {MIN_CHECKED_TIME} s or more"))
+        for n, result in sizes.items():
+            old = old_sizes.get(n)
+            if 'error' in result:
+                if old is None or result['error'] != old.get('error'):
+                    regressions.append((name, int(n), f"failed with {result['error']}"))
+                continue
+            if old is None or 'error' in old:
+                continue
+            ratio = (result['s_per_element'] / results['calibration_s']) / (old['s_per_element'] / baseline['calibration_s'])
+            ratios.setdefault(name, {})[n] = ratio
+            if ratio > max_ratio and old['s'] >= MIN_CHECKED_TIME:
+                regressions.append((name, int(n), f"is {ratio:.2f}x slower than its baseline (limit {max_ratio}x)"))
+    return ratios, regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the telemetry and matching kernels.')
+    parser.add_argument('--kernels', help='kernels to run', type=str, nargs='+', default=list(KERNELS), choices=list(KERNELS))
+    parser.add_argument('--sizes', help='element counts', type=float, nargs='+', default=SIZES)
+    parser.add_argument('--max-seconds', help='time budget of a single size', type=float, default=30.0)
+    parser.add_argument('--baseline', help='stored results to check against', type=str, default=BASELINE_JSON)
+    parser.add_argument('--max-ratio', help='highest accepted slowdown against the baseline', type=float, default=MAX_RATIO)
+    parser.add_argument('--update-baseline', help='store this run as the baseline', action='store_true')
+    parser.add_argument('-o', help='path to the JSON results', type=str, default=None)
+    parser.add_argument('--log-level', help='logging level, e.g. DEBUG', type=str, default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(message)s')
+
+    results = {
+        'schema': SCHEMA_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'calibration_s': calibrate(),
+        'kernels': benchmarkKernels(args.kernels, [int(i) for i in args.sizes], args.max_seconds)
+    }
+
+    regressions = []
+    if not args.update_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as json_file:
+            ratios, regressions = checkBaseline(results, json.load(json_file), max_ratio=args.max_ratio)
+        results['baseline'] = {'path': args.baseline, 'ratios': ratios}
+        for name, n, problem in regressions:
+            logging.error(f"{name} {problem}." if n is None else f"{name} at n={n} {problem}.")
+    if args.o is not None:
+        with open(args.o, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+        logging.info(f"Results written to {args.o}")
+    if args.update_baseline:
+        with open(args.baseline, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+        logging.info(f"Baseline written to {args.baseline}")
+    sys.exit(1 if regressions else 0)
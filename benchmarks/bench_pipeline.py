@@ -0,0 +1,304 @@
+""" End-to-end benchmark of the pipeline on synthetic GoPro-like inputs.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.bench_pipeline --durations 30 120 --resolutions 1280x720 1920x1080 -o bench.json
+    python -m benchmarks.bench_pipeline --durations 30 120 --baseline bench.json -o bench_new.json
+
+Each case encodes an ffmpeg testsrc2 video (cached in the work folder), runs processVideo() on it with synthetic
+telemetry standing in for the node extraction, then times every clean* parser on a full set of synthetic streams and the
+photo_selection_tools functions on the tagged frames. Results are written as JSON with one entry per case, keyed by the
+case name, so two runs can be compared with --baseline.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import time
+import traceback
+
+import numpy as np
+
+import gfam_exec
+from benchmarks.synthetic_inputs import makeTestVideo, syntheticNodeWrapper, writeSyntheticTelemetry
+from code import telemetry_cleaning_hero9
+from code.apply_tags_hero9 import finalizeVideo
+from code.run_report import finishRunReport, newRunReport, timeStage
+from code.telemetry_cleaning_hero9 import cleanACCL, cleanGPS, cleanGRAV, cleanGYRO, cleanIORI
+
+SCHEMA_VERSION = 1
+REQUIRED_TOOLS = ['ffmpeg', 'ffprobe']
+CLEANERS = {
+    'GPS': cleanGPS,
+    'ACCL': cleanACCL,
+    'GYRO': cleanGYRO,
+    'GRAV': cleanGRAV,
+    'IORI': cleanIORI
+}
+STAGE_KEYS = ['wall_s', 'cpu_s', 'child_cpu_s', 'items', 'items_per_s', 'bytes_read', 'bytes_written', 'mb_per_s', 'processes']
+
+def caseName(duration, resolution, fps):
+    """ Names a benchmark case, e.g. 60s_1920x1080_30fps.
+
+    :rtype: str
+    """
+
+    return f"{duration:g}s_{resolution}_{fps:g}fps"
+
+def benchmarkSettings(nth, sfm, ori, streaming):
+    """ Pipeline settings of a benchmark run, the defaults of a typical walking survey.
+
+    :rtype: dict
+    """
+
+    return {
+        'nth_frame': nth,
+        'js_path': None,
+        'rescale_z': False,
+        'min_z': None,
+        'max_z': None,
+        'ori': ori,
+        'sfm': sfm,
+        'prefix': '',
+        'north_hem': True,
+        'west_hem': True,
+        'clean_up': True,
+        'config_file': os.path.join('supplementary_files', 'pix4d.config'),
+        'min_speed': None,
+        'min_stationary': 2.0,
+        'rc_output': 'flight_log',
+        'p4d_output': 'exif',
+        'gps_quality': None,
+        'max_dop': 5.0,
+        'min_fix': 3,
+        'dedup': False,
+        'dedup_hamming': 4,
+        'dedup_radius': 5.0,
+        'dedup_action': 'report',
+        'shard_size': None,
+        'scratch_budget_mb': None,
+        'streaming': streaming,
+        'stage_timeouts': None,
+        'stage_threads': None,
+        'profile': False,
+        'trace_memory': False
+    }
+
+def timeCall(function, *args, **kwargs):
+    """ Times a single call, recording the error instead of raising it.
+
+    :return: wall_s, and error when the call raised
+    :rtype: dict, object
+    """
+
+    start = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+        error = None
+    except Exception as e:
+        result = None
+        error = f"{type(e).__name__}: {e}"
+        logging.debug(traceback.format_exc())
+    timing = {'wall_s': time.perf_counter() - start}
+    if error is not None:
+        timing['error'] = error
+    return timing, result
+
+def benchmarkCleaners(clean_dir, duration, fps):
+    """ Times every clean* parser on a full set of synthetic streams.
+
+    :return: wall time, sample count and time per sample of each stream
+    :rtype: dict
+    """
+
+    os.makedirs(clean_dir)
+    paths = {stream: os.path.join(clean_dir, stream + '.csv') for stream in CLEANERS}
+    writeSyntheticTelemetry(duration, fps=fps, output_gps=paths['GPS'], output_accl=paths['ACCL'], output_gyro=paths['GYRO'],
+                            output_grav=paths['GRAV'], output_iori=paths['IORI'])
+    results = {}
+    for stream, cleaner in CLEANERS.items():
+        with open(paths[stream]) as stream_csv:
+            samples = sum(1 for _ in stream_csv) - 1
+        timing, _ = timeCall(cleaner, paths[stream])
+        timing['samples'] = samples
+        timing['us_per_sample'] = timing['wall_s'] / samples * 1e6 if samples else 0.0
+        results[stream] = timing
+    return results
+
+def benchmarkPhotoSelection(image_dir):
+    """ Times the photo_selection_tools functions on a folder of geotagged frames.
+
+    :return: wall time of each function and the number of images
+    :rtype: dict
+    """
+
+    # matplotlib, shapely and pyproj are only needed here
+    from code.photo_selection_tools import SOURCE_EPSG, TARGET_EPSG, getBBFromDirectory, getImgCoordsFromDirectory, selectCoordsWithinCell, selectPhotosWithinCell
+
+    results = {'n_images': len([i for i in os.listdir(image_dir) if i.endswith('.jpg')])}
+    results['getBBFromDirectory'], bounds = timeCall(getBBFromDirectory, image_dir, SOURCE_EPSG, TARGET_EPSG)
+    results['getImgCoordsFromDirectory'], img_coords = timeCall(getImgCoordsFromDirectory, image_dir, SOURCE_EPSG, TARGET_EPSG)
+    if bounds is None or img_coords is None:
+        return results
+    x = (bounds[0][0] + bounds[1][0]) / 2
+    y = (bounds[0][1] + bounds[1][1]) / 2
+    results['selectPhotosWithinCell'], selected = timeCall(selectPhotosWithinCell, x, y, 10, 10, image_dir)
+    results['selectCoordsWithinCell'], _ = timeCall(selectCoordsWithinCell, x, y, 10, 10, img_coords)
+    results['n_selected'] = len(selected) if selected is not None else 0
+    return results
+
+def runCase(work_dir, duration, resolution, fps, settings, keep=False):
+    """ Runs one benchmark case.
+
+    :return: the case's results
+    :rtype: dict
+    """
+
+    name = caseName(duration, resolution, fps)
+    width, height = [int(i) for i in resolution.split('x')]
+    input_video = os.path.join(work_dir, 'inputs', f'testsrc_{name}.MP4')
+    makeTestVideo(input_video, duration, width=width, height=height, fps=fps)
+
+    case_dir = os.path.join(work_dir, 'runs', name)
+    if os.path.exists(case_dir):
+        shutil.rmtree(case_dir)
+    os.makedirs(case_dir)
+    output_dir = os.path.join(case_dir, 'gfam_outputs')
+    targets = gfam_exec.sfmTargets(settings['sfm'])
+    logging.info(f"Running case {name}.")
+
+    # testsrc videos have no GPMF track, synthetic telemetry stands in for the node extraction
+    telemetry_cleaning_hero9.nodeWrapperHERO9 = syntheticNodeWrapper(duration, fps=fps)
+    report = newRunReport(input_video)
+    error = None
+    try:
+        gfam_exec.processVideo(input_video, os.path.join(case_dir, 'video'), settings, report=report)
+        with timeStage(report, 'cleanup') as stage:
+            finalizeVideo(os.path.join(case_dir, 'video'), output_dir, settings['nth_frame'], targets=targets if len(targets) > 1 else None)
+            stage['items'] = report['stages']['tag']['items']
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        logging.error(f"Case {name} failed: {error}")
+        logging.debug(traceback.format_exc())
+
+    result = {
+        'params': {
+            'duration_s': duration,
+            'width': width,
+            'height': height,
+            'fps': fps,
+            'nth_frame': settings['nth_frame'],
+            'sfm': settings['sfm'],
+            'ori': settings['ori'],
+            'streaming': settings['streaming'],
+            'video_bytes': report['video_bytes']
+        },
+        'stages': {stage: {key: entry[key] for key in STAGE_KEYS} for stage, entry in report['stages'].items()},
+        'processes': finishRunReport(report)['processes']
+    }
+    if error is not None:
+        result['error'] = error
+    result['wall_s'] = sum(i['wall_s'] for i in result['stages'].values())
+    result['clean'] = benchmarkCleaners(os.path.join(case_dir, 'clean'), duration, fps)
+    image_dir = os.path.join(output_dir, 'images')
+    if os.path.isdir(image_dir):
+        result['photo_selection'] = benchmarkPhotoSelection(image_dir)
+    if not keep:
+        shutil.rmtree(case_dir)
+    return name, result
+
+def environment():
+    """ Describes the machine the benchmark ran on.
+
+    :rtype: dict
+    """
+
+    from code.process_runner import runProcess
+    ffmpeg = runProcess(['ffmpeg', '-version'], capture=True).stdout.decode('utf-8').splitlines()[0]
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': __import__('pandas').__version__,
+        'ffmpeg': ffmpeg,
+        'exiftool': shutil.which('exiftool') is not None
+    }
+
+def compareResults(results, baseline):
+    """ Logs the wall time ratio (new / baseline) of every stage of the cases found in both results.
+
+    :param results: Output of a benchmark run.
+    :type results: dict
+    :param baseline: Output of an earlier benchmark run.
+    :type baseline: dict
+
+    :return: ratio per case and stage
+    :rtype: dict
+    """
+
+    ratios = {}
+    for name, case in results['cases'].items():
+        if name not in baseline.get('cases', {}):
+            continue
+        old_case = baseline['cases'][name]
+        ratios[name] = {}
+        for stage, entry in case['stages'].items():
+            old = old_case['stages'].get(stage, {}).get('wall_s')
+            if old:
+                ratios[name][stage] = entry['wall_s'] / old
+        for stream, entry in case['clean'].items():
+            old = old_case.get('clean', {}).get(stream, {}).get('wall_s')
+            if old and 'error' not in entry:
+                ratios[name]['clean_' + stream] = entry['wall_s'] / old
+        for name_stage, ratio in ratios[name].items():
+            logging.info(f"{name} {name_stage}: {ratio:.2f}x baseline")
+    return ratios
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks the pipeline on synthetic GoPro-like inputs.')
+    parser.add_argument('--durations', help='video lengths (s)', type=float, nargs='+', default=[30])
+    parser.add_argument('--resolutions', help='video sizes, e.g. 1920x1080', type=str, nargs='+', default=['1920x1080'])
+    parser.add_argument('--fps', help='video frame rates', type=float, nargs='+', default=[30])
+    parser.add_argument('--nth', help='nth_frame setting', type=int, default=30)
+    parser.add_argument('--sfm', help='sfm setting', type=str, default='P4D')
+    parser.add_argument('--ori', help='export orientation', action='store_true')
+    parser.add_argument('--streaming', help='use the streaming pipeline', action='store_true')
+    parser.add_argument('--work-dir', help='folder for the synthetic inputs and runs', type=str, default='benchmark_work')
+    parser.add_argument('--keep', help='keep the outputs of every case', action='store_true')
+    parser.add_argument('--baseline', help='earlier results to compare against', type=str, default=None)
+    parser.add_argument('-o', help='path to the JSON results', type=str, default='benchmark_results.json')
+    parser.add_argument('--log-level', help='logging level, e.g. DEBUG', type=str, default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(message)s')
+
+    required = REQUIRED_TOOLS + ([] if args.streaming else ['exiftool'])
+    missing = [i for i in required if shutil.which(i) is None]
+    if missing:
+        sys.exit(f"Missing required tools: {', '.join(missing)}")
+
+    settings = benchmarkSettings(args.nth, args.sfm, args.ori, args.streaming)
+    results = {
+        'schema': SCHEMA_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'cases': {}
+    }
+    for duration in args.durations:
+        for resolution in args.resolutions:
+            for fps in args.fps:
+                name, result = runCase(os.path.abspath(args.work_dir), duration, resolution, fps, settings, keep=args.keep)
+                results['cases'][name] = result
+                logging.info(f"{name}: {result['wall_s']:.1f} s")
+
+    if args.baseline is not None:
+        with open(args.baseline) as json_file:
+            results['baseline'] = {'path': args.baseline, 'ratios': compareResults(results, json.load(json_file))}
+    with open(args.o, 'w') as json_file:
+        json.dump(results, json_file, indent=2)
+    logging.info(f"Results written to {args.o}")
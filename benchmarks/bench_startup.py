@@ -0,0 +1,176 @@
+""" Cold start benchmarks of the command line and the pipeline workers.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.bench_startup -o startup.json
+    python -m benchmarks.bench_startup --update-baseline
+
+Every case starts a fresh interpreter, the time is the best of --repeats runs. Times are divided by the start of a bare
+interpreter (python -c pass), so they can be compared across machines with the stored baseline (startup_baseline.json).
+The run fails when a case is slower than --max-ratio times its baseline, or when importing gfam_exec loads any of
+HEAVY_MODULES again.
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from code.pipeline_worker import startWorker, stopWorker, workerEvents
+
+SCHEMA_VERSION = 1
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_JSON = os.path.join(REPO_DIR, 'benchmarks', 'startup_baseline.json')
+MAX_RATIO = 1.5
+HEAVY_MODULES = ['pandas', 'numpy', 'matplotlib', 'shapely', 'pyproj']
+
+# python -c commands, run from the repository root
+CASES = {
+    'interpreter': 'pass',
+    'import_gfam_exec': 'import gfam_exec',
+    'cli_help': 'import sys, runpy; sys.argv = ["gfam_exec.py", "--help"]; runpy.run_path("gfam_exec.py", run_name="__main__")',
+    'preload_pipeline': 'import gfam_exec; gfam_exec.preloadPipeline()'
+}
+
+def timeCommand(code, repeats):
+    """ Times a python -c command in fresh interpreters.
+
+    :param code: The python code.
+    :type code: str
+    :param repeats: Number of runs.
+    :type repeats: int
+
+    :return: the best wall time (s)
+    :rtype: float
+    """
+
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, stdout=subprocess.DEVNULL, check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def heavyModulesAtImport():
+    """ Returns which of HEAVY_MODULES a fresh interpreter has loaded after importing gfam_exec.
+
+    :rtype: list of str
+    """
+
+    code = f"import sys, gfam_exec; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    output = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+    return output.split()
+
+def timeWorkerReady(repeats, timeout=60.0):
+    """ Times how long a pipeline worker takes to start and import the pipeline, see startWorker().
+
+    :param repeats: Number of workers started.
+    :type repeats: int
+    :param timeout: Seconds to wait for a worker. Defaults to 60.
+    :type timeout: float
+
+    :return: the best time to the worker's ready event (s)
+    :rtype: float
+    """
+
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        worker = startWorker(log_level='WARNING')
+        ready = False
+        while not ready and time.perf_counter() - start < timeout:
+            ready = any(event[0] == 'ready' for event in workerEvents(worker))
+            time.sleep(0.005)
+        elapsed = time.perf_counter() - start
+        stopWorker(worker)
+        worker['process'].join(timeout)
+        if not ready:
+            raise TimeoutError(f"Worker not ready after {timeout} s.")
+        best = min(best, elapsed)
+    return best
+
+def benchmarkStartup(repeats):
+    """ Runs every case.
+
+    :param repeats: Runs per case.
+    :type repeats: int
+
+    :return: best time per case (s)
+    :rtype: dict
+    """
+
+    results = {}
+    for name, code in CASES.items():
+        results[name] = timeCommand(code, repeats)
+        logging.info(f"{name}: {results[name] * 1000:.0f} ms")
+    results['worker_ready'] = timeWorkerReady(repeats)
+    logging.info(f"worker_ready: {results['worker_ready'] * 1000:.0f} ms")
+    return results
+
+def checkBaseline(results, baseline, max_ratio=MAX_RATIO):
+    """ Compares the times, relative to a bare interpreter, against a baseline.
+
+    :param results: Output of a run of this module.
+    :type results: dict
+    :param baseline: Stored results.
+    :type baseline: dict
+    :param max_ratio: Highest accepted slowdown. Defaults to MAX_RATIO.
+    :type max_ratio: float
+
+    :return: ratio per case, and the (case, ratio) over max_ratio
+    :rtype: dict, list of tuple
+    """
+
+    ratios = {}
+    regressions = []
+    calibration = results['cases']['interpreter']
+    old_calibration = baseline['cases']['interpreter']
+    for name, seconds in results['cases'].items():
+        if name == 'interpreter' or name not in baseline['cases']:
+            continue
+        ratios[name] = (seconds / calibration) / (baseline['cases'][name] / old_calibration)
+        if ratios[name] > max_ratio:
+            regressions.append((name, ratios[name]))
+    return ratios, regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Cold start benchmarks of the command line and the pipeline workers.')
+    parser.add_argument('--repeats', help='runs per case', type=int, default=5)
+    parser.add_argument('--baseline', help='stored results to check against', type=str, default=BASELINE_JSON)
+    parser.add_argument('--max-ratio', help='highest accepted slowdown against the baseline', type=float, default=MAX_RATIO)
+    parser.add_argument('--update-baseline', help='store this run as the baseline', action='store_true')
+    parser.add_argument('-o', help='path to the JSON results', type=str, default=None)
+    parser.add_argument('--log-level', help='logging level, e.g. DEBUG', type=str, default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(message)s')
+
+    results = {
+        'schema': SCHEMA_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'cases': benchmarkStartup(args.repeats),
+        'heavy_modules_at_import': heavyModulesAtImport()
+    }
+
+    failed = bool(results['heavy_modules_at_import'])
+    if failed:
+        logging.error(f"Importing gfam_exec loads {', '.join(results['heavy_modules_at_import'])}, they should be imported where they are used.")
+    if not args.update_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as json_file:
+            ratios, regressions = checkBaseline(results, json.load(json_file), max_ratio=args.max_ratio)
+        results['baseline'] = {'path': args.baseline, 'ratios': ratios}
+        for name, ratio in regressions:
+            logging.error(f"{name} is {ratio:.2f}x slower than its baseline (limit {args.max_ratio}x).")
+        failed = failed or bool(regressions)
+    if args.o is not None:
+        with open(args.o, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+        logging.info(f"Results written to {args.o}")
+    if args.update_baseline:
+        with open(args.baseline, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+        logging.info(f"Baseline written to {args.baseline}")
+    sys.exit(1 if failed else 0)
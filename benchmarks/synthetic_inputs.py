@@ -0,0 +1,178 @@
+import logging
+import os
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+# Sample rates of the HERO9 GPMF streams (Hz), GRAV and IORI come with every video frame
+GPS_RATE = 18.0
+IMU_RATE = 200.0
+ORIGIN = (38.5382, -121.7617, 15.0) # lat, lon, elev, inside EPSG:3310 like the field sites
+WALKING_SPEED = 1.4 # m/s
+TRACK_WIDTH = 20.0 # m between the passes of the lawnmower pattern
+METRES_PER_DEGREE = 111320.0
+
+def makeTestVideo(output_video, duration, width=1920, height=1080, fps=30):
+    """ Encodes an ffmpeg testsrc2 video shaped like GoPro footage (H.264, one keyframe per second).
+
+    :param output_video: Filepath to the output video, reused when it already exists.
+    :type output_video: str
+    :param duration: Length of the video (s).
+    :type duration: float
+    :param width: Width of the video. Defaults to 1920.
+    :type width: int
+    :param height: Height of the video. Defaults to 1080.
+    :type height: int
+    :param fps: Frame rate of the video. Defaults to 30.
+    :type fps: float
+    """
+
+    if os.path.exists(output_video):
+        logging.debug(f"Reusing {output_video}.")
+        return
+    os.makedirs(os.path.dirname(output_video), exist_ok=True)
+    video_call = [
+        'ffmpeg', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate={fps}:duration={duration}',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-g', str(int(round(fps))),
+        output_video
+    ]
+    subprocess.run(video_call, check=True)
+    logging.info(f"Synthetic video written to {output_video}")
+
+def walkTrack(t, origin=ORIGIN, speed=WALKING_SPEED, width=TRACK_WIDTH, seed=0):
+    """ Positions of someone walking a lawnmower pattern, passes of 5 * width metres.
+
+    :param t: Times (s).
+    :type t: numpy.ndarray
+    :param origin: lat, lon, elev of the start. Defaults to ORIGIN.
+    :type origin: tuple
+    :param speed: Walking speed (m/s). Defaults to WALKING_SPEED.
+    :type speed: float
+    :param width: Distance between passes (m). Defaults to TRACK_WIDTH.
+    :type width: float
+    :param seed: Seed of the GPS noise. Defaults to 0.
+    :type seed: int
+
+    :return: lat, lon, elev
+    :rtype: numpy.ndarray, numpy.ndarray, numpy.ndarray
+    """
+
+    rng = np.random.default_rng(seed)
+    length = 5 * width
+    distance = t * speed
+    leg, along = np.divmod(distance, length + width)
+    # each leg is a pass followed by a turn to the next pass
+    x = np.where(along < length, along, length)
+    x = np.where(leg % 2 == 0, x, length - x)
+    y = leg * width + np.clip(along - length, 0, width)
+    x = x + rng.normal(0, 0.5, len(t))
+    y = y + rng.normal(0, 0.5, len(t))
+    lat = origin[0] + y / METRES_PER_DEGREE
+    lon = origin[1] + x / (METRES_PER_DEGREE * np.cos(np.radians(origin[0])))
+    elev = origin[2] + 0.5 * np.sin(t / 30) + rng.normal(0, 1.0, len(t))
+    return lat, lon, elev
+
+def _joinValues(columns):
+    """ Formats sample channels like the value column of the JS extraction, e.g. "1.0,2.0,3.0".
+
+    :param columns: One array per channel.
+    :type columns: list of numpy.ndarray
+
+    :rtype: pandas.Series
+    """
+
+    value = pd.Series(np.round(columns[0], 7)).astype(str)
+    for column in columns[1:]:
+        value = value + ',' + pd.Series(np.round(column, 7)).astype(str)
+    return value
+
+def _writeStream(output_csv, cts, columns, extra=None):
+    """ Writes one stream in the CSV layout of telemetry_extraction_hero9.js (value, cts, date and sticky columns).
+
+    :param output_csv: Filepath to the output CSV.
+    :type output_csv: str
+    :param cts: Camera times (ms).
+    :type cts: numpy.ndarray
+    :param columns: One array per channel.
+    :type columns: list of numpy.ndarray
+    :param extra: Sticky columns, e.g. fix and precision. Defaults to None.
+    :type extra: dict
+    """
+
+    start = pd.Timestamp('2024-06-01T17:00:00Z')
+    stream = pd.DataFrame({
+        'value': _joinValues(columns),
+        'cts': np.round(cts, 3),
+        'date': (start + pd.to_timedelta(cts, unit='ms')).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    })
+    for key, column in (extra or {}).items():
+        stream[key] = column
+    stream.to_csv(output_csv, index=False)
+
+def writeSyntheticTelemetry(duration, fps=30, output_gps=None, output_accl=None, output_gyro=None, output_grav=None, output_iori=None, seed=0):
+    """ Writes GoPro-like raw telemetry for a walk of the given duration, in the layout cleanHERO9() expects.
+
+    GPS5 (lat, lon, alt, 2D and 3D speed with fix and precision) is written at GPS_RATE, ACCL and GYRO at IMU_RATE and
+    GRAV and IORI once per frame. A few GPS samples lose their fix so the quality flags have something to do.
+
+    :param duration: Length of the recording (s).
+    :type duration: float
+    :param fps: Frame rate of the video, sets the GRAV and IORI rate. Defaults to 30.
+    :type fps: float
+    :param output_gps: Filepath where GPS stream will be saved. Defaults to None.
+    :type output_gps: str
+    :param output_accl: Filepath where ACCL stream will be saved. Defaults to None.
+    :type output_accl: str
+    :param output_gyro: Filepath where GYRO stream will be saved. Defaults to None.
+    :type output_gyro: str
+    :param output_grav: Filepath where GRAV stream will be saved. Defaults to None.
+    :type output_grav: str
+    :param output_iori: Filepath where IORI stream will be saved. Defaults to None.
+    :type output_iori: str
+    :param seed: Seed of the noise. Defaults to 0.
+    :type seed: int
+    """
+
+    rng = np.random.default_rng(seed)
+    if output_gps:
+        t = np.arange(0, duration, 1 / GPS_RATE)
+        lat, lon, elev = walkTrack(t, seed=seed)
+        speed = WALKING_SPEED + rng.normal(0, 0.1, len(t))
+        fix = np.where(rng.random(len(t)) < 0.02, 2, 3)
+        precision = np.where(fix == 3, rng.integers(100, 250, len(t)), rng.integers(600, 1200, len(t)))
+        _writeStream(output_gps, t * 1000, [lat, lon, elev, speed, speed + rng.normal(0, 0.05, len(t))], {'fix': fix, 'precision': precision})
+    if output_accl or output_gyro:
+        t = np.arange(0, duration, 1 / IMU_RATE)
+        step = np.sin(2 * np.pi * 1.8 * t) # walking cadence
+        if output_accl:
+            _writeStream(output_accl, t * 1000, [9.81 + step + rng.normal(0, 0.3, len(t)), rng.normal(0, 0.3, len(t)), rng.normal(0, 0.3, len(t))])
+        if output_gyro:
+            _writeStream(output_gyro, t * 1000, [0.2 * step + rng.normal(0, 0.05, len(t)), rng.normal(0, 0.05, len(t)), rng.normal(0, 0.05, len(t))])
+    if output_grav or output_iori:
+        t = np.arange(0, duration, 1 / fps)
+        tilt = 0.05 * np.sin(2 * np.pi * 1.8 * t) + rng.normal(0, 0.01, len(t))
+        if output_grav:
+            _writeStream(output_grav, t * 1000, [np.sin(tilt), np.cos(tilt), rng.normal(0, 0.01, len(t))])
+        if output_iori:
+            heading = np.unwrap(rng.normal(0, 0.02, len(t)).cumsum())
+            _writeStream(output_iori, t * 1000, [np.cos(heading / 2), np.sin(tilt / 2), np.zeros(len(t)), np.sin(heading / 2)])
+
+def syntheticNodeWrapper(duration, fps=30, seed=0):
+    """ Returns a stand-in for nodeWrapperHERO9() that writes synthetic telemetry, testsrc videos have no GPMF track.
+
+    :param duration: Length of the video (s).
+    :type duration: float
+    :param fps: Frame rate of the video. Defaults to 30.
+    :type fps: float
+    :param seed: Seed of the noise. Defaults to 0.
+    :type seed: int
+
+    :rtype: function
+    """
+
+    def nodeWrapper(input_video, output_gps=None, output_accl=None, output_gyro=None, output_grav=None, output_iori=None, js_path=None):
+        writeSyntheticTelemetry(duration, fps=fps, output_gps=output_gps, output_accl=output_accl, output_gyro=output_gyro,
+                                output_grav=output_grav, output_iori=output_iori, seed=seed)
+    return nodeWrapper
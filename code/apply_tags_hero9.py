@@ -1,11 +1,26 @@
 import pandas as pd
 import numpy as np
 import os
+import json
 import logging
-import subprocess
 import shutil
 from bisect import bisect_left
 
+from code.exiftool_session import exifToolSession, runExifTool
+from code.file_management import linkOrCopy, renameOrMove
+from code.frame_alignment import FRAME_TABLE, buildFrameTable
+from code.frame_deduplication import HASH_CACHE, writeHashCache
+from code.frame_manifest import FRAME_MANIFEST, readFrameManifest, selectedFrames, writeFrameManifest
+from code.process_runner import runProcess
+from code.progress_events import reportFrames
+
+# Pix4D geolocation accuracy (m). Without DOP the defaults reflect typical GoPro GPS under canopy.
+GPS_UERE = 5.0
+DEFAULT_HORIZONTAL_ACCURACY = 50.0
+DEFAULT_VERTICAL_ACCURACY = 100.0
+# files a video places in gfam_outputs, recorded in its project directory, see recordVideoOutputs()
+OUTPUT_JOURNAL = 'output_journal.json'
+
 def findClosestCTS(cts, cts_list):
     """ Uses bisection search to find the nearest neighbor for a CTS.
 
@@ -33,7 +48,7 @@ def findClosestCTS(cts, cts_list):
         logging.debug('Found CTS %s', before)
         return before
 
-def applyTags(input_dir, gps_csv=None, ori_csv=None, sfm='P4D', fps=30, file_ending='.jpg', north_hem=True, west_hem=True, config_file=None):
+def applyTags(input_dir, gps_csv=None, ori_csv=None, sfm='P4D', fps=30, file_ending='.jpg', north_hem=True, west_hem=True, config_file=None, skip_poor_gps=False, frame_table=None, frame_pts=None, manifest=None):
     """ Tags a directory of cts labelled frames with their GPS and GYRO data using exif_tool.
 
     :param input_dir: Filepath to the directory of labelled frames.
@@ -55,58 +70,170 @@ def applyTags(input_dir, gps_csv=None, ori_csv=None, sfm='P4D', fps=30, file_end
     :type west_hem: bool
     :param config_file: Filepath to the config file for extra EXIF tags. Defaults to None.
     :type config_file: str
+    :param skip_poor_gps: Leaves out the GPS tags of frames whose nearest GPS sample is flagged by cleanGPS(). Defaults to False.
+    :type skip_poor_gps: bool
+    :param frame_table: Output of buildFrameTable(), built from the CSVs if not supplied. Defaults to None.
+    :type frame_table: pandas df
+    :param frame_pts: Exact PTS (ms) of every source frame from extractFramePTS(), replaces fps. Defaults to None.
+    :type frame_pts: numpy.ndarray
+    :param manifest: Frame manifest of the video, lists the frames instead of input_dir. Defaults to None.
+    :type manifest: pandas df
     """
 
-    if gps_csv is not None:
-        gps_df = pd.read_csv(gps_csv)
-    if ori_csv is not None:
-        ori_df = pd.read_csv(ori_csv)
+    if frame_table is None:
+        frame_table = buildFrameTable(
+            input_dir,
+            gps_csv=gps_csv,
+            gyro_csv=ori_csv if sfm == 'P4D' else None,
+            grav_csv=ori_csv if sfm == 'RC' else None,
+            fps=fps,
+            file_ending=file_ending,
+            frame_pts=frame_pts,
+            manifest=manifest
+        )
+    writeEXIFTags(
+        frame_table,
+        gps=gps_csv is not None,
+        ori=ori_csv is not None and sfm == 'P4D',
+        north_hem=north_hem,
+        west_hem=west_hem,
+        config_file=config_file,
+        skip_poor_gps=skip_poor_gps
+    )
+    if ori_csv is not None and sfm == 'RC':
+        writeGravityXMPs(frame_table)
+
+def writeEXIFTags(frame_table, gps=True, ori=False, north_hem=True, west_hem=True, config_file=None, skip_poor_gps=False):
+    """ Writes the GPS and Pix4D orientation tags of every frame in a frame table using exif_tool.
+
+    :param frame_table: Output of buildFrameTable().
+    :type frame_table: pandas df
+    :param gps: Writes the GPS tags. Defaults to True.
+    :type gps: bool
+    :param ori: Writes the Pix4D Pitch, Roll and Yaw tags. Defaults to False.
+    :type ori: bool
+    :param north_hem: Controls whether latitude is written in N hemisphere. Defaults to True.
+    :type north_hem: bool
+    :param west_hem: Controls whether longitude is written in W hemisphere. Defaults to True.
+    :type west_hem: bool
+    :param config_file: Filepath to the config file for extra EXIF tags. Defaults to None.
+    :type config_file: str
+    :param skip_poor_gps: Leaves out the GPS tags of frames flagged in gps_ok. Defaults to False.
+    :type skip_poor_gps: bool
+    """
 
-    for i in sorted(os.listdir(input_dir)):
-        if not i.endswith(file_ending):
-            logging.debug(f"Skipping {i}.")
+    gps = gps and 'lat' in frame_table
+    ori = ori and 'p4d_pitch' in frame_table
+    if not gps and not ori:
+        logging.debug("No EXIF tags to write.")
+        return
+
+    gps_usable = np.ones(len(frame_table), dtype=bool)
+    if gps and skip_poor_gps:
+        gps_usable = frame_table['gps_ok'].to_numpy(bool)
+        logging.info(f"{int((~gps_usable).sum())} frames have a poor GPS fix and will not be geotagged.")
+    lat_ref = '-GPSLatitudeRef=North' if north_hem == True else '-GPSLatitudeRef=South'
+    lon_ref = '-GPSLongitudeRef=West' if west_hem == True else '-GPSLongitudeRef=East'
+
+    # a persistent exiftool, when one is running (see setExifToolSession()), saves starting perl for every frame
+    session = exifToolSession(config_file if ori else None)
+    for k, row in enumerate(frame_table.itertuples(index=False)):
+        tag_args = []
+        if gps and gps_usable[k]:
+            tag_args.extend(['-GPSLatitude ='+str(row.lat), '-GPSLongitude ='+str(row.lon), '-GPSAltitude ='+str(row.elev)])
+            tag_args.extend([lat_ref, lon_ref])
+        if ori:
+            tag_args.extend(['-Pitch ='+str(row.p4d_pitch), '-Roll ='+str(row.p4d_roll), '-Yaw ='+str(row.p4d_yaw)])
+        if not tag_args:
+            # a poor fix frame without orientation tags, exiftool would only report that nothing changed
+            reportFrames(k + 1, len(frame_table))
             continue
-        frame = os.path.join(input_dir, i)
-        info = i.split('_')
-        cts = info[-1]
-        cts = float(cts[:-4])/fps*1000
-        tagging_call = ['exiftool']
-        if gps_csv is not None:
-            gps_cts = sorted(gps_df['cts'])
-            closest_gps = findClosestCTS(cts, gps_cts)
-            gps_row = gps_df.loc[gps_df['cts'] == closest_gps]
-            lat = gps_row['lat'].iloc[0]
-            lon = gps_row['lon'].iloc[0]
-            elev = gps_row['elev'].iloc[0]
-            logging.debug("Found telemetry tags")
-            tagging_call.extend(['-GPSLatitude ='+str(lat), '-GPSLongitude ='+str(lon), '-GPSAltitude ='+str(elev)])
-            if north_hem == True:
-                tagging_call.append('-GPSLatitudeRef=North')
-            else:    
-                tagging_call.append('-GPSLatitudeRef=South')
-            if west_hem == True:
-                tagging_call.append('-GPSLongitudeRef=West')
-            else:    
-                tagging_call.append('-GPSLongitudeRef=East')
-        if ori_csv is not None:
-            ori_cts = sorted(ori_df['cts'])
-            closest_ori = findClosestCTS(cts, ori_cts)
-            ori_row = ori_df.loc[ori_df['cts'] == closest_ori]
-            if sfm == 'P4D':
-                rY = ((ori_row['rX'].iloc[0])/np.pi*180)+90
-                rX = (ori_row['rY'].iloc[0])/np.pi*180
-                rZ = (ori_row['rZ'].iloc[0])/np.pi*180       
-                tagging_call.insert(1, '-config')
-                tagging_call.insert(2, config_file)
-                tagging_call.extend(['-Pitch ='+str(rY), '-Roll ='+str(rX), '-Yaw ='+str(rZ)])
-            elif sfm == 'RC':
-                grav_X = ori_row['x'].iloc[0]
-                grav_Y = ori_row['y'].iloc[0]
-                grav_Z = ori_row['z'].iloc[0]
-                grav_vector = [grav_X, grav_Y, grav_Z]
-                createGravityXMP(frame, grav_vector)
-        tagging_call.extend(['-overwrite_original', frame])
-        subprocess.run(tagging_call)
+        tag_args.extend(['-overwrite_original', row.frame])
+        if session is not None:
+            output = runExifTool(session, tag_args)
+            if '1 image files updated' not in output:
+                logging.warning(f"exiftool did not update {row.frame}: {output.strip()}")
+        else:
+            tagging_call = ['exiftool']
+            if ori:
+                tagging_call.extend(['-config', config_file])
+            runProcess(tagging_call + tag_args)
+        reportFrames(k + 1, len(frame_table))
+
+def writeGravityXMPs(frame_table):
+    """ Writes a RealityCapture gravity XMP sidecar for every frame in a frame table.
+
+    :param frame_table: Output of buildFrameTable(), must include the GRAV stream.
+    :type frame_table: pandas df
+    """
+
+    gravity = frame_table[['grav_x', 'grav_y', 'grav_z']].to_numpy(float)
+    for frame, gravity_vector in zip(frame_table['frame'], gravity):
+        createGravityXMP(frame, gravity_vector)
+
+def applyTagsForTargets(frame_table, targets, ori=False, north_hem=True, west_hem=True, config_file=None, skip_poor_gps=False, link_mode='hardlink', rc_output='xmp', p4d_output='exif', input_dir=None):
+    """ Writes the outputs of several SfM targets from one set of decoded frames and one frame table.
+
+    The GPS tags shared by every target are written once in place. Each target then gets its own folder next to the
+    frames (e.g. subsample_30_frames_RC) filled with links, and only its target specific outputs are added. exiftool
+    -overwrite_original replaces the file rather than editing it, so tagging one target never alters another's links.
+
+    :param frame_table: Output of buildFrameTable(), with the streams needed by all targets.
+    :type frame_table: pandas df
+    :param targets: SfM targets, e.g. ['P4D', 'RC']
+    :type targets: list of str
+    :param ori: Writes the orientation outputs (P4D tags, RC gravity XMPs). Defaults to False.
+    :type ori: bool
+    :param north_hem: Controls whether latitude is written in N hemisphere. Defaults to True.
+    :type north_hem: bool
+    :param west_hem: Controls whether longitude is written in W hemisphere. Defaults to True.
+    :type west_hem: bool
+    :param config_file: Filepath to the config file for extra EXIF tags. Defaults to None.
+    :type config_file: str
+    :param skip_poor_gps: Leaves out the GPS tags of frames flagged in gps_ok. Defaults to False.
+    :type skip_poor_gps: bool
+    :param link_mode: Passed to linkOrCopy(). Defaults to 'hardlink'.
+    :type link_mode: str
+    :param rc_output: 'xmp' writes RC gravity sidecars, 'flight_log' leaves them out (see writeRCFlightLog()). Defaults to 'xmp'.
+    :type rc_output: str
+    :param p4d_output: 'exif' writes the P4D tags, 'geolocation' leaves them out (see writeP4DGeolocation()). Defaults to 'exif'.
+    :type p4d_output: str
+    :param input_dir: Directory of the frames, the shard subdirectories below it are kept in the target folders.
+        Defaults to None (the folder of the first frame, i.e. the flat layout).
+    :type input_dir: str
+
+    :return: the output folder of each target
+    :rtype: dict
+    """
+
+    if rc_output not in ('xmp', 'flight_log'):
+        raise ValueError(f"Unknown rc_output {rc_output}, expected 'xmp' or 'flight_log'.")
+    if p4d_output not in ('exif', 'geolocation'):
+        raise ValueError(f"Unknown p4d_output {p4d_output}, expected 'exif' or 'geolocation'.")
+    if any(target != 'P4D' or p4d_output == 'exif' for target in targets):
+        writeEXIFTags(frame_table, gps=True, ori=False, north_hem=north_hem, west_hem=west_hem, skip_poor_gps=skip_poor_gps)
+    if len(frame_table) == 0:
+        return {}
+    if input_dir is None:
+        input_dir = os.path.dirname(frame_table['frame'].iloc[0])
+    relative_frames = [os.path.relpath(i, input_dir) for i in frame_table['frame']]
+    target_dirs = {}
+    for target in targets:
+        target_dir = os.path.normpath(input_dir) + '_' + target
+        os.mkdir(target_dir)
+        for shard in sorted({os.path.dirname(i) for i in relative_frames} - {''}):
+            os.makedirs(os.path.join(target_dir, shard))
+        target_frames = [os.path.join(target_dir, i) for i in relative_frames]
+        for src, dst in zip(frame_table['frame'], target_frames):
+            linkOrCopy(src, dst, mode=link_mode)
+        target_table = frame_table.assign(frame=target_frames)
+        if ori == True and target == 'P4D' and p4d_output == 'exif':
+            writeEXIFTags(target_table, gps=False, ori=True, config_file=config_file)
+        elif ori == True and target == 'RC' and rc_output == 'xmp':
+            writeGravityXMPs(target_table)
+        target_dirs[target] = target_dir
+        logging.info(f"{target} outputs written to {target_dir}")
+    return target_dirs
 
 def createGravityXMP(img_path, gravity_vector):
     """ Creates an XMP sidecar file containing a gravity vector for RealityCapture.
@@ -137,7 +264,7 @@ def createGravityXMP(img_path, gravity_vector):
     logging.info(f"XMP sidecar created at: {xmp_path}")
 
 
-def generateRCFlightLog(input_dir, gps_csv, gyro_csv, output_csv, fps=30, file_ending='.jpg', north_hem=True, west_hem=True):
+def generateRCFlightLog(input_dir, gps_csv, gyro_csv, output_csv, fps=30, file_ending='.jpg', north_hem=True, west_hem=True, frame_table=None, manifest=None):
     """Generates a flight log for RealityCapture to read IMU data.
 
     :param input_dir: Directory of labelled frames.
@@ -156,114 +283,387 @@ def generateRCFlightLog(input_dir, gps_csv, gyro_csv, output_csv, fps=30, file_e
     :type north_hem: bool
     :param west_hem: Controls whether longitude is written in W hemisphere. Defaults to True.
     :type west_hem: bool
+    :param frame_table: Output of buildFrameTable(), built from the CSVs if not supplied. Defaults to None.
+    :type frame_table: pandas df
+    :param manifest: Frame manifest of the video, lists the frames instead of input_dir. Defaults to None.
+    :type manifest: pandas df
     """
 
-    gps_df = pd.read_csv(gps_csv)
-    gyro_df = pd.read_csv(gyro_csv)
+    if frame_table is None:
+        frame_table = buildFrameTable(input_dir, gps_csv=gps_csv, gyro_csv=gyro_csv, fps=fps, file_ending=file_ending, manifest=manifest)
+    writeRCFlightLog(frame_table, output_csv, west_hem=west_hem)
 
-    flight_log_entries = []
+def writeRCFlightLog(frame_table, output_csv, west_hem=True, skip_poor_gps=False):
+    """Writes a RealityCapture flight log from a frame table in a single vectorized pass.
 
-    for i in sorted(os.listdir(input_dir)):
-        if not i.endswith(file_ending):
-            logging.debug(f"Skipping {i}")
-            continue
+    Images are listed by filename so the log stays valid after cleanUpIntermediate() moves them. Yaw, Pitch and Roll
+    are only written when the table includes the GYRO stream.
+
+    :param frame_table: Output of buildFrameTable(), must include the GPS stream.
+    :type frame_table: pandas df
+    :param output_csv: Path to the output flight log CSV.
+    :type output_csv: str
+    :param west_hem: Controls whether longitude is written in W hemisphere. Defaults to True.
+    :type west_hem: bool
+    :param skip_poor_gps: Leaves out the frames flagged in gps_ok. Defaults to False.
+    :type skip_poor_gps: bool
+    """
 
-        frame = input_dir + '/' + i
-        info = i.split('_')
-        cts = info[-1]
-        cts = float(cts[:-4])/fps*1000
-
-        gps_cts = sorted(gps_df['cts'])
-        closest_gps = findClosestCTS(cts, gps_cts)
-        gps_row = gps_df.loc[gps_df['cts'] == closest_gps]
-
-        lat = gps_row['lat'].iloc[0]
-        lon = gps_row['lon'].iloc[0]
-        elev = gps_row['elev'].iloc[0]
-
-        if west_hem and lon > 0:
-            lon = -lon
-
-        gyro_cts = sorted(gyro_df['cts'])
-        closest_gyro = findClosestCTS(cts, gyro_cts)
-        gyro_row = gyro_df.loc[gyro_df['cts'] == closest_gyro]
-
-        rY = ((gyro_row['rX'].iloc[0])/np.pi*180)
-        rX = (gyro_row['rY'].iloc[0])/np.pi*180
-        rZ = (gyro_row['rZ'].iloc[0])/np.pi*180     
-
-        flight_log_entries.append({
-            'Image': frame,
-            'Latitude': lat,
-            'Longitude': lon,
-            'Altitude': elev,
-            'Yaw': rZ,
-            'Pitch': rX,
-            'Roll': rY
-        })
-
-    flight_log_df = pd.DataFrame(flight_log_entries)
+    if skip_poor_gps:
+        frame_table = frame_table[frame_table['gps_ok'].to_numpy(bool)]
+    lon = frame_table['lon'].to_numpy(float)
+    if west_hem:
+        lon = np.where(lon > 0, -lon, lon)
+
+    flight_log_df = pd.DataFrame({
+        'Image': frame_table['frame'].map(os.path.basename),
+        'Latitude': frame_table['lat'],
+        'Longitude': lon,
+        'Altitude': frame_table['elev']
+    })
+    if 'p4d_pitch' in frame_table:
+        # the flight log uses the gyro axes without the Pix4D pitch offset, and with pitch and roll swapped
+        flight_log_df['Yaw'] = frame_table['p4d_yaw']
+        flight_log_df['Pitch'] = frame_table['p4d_roll']
+        flight_log_df['Roll'] = frame_table['p4d_pitch'] - 90
     flight_log_df.to_csv(output_csv, index=False)
 
-    logging.info(f"Flight log saved to f{output_csv}")
+    logging.info(f"Flight log with {len(flight_log_df)} images saved to {output_csv}")
+
+def writeP4DGeolocation(frame_table, output_csv, north_hem=True, west_hem=True, skip_poor_gps=False):
+    """Writes a Pix4D image geolocation file from a frame table in a single vectorized pass, leaving the JPEGs untouched.
+
+    Horizontal accuracy is estimated as DOP * GPS_UERE with the vertical accuracy twice that, or the default accuracies
+    when the GPS stream has no DOP. Yaw, Pitch and Roll are only written when the table includes the GYRO stream.
+
+    :param frame_table: Output of buildFrameTable(), must include the GPS stream.
+    :type frame_table: pandas df
+    :param output_csv: Path to the output geolocation CSV.
+    :type output_csv: str
+    :param north_hem: Controls whether latitude is written in N hemisphere. Defaults to True.
+    :type north_hem: bool
+    :param west_hem: Controls whether longitude is written in W hemisphere. Defaults to True.
+    :type west_hem: bool
+    :param skip_poor_gps: Leaves out the frames flagged in gps_ok. Defaults to False.
+    :type skip_poor_gps: bool
+    """
+
+    if skip_poor_gps:
+        frame_table = frame_table[frame_table['gps_ok'].to_numpy(bool)]
+    lat = np.abs(frame_table['lat'].to_numpy(float))
+    lon = np.abs(frame_table['lon'].to_numpy(float))
+    if not north_hem:
+        lat = -lat
+    if west_hem:
+        lon = -lon
+    if 'dop' in frame_table:
+        horizontal = frame_table['dop'].to_numpy(float) * GPS_UERE
+        vertical = horizontal * 2
+    else:
+        horizontal = np.full(len(frame_table), DEFAULT_HORIZONTAL_ACCURACY)
+        vertical = np.full(len(frame_table), DEFAULT_VERTICAL_ACCURACY)
+
+    geolocation_df = pd.DataFrame({
+        'imagename': frame_table['frame'].map(os.path.basename),
+        'latitude': lat,
+        'longitude': lon,
+        'altitude': frame_table['elev']
+    })
+    if 'p4d_pitch' in frame_table:
+        geolocation_df['yaw'] = frame_table['p4d_yaw']
+        geolocation_df['pitch'] = frame_table['p4d_pitch']
+        geolocation_df['roll'] = frame_table['p4d_roll']
+    geolocation_df['accuracy_horz'] = horizontal
+    geolocation_df['accuracy_vert'] = vertical
+    geolocation_df.to_csv(output_csv, index=False)
+
+    logging.info(f"Pix4D geolocation file with {len(geolocation_df)} images saved to {output_csv}")
+
+def _isEmptyDir(path):
+    """ Checks whether a directory is empty without listing it.
+
+    :param path: Filepath to the directory.
+    :type path: str
+
+    :rtype: bool
+    """
+
+    with os.scandir(path) as entries:
+        return next(entries, None) is None
+
+def finalFramePath(frame_rel, video_name):
+    """ Returns where a frame goes in gfam_outputs/images, sharded frames get one <video>_<shard> folder per shard.
+
+    :param frame_rel: Path of the frame relative to its subsample folder.
+    :type frame_rel: str
+    :param video_name: Name of the video's project directory.
+    :type video_name: str
+
+    :rtype: str
+    """
+
+    shard = os.path.dirname(frame_rel)
+    if shard:
+        return os.path.join(video_name + '_' + shard, os.path.basename(frame_rel))
+    return frame_rel
+
+def _placeFiles(src_dir, dst_dir, files):
+    """ Renames files from src_dir to dst_dir. Folders whose destination does not exist yet (or is empty) are renamed
+    as a whole instead of file by file.
+
+    :param src_dir: Filepath to the source folder.
+    :type src_dir: str
+    :param dst_dir: Filepath to the destination folder.
+    :type dst_dir: str
+    :param files: (source, destination) paths relative to src_dir and dst_dir.
+    :type files: list of tuple
+
+    :return: the number of folder renames
+    :rtype: int
+    """
+
+    groups = {}
+    for src_rel, dst_rel in files:
+        groups.setdefault((os.path.dirname(src_rel), os.path.dirname(dst_rel)), []).append((src_rel, dst_rel))
+    n_dirs = 0
+    for (src_sub, dst_sub), group in groups.items():
+        src_path = os.path.normpath(os.path.join(src_dir, src_sub))
+        dst_path = os.path.normpath(os.path.join(dst_dir, dst_sub))
+        names_match = all(os.path.basename(a) == os.path.basename(b) for a, b in group)
+        if names_match and os.path.isdir(dst_path) and _isEmptyDir(dst_path):
+            os.rmdir(dst_path)
+        if names_match and not os.path.exists(dst_path):
+            renameOrMove(src_path, dst_path)
+            n_dirs += 1
+            continue
+        os.makedirs(dst_path, exist_ok=True)
+        for src_rel, dst_rel in group:
+            renameOrMove(os.path.join(src_dir, src_rel), os.path.join(dst_dir, dst_rel))
+    return n_dirs
+
+def _verifyFiles(expected):
+    """ Checks that every expected file exists with its expected size.
 
-def cleanUpIntermediate(project_dir, nth=30):
+    :param expected: Filepath and size of every expected file.
+    :type expected: dict
+
+    :return: the filepaths that are missing or have the wrong size
+    :rtype: list of str
+    """
+
+    failed = []
+    for path, size in expected.items():
+        try:
+            if os.stat(path).st_size != size:
+                failed.append(path)
+        except FileNotFoundError:
+            failed.append(path)
+    return failed
+
+def recordVideoOutputs(video_dir, output_dir, images=None, files=None):
+    """ Records the files a video is about to place in gfam_outputs, in <video_dir>/output_journal.json, before any of
+    them is written, so an interrupted or failed run can be undone with discardVideoOutputs(). Entries are added to the
+    ones already recorded.
+
+    :param video_dir: Filepath to the video's project directory.
+    :type video_dir: str
+    :param output_dir: Filepath to gfam_outputs.
+    :type output_dir: str
+    :param images: Frames (and sidecars) per images folder, as {images folder: [paths relative to it]}. Defaults to None.
+    :type images: dict
+    :param files: Filepaths to the other files, e.g. telemetry. Defaults to None.
+    :type files: list of str
+    """
+
+    journal_json = os.path.join(video_dir, OUTPUT_JOURNAL)
+    journal = {'images': {}, 'files': []}
+    if os.path.exists(journal_json):
+        with open(journal_json) as json_file:
+            journal = json.load(json_file)
+    for image_dir, frames in (images or {}).items():
+        recorded = journal['images'].setdefault(os.path.relpath(image_dir, output_dir), [])
+        recorded.extend(sorted(set(frames) - set(recorded)))
+    journal['files'].extend(sorted({os.path.relpath(j, output_dir) for j in files or []} - set(journal['files'])))
+    with open(journal_json, 'w') as json_file:
+        json.dump(journal, json_file)
+
+def discardVideoOutputs(video_dir, output_dir):
+    """ Removes what a video placed in gfam_outputs before it was interrupted or failed, as recorded by
+    recordVideoOutputs(): its frames and their sidecars, also where near-duplicate removal moved them, their rows in
+    the hash cache and its telemetry. The video's project directory itself is left to the caller.
+
+    :param video_dir: Filepath to the video's project directory.
+    :type video_dir: str
+    :param output_dir: Filepath to gfam_outputs.
+    :type output_dir: str
+
+    :return: the number of files removed, 0 if the video recorded nothing
+    :rtype: int
+    """
+
+    journal_json = os.path.join(video_dir, OUTPUT_JOURNAL)
+    if not os.path.exists(journal_json):
+        return 0
+    with open(journal_json) as json_file:
+        journal = json.load(json_file)
+
+    removed = 0
+    for image_rel, frames in journal['images'].items():
+        image_dir = os.path.join(output_dir, image_rel)
+        parent_dir = os.path.dirname(os.path.normpath(image_dir))
+        frame_paths = set()
+        for frame_rel in frames:
+            frame = os.path.join(image_dir, frame_rel)
+            frame_paths.add(os.path.abspath(frame))
+            # removeNearDuplicates() moves dropped frames, with their sidecar, to duplicates next to the images folder
+            for path in (frame, os.path.join(parent_dir, 'duplicates', os.path.basename(frame))):
+                for candidate in (path, os.path.splitext(path)[0] + '.xmp'):
+                    if os.path.isfile(candidate):
+                        os.remove(candidate)
+                        removed += 1
+        for shard in {os.path.dirname(j) for j in frames if os.path.dirname(j)}:
+            shard_dir = os.path.join(image_dir, shard)
+            if os.path.isdir(shard_dir) and _isEmptyDir(shard_dir):
+                os.rmdir(shard_dir)
+        cache_csv = os.path.join(parent_dir, HASH_CACHE)
+        if os.path.exists(cache_csv):
+            cache = pd.read_csv(cache_csv, dtype={'SourceFile': str, 'dhash': str})
+            stale = cache['SourceFile'].map(os.path.abspath).isin(frame_paths)
+            if stale.any():
+                writeHashCache(cache[~stale], cache_csv)
+    for file_rel in journal['files']:
+        path = os.path.join(output_dir, file_rel)
+        if os.path.isfile(path):
+            os.remove(path)
+            removed += 1
+    os.remove(journal_json)
+    return removed
+
+def finalizeVideo(video_dir, output_dir, nth=30, targets=None):
+    """ Moves the outputs of one processed video into gfam_outputs and deletes its intermediate files.
+
+    Meant to run as soon as the video is processed. Everything is placed with same-filesystem renames: a subsample or
+    shard folder takes a single rename while its destination does not exist yet, otherwise each file is renamed. The
+    files to move come from the frame manifest (with their .xmp sidecars) and are checked at their new location
+    against the sizes they had before the move, so the cost is linear in the video's own frames whatever the size of
+    gfam_outputs. Frames that were streamed straight into gfam_outputs (see streamTaggedFrames()) are only checked
+    against the sizes in the manifest. Everything is recorded with recordVideoOutputs() before the first move, and the
+    video directory is only deleted when every file checks out.
+
+    :param video_dir: Filepath to the video's project directory.
+    :type video_dir: str
+    :param output_dir: Filepath to gfam_outputs.
+    :type output_dir: str
+    :param nth: The amount of frames extracted during processing, used to identify subsample directory. Defaults to 30.
+    :type nth: int
+    :param targets: SfM targets of a multi-target run, each gets its own gfam_outputs/<target>/images folder. Defaults to None.
+    :type targets: list of str
+
+    :return: True if every file was moved and verified
+    :rtype: bool
+    """
+
+    video_name = os.path.basename(os.path.normpath(video_dir))
+    subsample_name = 'subsample_' + str(nth) + '_frames'
+    if targets is None:
+        image_dirs = [(subsample_name, os.path.join(output_dir, 'images'))]
+    else:
+        image_dirs = [(subsample_name + '_' + target, os.path.join(output_dir, target, 'images')) for target in targets]
+    output_telemetry = os.path.join(output_dir, 'telemetry')
+    os.makedirs(output_telemetry, exist_ok=True)
+
+    telem_dir = os.path.join(video_dir, 'telem')
+    manifest_csv = os.path.join(telem_dir, FRAME_MANIFEST)
+    manifest = readFrameManifest(manifest_csv, video_dir) if os.path.exists(manifest_csv) else None
+    streamed = manifest is not None and not os.path.isdir(os.path.join(video_dir, subsample_name))
+    if manifest is None:
+        logging.warning(f"No frame manifest in {telem_dir}, listing the subsample folders instead.")
+    elif not streamed:
+        frames = [os.path.relpath(j, os.path.join(video_dir, subsample_name)) for j in selectedFrames(manifest)['path']]
+
+    expected = {}
+    n_dirs = 0
+    if streamed:
+        written = selectedFrames(manifest)
+        expected.update(zip(written['path'], written['size']))
+        image_dirs = []
+    placements = []
+    for subsample, output_images in image_dirs:
+        os.makedirs(output_images, exist_ok=True)
+        subsample_dir = os.path.join(video_dir, subsample)
+        if manifest is not None:
+            files = []
+            for frame_rel in frames:
+                dst_rel = finalFramePath(frame_rel, video_name)
+                files.append((frame_rel, dst_rel))
+                sidecar = os.path.splitext(frame_rel)[0] + '.xmp'
+                if os.path.exists(os.path.join(subsample_dir, sidecar)):
+                    files.append((sidecar, os.path.splitext(dst_rel)[0] + '.xmp'))
+        else:
+            files = [(j, j) for j in os.listdir(subsample_dir)]
+        for src_rel, dst_rel in files:
+            expected[os.path.join(output_images, dst_rel)] = os.stat(os.path.join(subsample_dir, src_rel)).st_size
+        placements.append((subsample_dir, output_images, files))
+    telem_files = [(j, video_name + '_' + j) for j in os.listdir(telem_dir)]
+    recordVideoOutputs(
+        video_dir,
+        output_dir,
+        images={output_images: [dst_rel for _, dst_rel in files] for _, output_images, files in placements},
+        files=[os.path.join(output_telemetry, dst_rel) for _, dst_rel in telem_files]
+    )
+    for subsample_dir, output_images, files in placements:
+        n_dirs += _placeFiles(subsample_dir, output_images, files)
+
+    if manifest is not None and not streamed:
+        # unselected frames are deleted with the video directory, selected ones now live in the first images folder
+        moved = selectedFrames(manifest).index
+        manifest['path'] = ''
+        manifest.loc[moved, 'path'] = [os.path.join(image_dirs[0][1], finalFramePath(j, video_name)) for j in frames]
+    if manifest is not None:
+        writeFrameManifest(manifest_csv, manifest, output_dir)
+    frame_table_csv = os.path.join(telem_dir, FRAME_TABLE)
+    if os.path.exists(frame_table_csv):
+        # its frames point into the video directory, they are made relative to gfam_outputs like the manifest's
+        frame_table = pd.read_csv(frame_table_csv)
+        if manifest is not None:
+            final_paths = dict(zip(manifest['index'] + 1, manifest['path']))
+            frame_table['frame'] = [final_paths[j] for j in frame_table['frame_index']]
+        else:
+            frame_table['frame'] = [os.path.join(image_dirs[0][1], os.path.basename(j)) for j in frame_table['frame']]
+        frame_table['frame'] = [os.path.relpath(j, output_dir) if j else '' for j in frame_table['frame']]
+        frame_table.to_csv(frame_table_csv, index=False)
+
+    for src_rel, dst_rel in telem_files:
+        src_telem = os.path.join(telem_dir, src_rel)
+        dst_telem = os.path.join(output_telemetry, dst_rel)
+        expected[dst_telem] = os.stat(src_telem).st_size
+        renameOrMove(src_telem, dst_telem)
+
+    failed = _verifyFiles(expected)
+    if failed:
+        logging.error(f"{len(failed)} of {len(expected)} files from {video_name} were not moved correctly, e.g. {failed[0]}. Keeping {video_dir}.")
+        return False
+    shutil.rmtree(video_dir, ignore_errors=True)
+    logging.info(f"Finalized {video_name}: {len(expected)} files verified, {n_dirs} folders moved with a single rename.")
+    return True
+
+def cleanUpIntermediate(project_dir, nth=30, targets=None):
     """ Helper function to organize GFAM outputs and delete extraneous files. Creates an images folder and a telemetry folder.
 
+    Runs finalizeVideo() on every video directory of the project that has not been finalized yet, i.e. every directory
+    with a telem folder, so gfam_outputs, gfam_reports and other folders are left alone.
+
     :param project_dir: Filepath to the project directory.
     :type project_dir: str
     :param nth: The amount of frames extracted during processing, used to identify subsample directory. Defaults to 30.
     :type nth: int.
+    :param targets: SfM targets of a multi-target run, each gets its own gfam_outputs/<target>/images folder. Defaults to None.
+    :type targets: list of str
 
     """
     output_dir = os.path.join(project_dir, 'gfam_outputs')
-    os.mkdir(output_dir)
-    output_images = os.path.join(output_dir, 'images')
-    os.mkdir(output_images)
-    output_telemetry = os.path.join(output_dir, 'telemetry')
-    os.mkdir(output_telemetry)
-    
-    n_img = 0
-    n_img_copies = 0
+    os.makedirs(output_dir, exist_ok=True)
 
-    n_telem = 0
-    n_telem_copies = 0
-
-    for i in os.listdir(project_dir):
-        if i == 'gfam_outputs':
-            continue
-        if os.path.isdir(os.path.join(project_dir, i)):
-            current_dir = os.path.join(project_dir, i)
-            subsample_dir = os.path.join(current_dir, 'subsample_' + str(nth) + '_frames')
-            telem_dir = os.path.join(current_dir, 'telem')
-            n_img += len(os.listdir(subsample_dir))
-            n_telem += len(os.listdir(telem_dir))
-            video_name = i
-            for j in os.listdir(subsample_dir):
-                src_img = os.path.join(subsample_dir, j)
-                dest_img = os.path.join(output_images, j)
-                shutil.move(src_img, dest_img)
-                if not os.path.exists(dest_img):
-                    logging.error(f"Failed to copy {src_img}.")
-                else:
-                    n_img_copies +=1
-            if len(os.listdir(output_images)) != n_img:
-                if n_img != n_img_copies:
-                    logging.error("Not all images were copied correctly during cleanup.")
-                else:
-                    logging.warning("Size of directory is not the same before and after cleanup.")
-            
-            for j in os.listdir(telem_dir):
-                src_telem = os.path.join(telem_dir, j)
-                dst_telem = os.path.join(output_telemetry, video_name + '_' + j)
-                shutil.move(src_telem, dst_telem)
-                if not os.path.exists(dst_telem):
-                    logging.error(f"Failed to copy {src_telem}.")
-                else:
-                    n_telem_copies += 1
-            if len(os.listdir(output_telemetry)) != n_telem:
-                if n_telem != n_telem_copies:
-                    logging.error("Not all telemetry were copied correctly during cleanup.")
-                else:
-                    logging.warning("Size of directory is not the same before and after cleanup.")
-            shutil.rmtree(current_dir, ignore_errors=True)
\ No newline at end of file
+    for i in sorted(os.listdir(project_dir)):
+        if os.path.isdir(os.path.join(project_dir, i, 'telem')):
+            finalizeVideo(os.path.join(project_dir, i), output_dir, nth=nth, targets=targets)
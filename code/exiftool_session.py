@@ -0,0 +1,96 @@
+import logging
+import subprocess
+import threading
+
+from code.process_runner import processStage, startProcess, waitProcess
+
+_state = {'enabled': False, 'session': None}
+
+def setExifToolSession(enabled=True):
+    """ Turns the persistent exiftool session on or off. While it is on, writeEXIFTags() sends its commands to a single
+    exiftool -stay_open process instead of starting exiftool for every frame.
+
+    :param enabled: Defaults to True.
+    :type enabled: bool
+    """
+
+    _state['enabled'] = enabled == True
+    if not _state['enabled']:
+        closeExifTool()
+
+def exifToolSession(config_file=None):
+    """ Returns the running session, starting it when needed. exiftool only reads -config at start up, so a session
+    without the requested config file is restarted with it.
+
+    :param config_file: Filepath to the config file the session must have loaded. Defaults to None (any session).
+    :type config_file: str
+
+    :return: the session, None while the session is off
+    :rtype: dict
+    """
+
+    if not _state['enabled']:
+        return None
+    session = _state['session']
+    if session is not None and session['process'].poll() is None:
+        if config_file is None or session['config_file'] == config_file:
+            return session
+    closeExifTool()
+    command = ['exiftool']
+    if config_file:
+        command.extend(['-config', config_file])
+    command.extend(['-stay_open', 'True', '-@', '-'])
+    # outside of any stage, the session outlives the stage that started it and must not get its timeout
+    with processStage(None):
+        process = startProcess(command, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
+    _state['session'] = {'process': process, 'config_file': config_file, 'lock': threading.Lock(), 'commands': 0}
+    logging.debug(f"Started an exiftool session (pid {process.pid}).")
+    return _state['session']
+
+def runExifTool(session, args):
+    """ Runs one exiftool command in a session.
+
+    :param session: Output of exifToolSession()
+    :type session: dict
+    :param args: Arguments of the command, without 'exiftool', one per list item.
+    :type args: list of str
+
+    :return: what exiftool printed on stdout for the command
+    :rtype: str
+    """
+
+    process = session['process']
+    lines = []
+    with session['lock']:
+        # the -@ - argument file takes one argument per line
+        process.stdin.write(('\n'.join(args) + '\n-execute\n').encode('utf-8'))
+        process.stdin.flush()
+        for line in process.stdout:
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            if line == '{ready}':
+                break
+            lines.append(line)
+        else:
+            raise RuntimeError(f"exiftool session exited with status {process.poll()}.")
+        session['commands'] += 1
+    return '\n'.join(lines)
+
+def closeExifTool():
+    """ Stops the running session, if any. """
+
+    session = _state['session']
+    if session is None:
+        return
+    _state['session'] = None
+    process = session['process']
+    with session['lock']:
+        try:
+            process.stdin.write(b'-stay_open\nFalse\n')
+            process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+        process.stdout.read()
+        process.stdout.close()
+        with processStage(None):
+            waitProcess(process)
+    logging.debug(f"Closed the exiftool session after {session['commands']} commands.")
@@ -0,0 +1,97 @@
+import errno
+import logging
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# ioctl request number for FICLONE on Linux (btrfs, xfs, bcachefs, ...)
+FICLONE = 0x40049409
+LINK_MODES = ('copy', 'hardlink', 'reflink', 'symlink', 'auto')
+
+def reflinkFile(src, dst):
+    """ Creates a copy-on-write clone of a file. Only supported on Linux filesystems with reflink support.
+
+    :param src: Filepath to the source file.
+    :type src: str
+    :param dst: Filepath to the clone.
+    :type dst: str
+    """
+
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform.')
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+def linkOrCopy(src, dst, mode='auto'):
+    """ Places a file at a new location using the cheapest method the filesystem allows, falling back to a copy.
+
+    'auto' tries a reflink, then a hardlink, then copies. Reflinks are preferred because the clone is independent of
+    the source, while a hardlink shares the same inode: tools that write in place (e.g. exiftool
+    -overwrite_original_in_place) edit both, tools that write a new file and rename it over the link (e.g. exiftool
+    -overwrite_original) break the link and leave the other copy untouched.
+
+    :param src: Filepath to the source file.
+    :type src: str
+    :param dst: Filepath to the destination.
+    :type dst: str
+    :param mode: One of 'copy', 'hardlink', 'reflink', 'symlink' or 'auto'. Defaults to 'auto'.
+    :type mode: str
+
+    :return: The method that was actually used.
+    :rtype: str
+    """
+
+    if mode not in LINK_MODES:
+        raise ValueError(f"Unknown link mode {mode}, expected one of {LINK_MODES}.")
+    if mode == 'auto':
+        attempts = ['reflink', 'hardlink']
+    elif mode == 'copy':
+        attempts = []
+    else:
+        attempts = [mode]
+
+    for method in attempts:
+        try:
+            if method == 'reflink':
+                reflinkFile(src, dst)
+            elif method == 'hardlink':
+                os.link(src, dst)
+            elif method == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+            return method
+        except OSError as e:
+            logging.debug(f"Could not {method} {src} to {dst}: {e}")
+    shutil.copy2(src, dst)
+    return 'copy'
+
+def renameOrMove(src, dst):
+    """ Moves a file or directory with a single rename, falling back to shutil.move() across filesystems.
+
+    :param src: Filepath to the source.
+    :type src: str
+    :param dst: Filepath to the destination, must not exist (an empty directory is replaced on POSIX).
+    :type dst: str
+
+    :return: 'rename' or 'move'
+    :rtype: str
+    """
+
+    try:
+        os.rename(src, dst)
+        return 'rename'
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    logging.debug(f"{src} and {dst} are on different filesystems, copying.")
+    shutil.move(src, dst)
+    return 'move'
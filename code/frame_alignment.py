@@ -0,0 +1,133 @@
+import logging
+import os
+import numpy as np
+import pandas as pd
+
+from code.frame_manifest import selectedFrames
+
+FRAME_TABLE = 'frames.csv'
+
+def findClosestIndices(cts, sample_cts):
+    """ Vectorized version of findClosestCTS(), matches every CTS to its nearest sample at once.
+
+    :param cts: The camera times (ms) to match.
+    :type cts: numpy.ndarray
+    :param sample_cts: Sorted CTS of the telemetry samples.
+    :type sample_cts: numpy.ndarray
+
+    :return: the index of the nearest sample for each CTS
+    :rtype: numpy.ndarray
+    """
+
+    cts = np.asarray(cts, dtype=float)
+    sample_cts = np.asarray(sample_cts, dtype=float)
+    pos = np.clip(np.searchsorted(sample_cts, cts, side='left'), 1, len(sample_cts) - 1)
+    before = sample_cts[pos - 1]
+    after = sample_cts[pos]
+    pos[cts - before <= after - cts] -= 1
+    return np.clip(pos, 0, len(sample_cts) - 1)
+
+def alignStream(frame_cts, stream_csv, columns):
+    """ Looks up the nearest sample of a cleaned telemetry stream for every frame.
+
+    :param frame_cts: CTS (ms) of every frame.
+    :type frame_cts: numpy.ndarray
+    :param stream_csv: Filepath to a cleaned telemetry stream.
+    :type stream_csv: str
+    :param columns: The columns to look up.
+    :type columns: list of str
+
+    :return: one array per column, aligned with frame_cts
+    :rtype: dict
+    """
+
+    stream_df = pd.read_csv(stream_csv).sort_values('cts')
+    closest = findClosestIndices(frame_cts, stream_df['cts'].to_numpy())
+    return {column: stream_df[column].to_numpy()[closest] for column in columns if column in stream_df}
+
+def listFrames(input_dir, file_ending='.jpg'):
+    """ Lists the frames of a directory with the frame number parsed from their filename.
+
+    :param input_dir: Filepath to the directory of frames.
+    :type input_dir: str
+    :param file_ending: Target ending for the frames. Defaults to '.jpg'.
+    :type file_ending: str
+
+    :return: frame filenames and frame numbers
+    :rtype: list of str, numpy.ndarray
+    """
+
+    frames = []
+    for i in sorted(os.listdir(input_dir)):
+        if not i.endswith(file_ending):
+            logging.debug(f"Skipping {i}.")
+            continue
+        frames.append(i)
+    frame_index = np.array([int(i.split('_')[-1][:-len(file_ending)]) for i in frames], dtype=np.int64)
+    return frames, frame_index
+
+def buildFrameTable(input_dir, gps_csv=None, gyro_csv=None, grav_csv=None, fps=30, file_ending='.jpg', frame_pts=None, manifest=None):
+    """ Aligns every frame with its nearest telemetry samples once, so every output writer can share the result.
+
+    The table has frame, frame_index and cts columns, then lat, lon, elev, dop and gps_ok (GPS), p4d_pitch, p4d_roll and
+    p4d_yaw in degrees (GYRO) and grav_x, grav_y and grav_z (GRAV) for the streams that were supplied.
+
+    :param input_dir: Filepath to the directory of labelled frames.
+    :type input_dir: str
+    :param gps_csv: Filepath to the GPS data, must be cleaned with cleanGPS(). Defaults to None.
+    :type gps_csv: str
+    :param gyro_csv: Filepath to the GYRO data, must be cleaned with cleanGYRO(). Defaults to None.
+    :type gyro_csv: str
+    :param grav_csv: Filepath to the GRAV data, must be cleaned with cleanGRAV(). Defaults to None.
+    :type grav_csv: str
+    :param fps: FPS of the original video, only used without frame_pts. Defaults to 30.
+    :type fps: float
+    :param file_ending: Target ending for the frames. Defaults to '.jpg'.
+    :type file_ending: str
+    :param frame_pts: Exact PTS (ms) of every source frame from extractFramePTS(). Defaults to None.
+    :type frame_pts: numpy.ndarray
+    :param manifest: Frame manifest of the video. When given, its selected frames and their PTS are used and input_dir is
+        never listed. Defaults to None.
+    :type manifest: pandas df
+
+    :return: one row per frame
+    :rtype: pandas df
+    """
+
+    if manifest is not None:
+        selected = selectedFrames(manifest)
+        frames = list(selected['path'])
+        frame_index = selected['index'].to_numpy(np.int64) + 1
+        frame_cts = selected['pts'].to_numpy(float)
+    else:
+        frames, frame_index = listFrames(input_dir, file_ending=file_ending)
+        frames = [os.path.join(input_dir, i) for i in frames]
+        if frame_pts is not None:
+            # frames are numbered from 1
+            frame_cts = np.asarray(frame_pts, dtype=float)[frame_index - 1]
+        else:
+            frame_cts = frame_index / fps * 1000
+    table = pd.DataFrame({
+        'frame': frames,
+        'frame_index': frame_index,
+        'cts': frame_cts
+    })
+
+    if gps_csv is not None:
+        gps = alignStream(frame_cts, gps_csv, ['lat', 'lon', 'elev', 'dop', 'gps_ok'])
+        for column in ['lat', 'lon', 'elev', 'dop']:
+            if column in gps:
+                table[column] = gps[column]
+        table['gps_ok'] = gps['gps_ok'].astype(bool) if 'gps_ok' in gps else True
+    if gyro_csv is not None:
+        gyro = alignStream(frame_cts, gyro_csv, ['rX', 'rY', 'rZ'])
+        table['p4d_pitch'] = (gyro['rX'].astype(float)/np.pi*180)+90
+        table['p4d_roll'] = gyro['rY'].astype(float)/np.pi*180
+        table['p4d_yaw'] = gyro['rZ'].astype(float)/np.pi*180
+    if grav_csv is not None:
+        grav = alignStream(frame_cts, grav_csv, ['x', 'y', 'z'])
+        table['grav_x'] = pd.to_numeric(grav['x'], errors='coerce')
+        table['grav_y'] = pd.to_numeric(grav['y'], errors='coerce')
+        table['grav_z'] = pd.to_numeric(grav['z'], errors='coerce')
+    logging.debug(f"Aligned {len(table)} frames with telemetry.")
+    return table
@@ -0,0 +1,356 @@
+import io
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from code.process_runner import runProcess
+
+HASH_WIDTH = 9
+HASH_HEIGHT = 8
+EARTH_RADIUS = 6371000.0
+HASH_CACHE = 'dhash_cache.csv'
+
+def _hashChunk(img_paths):
+    """ Decodes a chunk of images with a single ffmpeg call and returns their difference hashes.
+
+    :param img_paths: Filepaths to the images.
+    :type img_paths: list of str
+
+    :return: one 64 bit hash per image
+    :rtype: numpy.ndarray
+    """
+
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as concat_file:
+        concat_file.write('ffconcat version 1.0\n')
+        for img in img_paths:
+            escaped = os.path.abspath(img).replace("'", "'\\''")
+            concat_file.write(f"file '{escaped}'\n")
+    try:
+        hash_call = [
+            'ffmpeg', '-loglevel', 'error',
+            '-f', 'concat', '-safe', '0', '-i', concat_file.name,
+            '-vf', f"scale={HASH_WIDTH}:{HASH_HEIGHT}:flags=area,format=gray",
+            '-vsync', 'passthrough',
+            '-f', 'rawvideo', '-'
+        ]
+        pixels = runProcess(hash_call, capture=True, check=True).stdout
+    finally:
+        os.remove(concat_file.name)
+
+    pixels = np.frombuffer(pixels, dtype=np.uint8)
+    if pixels.size != len(img_paths) * HASH_WIDTH * HASH_HEIGHT:
+        raise RuntimeError(f"ffmpeg returned {pixels.size} pixels for {len(img_paths)} images.")
+    pixels = pixels.reshape(len(img_paths), HASH_HEIGHT, HASH_WIDTH)
+    bits = pixels[:, :, 1:] > pixels[:, :, :-1]
+    return np.packbits(bits.reshape(len(img_paths), -1), axis=1).view('>u8').ravel()
+
+def computeDHashes(img_paths, chunk_size=256, workers=None):
+    """ Computes a 64 bit difference hash (dHash) of the downscaled luminance of every image.
+
+    Images are decoded in chunks by ffmpeg, so each worker only pays the process start-up once per chunk.
+
+    :param img_paths: Filepaths to the images.
+    :type img_paths: list of str
+    :param chunk_size: Number of images decoded per ffmpeg call. Defaults to 256.
+    :type chunk_size: int
+    :param workers: Number of parallel ffmpeg calls. Defaults to None (ThreadPoolExecutor default).
+    :type workers: int
+
+    :return: one hash per image
+    :rtype: numpy.ndarray
+    """
+
+    chunks = [img_paths[i:i+chunk_size] for i in range(0, len(img_paths), chunk_size)]
+    if not chunks:
+        return np.zeros(0, dtype=np.uint64)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        hashes = list(pool.map(_hashChunk, chunks))
+    logging.debug(f"Hashed {len(img_paths)} images.")
+    return np.concatenate(hashes).astype(np.uint64)
+
+def hammingDistance(a, b):
+    """ Counts the differing bits between two arrays of 64 bit hashes.
+
+    :param a: Hashes
+    :type a: numpy.ndarray
+    :param b: Hashes
+    :type b: numpy.ndarray
+
+    :return: Hamming distances
+    :rtype: numpy.ndarray
+    """
+
+    xor = np.bitwise_xor(a.astype(np.uint64), b.astype(np.uint64))
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(xor).astype(np.int64)
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1).astype(np.int64)
+
+def readImageGPS(img_dir, file_ending='.jpg', img_paths=None):
+    """ Reads the GPS tags of every image in a directory (and its shard subdirectories) with a single exiftool call.
+
+    :param img_dir: Filepath to the image directory.
+    :type img_dir: str
+    :param file_ending: Target ending for the frames. Defaults to '.jpg'.
+    :type file_ending: str
+    :param img_paths: Only reads these images, passed to exiftool in an argument file. Defaults to None (the whole
+        directory).
+    :type img_paths: list of str
+
+    :return: SourceFile, GPSLatitude and GPSLongitude (signed decimal degrees) for each image
+    :rtype: pandas.DataFrame
+    """
+
+    gps_call = ['exiftool', '-csv', '-n', '-GPSLatitude', '-GPSLongitude', '-ext', file_ending.lstrip('.')]
+    arg_file = None
+    if img_paths is None:
+        gps_call.extend(['-r', img_dir])
+    elif not img_paths:
+        return pd.DataFrame(columns=['SourceFile', 'GPSLatitude', 'GPSLongitude'])
+    else:
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as arg_file:
+            arg_file.write('\n'.join(img_paths) + '\n')
+        gps_call.extend(['-@', arg_file.name])
+    try:
+        output = runProcess(gps_call, capture=True).stdout.decode('utf-8')
+    finally:
+        if arg_file is not None:
+            os.remove(arg_file.name)
+    if not output.strip():
+        return pd.DataFrame(columns=['SourceFile', 'GPSLatitude', 'GPSLongitude'])
+    gps_df = pd.read_csv(io.StringIO(output))
+    for column in ['GPSLatitude', 'GPSLongitude']:
+        if column not in gps_df:
+            gps_df[column] = np.nan
+    gps_df['SourceFile'] = [os.path.normpath(i) for i in gps_df['SourceFile']]
+    return gps_df[['SourceFile', 'GPSLatitude', 'GPSLongitude']]
+
+def readCachedImageGPS(img_dir, cache_csv, file_ending='.jpg'):
+    """ Reads the GPS tags of the images of a directory like readImageGPS(), along with their difference hashes, from a
+    cache written by writeHashCache(). Only the images that are new or changed since (by size and modification time)
+    are read with exiftool, their hash is left empty.
+
+    :param img_dir: Filepath to the image directory.
+    :type img_dir: str
+    :param cache_csv: Filepath to the cache, e.g. dhash_cache.csv next to img_dir.
+    :type cache_csv: str
+    :param file_ending: Target ending for the frames. Defaults to '.jpg'.
+    :type file_ending: str
+
+    :return: SourceFile, GPSLatitude, GPSLongitude, size, mtime_ns and dhash (hex, NaN if unknown) for each image
+    :rtype: pandas.DataFrame
+    """
+
+    img_paths = []
+    for root, _, files in os.walk(img_dir):
+        img_paths.extend(os.path.normpath(os.path.join(root, i)) for i in files if i.lower().endswith(file_ending.lower()))
+    stats = [os.stat(i) for i in img_paths]
+    images = pd.DataFrame({
+        'SourceFile': img_paths,
+        'size': [i.st_size for i in stats],
+        'mtime_ns': [i.st_mtime_ns for i in stats]
+    })
+    if os.path.exists(cache_csv):
+        cache = pd.read_csv(cache_csv, dtype={'SourceFile': str, 'dhash': str})
+    else:
+        cache = pd.DataFrame(columns=['SourceFile', 'size', 'mtime_ns', 'GPSLatitude', 'GPSLongitude', 'dhash'])
+    images = images.merge(cache.astype({'size': np.int64, 'mtime_ns': np.int64}), on=['SourceFile', 'size', 'mtime_ns'],
+                          how='left', indicator=True)
+    new = images['_merge'] != 'both'
+    images = images.drop(columns='_merge')
+    logging.info(f"{int(new.sum())} of {len(images)} images are not in the hash cache.")
+    if new.any():
+        gps_df = readImageGPS(img_dir, file_ending=file_ending, img_paths=list(images.loc[new, 'SourceFile']))
+        gps_df = gps_df.set_index('SourceFile')
+        for column in ['GPSLatitude', 'GPSLongitude']:
+            images.loc[new, column] = images.loc[new, 'SourceFile'].map(gps_df[column]).to_numpy(float)
+        images.loc[new, 'dhash'] = np.nan
+    return images
+
+def writeHashCache(images, cache_csv):
+    """ Saves the GPS tags and difference hashes read by readCachedImageGPS().
+
+    :param images: Output of readCachedImageGPS(), with the hashes filled in.
+    :type images: pandas.DataFrame
+    :param cache_csv: Filepath to the cache.
+    :type cache_csv: str
+    """
+
+    tmp_csv = cache_csv + '.tmp'
+    images[['SourceFile', 'size', 'mtime_ns', 'GPSLatitude', 'GPSLongitude', 'dhash']].to_csv(tmp_csv, index=False)
+    os.replace(tmp_csv, cache_csv)
+
+def findCandidatePairs(lat, lon, radius):
+    """ Finds all pairs of points within radius metres of each other by binning them into a grid of radius sized cells.
+
+    Only points in the same or neighbouring cells are compared, so the cost scales with local density rather than n^2.
+
+    :param lat: Latitudes in decimal degrees.
+    :type lat: numpy.ndarray
+    :param lon: Longitudes in decimal degrees.
+    :type lon: numpy.ndarray
+    :param radius: Maximum distance between candidates (m).
+    :type radius: float
+
+    :return: index pairs (i < j) and their distances
+    :rtype: numpy.ndarray, numpy.ndarray, numpy.ndarray
+    """
+
+    if len(lat) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0)
+    lat0 = np.radians(np.nanmean(lat))
+    x = np.radians(lon) * np.cos(lat0) * EARTH_RADIUS
+    y = np.radians(lat) * EARTH_RADIUS
+    cell_x = np.floor(x / radius).astype(np.int64)
+    cell_y = np.floor(y / radius).astype(np.int64)
+
+    cells = {}
+    for k, key in enumerate(zip(cell_x, cell_y)):
+        cells.setdefault(key, []).append(k)
+    cells = {key: np.array(idx) for key, idx in cells.items()}
+
+    pairs_i = []
+    pairs_j = []
+    for (cx, cy), idx in cells.items():
+        # only look forward so each pair of cells is visited once
+        for dx, dy in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+            other = cells.get((cx + dx, cy + dy))
+            if other is None:
+                continue
+            if dx == 0 and dy == 0:
+                a, b = np.triu_indices(len(idx), 1)
+                ii, jj = idx[a], idx[b]
+            else:
+                ii = np.repeat(idx, len(other))
+                jj = np.tile(other, len(idx))
+            pairs_i.append(ii)
+            pairs_j.append(jj)
+    ii = np.concatenate(pairs_i)
+    jj = np.concatenate(pairs_j)
+    distance = np.hypot(x[ii] - x[jj], y[ii] - y[jj])
+    close = distance <= radius
+    ii, jj, distance = ii[close], jj[close], distance[close]
+    swap = ii > jj
+    ii[swap], jj[swap] = jj[swap], ii[swap]
+    return ii, jj, distance
+
+def findNearDuplicates(img_dir, max_hamming=4, radius=5.0, file_ending='.jpg', workers=None, cache_csv=None):
+    """ Finds pairs of near-identical images that were taken close to each other.
+
+    :param img_dir: Filepath to the image directory, e.g. gfam_outputs/images
+    :type img_dir: str
+    :param max_hamming: Maximum number of differing dHash bits for a pair to count as duplicates. Defaults to 4.
+    :type max_hamming: int
+    :param radius: Only images within this distance (m) of each other are compared. Defaults to 5.
+    :type radius: float
+    :param file_ending: Target ending for the frames. Defaults to '.jpg'.
+    :type file_ending: str
+    :param workers: Number of parallel ffmpeg calls used for hashing. Defaults to None.
+    :type workers: int
+    :param cache_csv: Keeps the GPS tags and hashes of the images in this file, so that only new images are read and
+        hashed on the next call, see readCachedImageGPS(). Defaults to None (no cache).
+    :type cache_csv: str
+
+    :return: image_a, image_b, distance and hamming for each duplicate pair, image_a sorting before image_b
+    :rtype: pandas.DataFrame
+    """
+
+    if cache_csv is not None:
+        images = readCachedImageGPS(img_dir, cache_csv, file_ending=file_ending)
+    else:
+        images = readImageGPS(img_dir, file_ending=file_ending)
+        images['dhash'] = np.nan
+    n_missing = int(images['GPSLatitude'].isna().sum())
+    if n_missing > 0:
+        logging.warning(f"{n_missing} images have no GPS tags and will not be deduplicated.")
+    gps_df = images.dropna(subset=['GPSLatitude', 'GPSLongitude']).sort_values('SourceFile')
+    img_paths = list(gps_df['SourceFile'])
+
+    ii, jj, distance = findCandidatePairs(gps_df['GPSLatitude'].to_numpy(float), gps_df['GPSLongitude'].to_numpy(float), radius)
+    logging.info(f"{len(ii)} candidate pairs among {len(img_paths)} images.")
+    # only hash images that have at least one spatial neighbour
+    candidates = np.unique(np.concatenate([ii, jj]))
+    cached = gps_df['dhash'].to_numpy(object)
+    hashed = np.array([isinstance(cached[k], str) for k in candidates], dtype=bool)
+    hashes = np.zeros(len(img_paths), dtype=np.uint64)
+    hashes[candidates[hashed]] = [int(cached[k], 16) for k in candidates[hashed]]
+    hashes[candidates[~hashed]] = computeDHashes([img_paths[k] for k in candidates[~hashed]], workers=workers)
+    if cache_csv is not None:
+        rows = gps_df.index[candidates[~hashed]]
+        images.loc[rows, 'dhash'] = [f"{h:016x}" for h in hashes[candidates[~hashed]]]
+        writeHashCache(images, cache_csv)
+
+    hamming = hammingDistance(hashes[ii], hashes[jj])
+    duplicate = hamming <= max_hamming
+    return pd.DataFrame({
+        'image_a': [img_paths[k] for k in ii[duplicate]],
+        'image_b': [img_paths[k] for k in jj[duplicate]],
+        'distance': distance[duplicate],
+        'hamming': hamming[duplicate]
+    }).sort_values(['image_a', 'image_b']).reset_index(drop=True)
+
+def removeNearDuplicates(img_dir, max_hamming=4, radius=5.0, action='report', report_csv=None, duplicate_dir=None,
+                         file_ending='.jpg', workers=None, cache_csv=None):
+    """ Reports or drops near-duplicate frames, e.g. from overlapping passes merged by cleanUpIntermediate().
+
+    Pairs are resolved greedily in filename order: the first image of a pair is kept and the second dropped, unless
+    the first was already dropped. Dropped images (and their .xmp sidecars) are moved to duplicate_dir, not deleted.
+
+    :param img_dir: Filepath to the image directory, e.g. gfam_outputs/images
+    :type img_dir: str
+    :param max_hamming: Maximum number of differing dHash bits for a pair to count as duplicates. Defaults to 4.
+    :type max_hamming: int
+    :param radius: Only images within this distance (m) of each other are compared. Defaults to 5.
+    :type radius: float
+    :param action: 'report' only writes the report, 'drop' also moves the duplicates. Defaults to 'report'.
+    :type action: str
+    :param report_csv: Filepath to the duplicate report. Defaults to duplicates.csv next to img_dir.
+    :type report_csv: str
+    :param duplicate_dir: Where dropped images are moved. Defaults to duplicates next to img_dir.
+    :type duplicate_dir: str
+    :param file_ending: Target ending for the frames. Defaults to '.jpg'.
+    :type file_ending: str
+    :param workers: Number of parallel ffmpeg calls used for hashing. Defaults to None.
+    :type workers: int
+    :param cache_csv: Cache of the GPS tags and hashes, see findNearDuplicates(). Defaults to None (no cache).
+    :type cache_csv: str
+
+    :return: Filepaths of the images that were (or would be) dropped
+    :rtype: list of str
+    """
+
+    if action not in ('report', 'drop'):
+        raise ValueError(f"Unknown dedup action {action}, expected 'report' or 'drop'.")
+    parent_dir = os.path.dirname(os.path.normpath(img_dir))
+    if report_csv is None:
+        report_csv = os.path.join(parent_dir, 'duplicates.csv')
+    if duplicate_dir is None:
+        duplicate_dir = os.path.join(parent_dir, 'duplicates')
+
+    pairs = findNearDuplicates(img_dir, max_hamming=max_hamming, radius=radius, file_ending=file_ending, workers=workers,
+                               cache_csv=cache_csv)
+    dropped = set()
+    drop_flags = []
+    for image_a, image_b in zip(pairs['image_a'], pairs['image_b']):
+        drop = image_a not in dropped and image_b not in dropped
+        if drop:
+            dropped.add(image_b)
+        drop_flags.append(drop)
+    pairs['dropped'] = drop_flags
+    pairs.to_csv(report_csv, index=False)
+    logging.info(f"Found {len(pairs)} near-duplicate pairs, {len(dropped)} images flagged. Report saved to {report_csv}")
+
+    if action == 'drop' and dropped:
+        os.makedirs(duplicate_dir, exist_ok=True)
+        for img in sorted(dropped):
+            shutil.move(img, os.path.join(duplicate_dir, os.path.basename(img)))
+            sidecar = os.path.splitext(img)[0] + '.xmp'
+            if os.path.exists(sidecar):
+                shutil.move(sidecar, os.path.join(duplicate_dir, os.path.basename(sidecar)))
+        logging.info(f"Moved {len(dropped)} near-duplicate images to {duplicate_dir}")
+    return sorted(dropped)
@@ -1,21 +1,34 @@
-import logging, os, shutil, subprocess
+import logging, os, shutil
+import numpy as np
 
-def timeStampFrames(input_video, frame_dir, output_dir):
+from code.frame_manifest import buildFrameManifest, frameName, setFramePaths, shardName
+from code.frame_selection import buildSelectExpression, selectedFrameIndices
+from code.process_runner import runProcess
+from code.progress_events import hasSubscribers, parseFFmpegProgress
+
+# chunks are sized for frames this much larger than the largest one seen so far
+CHUNK_MARGIN = 1.5
+
+def timeStampFrames(input_video, frame_dir, output_dir, prefix='frame_'):
     """ Tags frames with their CTS timestamp (used for telemetry matching).
-    
+
     :param input_video: Filepath to the target video.
     :type input_video: str
     :param frame_dir: Filepath to the directory where frames are stored.
     :type frame_dir: str
     :param output_dir: Filepath to the directory where the timestamped frames will be stored.
     :type output_dir: str
+    :param prefix: Prefix used by extractAllFrames(). Defaults to 'frame_'.
+    :type prefix: str
     """
 
     fps = extractFPS(input_video)
+    manifest = buildFrameManifest(extractFramePTS(input_video), 1)
+    setFramePaths(manifest, manifest.index, frame_dir, [frameName(i, prefix=prefix) for i in manifest['index']])
 
-    labelFramesWithCTS(frame_dir, output_dir, fps=fps)
+    labelFramesWithCTS(frame_dir, output_dir, fps=fps, manifest=manifest)
 
-def labelFramesWithCTS(input_dir, output_dir, fps=30, file_ending='.jpg'):
+def labelFramesWithCTS(input_dir, output_dir, fps=30, file_ending='.jpg', manifest=None, sig_fig=7):
     """ Labels a directory of frames with their approximate camera time.
 
     :param input_dir: Filepath to the directory of frames.
@@ -26,8 +39,19 @@ def labelFramesWithCTS(input_dir, output_dir, fps=30, file_ending='.jpg'):
     :type fps: int
     :param file_ending: Target ending for the frames. Defaults to '.jpg'
     :type file_ending: str
+    :param manifest: Frame manifest from buildFrameManifest(). When given, the frames it lists are labelled with their exact PTS instead. Defaults to None.
+    :type manifest: pandas df
+    :param sig_fig: Length of the frame IDs, only used with a manifest. Defaults to 7.
+    :type sig_fig: int
     """
 
+    if manifest is not None:
+        written = manifest[manifest['path'] != '']
+        for index, path, cts in zip(written['index'], written['path'], written['pts']):
+            new_file = output_dir + '/frame_' + str(index + 1).zfill(sig_fig) + '_cts_' + str(int(round(cts))) + file_ending
+            shutil.copy(path, new_file)
+        return
+
     cts_per_frame = 1/(fps/1000)
     logging.debug('CTS per frame: %s', cts_per_frame)
     counter = 0
@@ -59,7 +83,7 @@ def extractFPS(input_video):
     """
 
     command = ['ffprobe', '-v', '0', '-of', 'csv=p=0' ,'-select_streams', 'v:0', '-show_entries', 'stream=r_frame_rate', input_video]
-    info = subprocess.check_output(command).decode("utf-8")
+    info = runProcess(command, capture=True, check=True).stdout.decode("utf-8")
     info = info.strip()
     info = info.split('/')
     fps = int(info[0])/int(info[1])
@@ -67,9 +91,107 @@ def extractFPS(input_video):
 
     return fps
 
-def extractAllFrames(input_video, output_dir, prefix='frame_', sig_fig=7, file_ending='.jpg'):
+def extractFramePTS(input_video):
+    """ Wrapper for ffprobe to get the exact presentation timestamp of every frame in one pass.
+
+    Only the packet headers are read, nothing is decoded. Packets come in decode order, so the timestamps are sorted to
+    get them in presentation order, i.e. the order ffmpeg emits frames in.
+
+    :param input_video: Filepath to the target video
+    :type input_video: str
+
+    :return: the PTS (ms, relative to the first frame) of each frame, indexed by frame number - 1
+    :rtype: numpy.ndarray
+    """
+
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time', '-of', 'csv=p=0', input_video]
+    info = runProcess(command, capture=True, check=True).stdout.decode("utf-8")
+    pts = np.sort(np.array([float(i) for i in info.split() if i.strip(',') not in ('', 'N/A')]))
+    if len(pts) == 0:
+        raise RuntimeError(f"ffprobe found no frame timestamps in {input_video}.")
+    pts = (pts - pts[0]) * 1000
+    logging.debug(f"Read the PTS of {len(pts)} frames.")
+
+    return pts
+
+def runExtraction(frame_extraction_call, total=None, offset=0):
+    """ Runs an ffmpeg extraction, publishing its frame count as progress events while anything subscribed to them.
+
+    :param frame_extraction_call: The ffmpeg command.
+    :type frame_extraction_call: list of str
+    :param total: Frames the stage will extract. Defaults to None (unknown).
+    :type total: int
+    :param offset: Frames extracted by earlier calls of the same stage. Defaults to 0.
+    :type offset: int
+    """
+
+    if not hasSubscribers():
+        runProcess(frame_extraction_call)
+        return
+    frame_extraction_call = frame_extraction_call[:1] + ['-progress', 'pipe:1', '-nostats'] + frame_extraction_call[1:]
+    runProcess(frame_extraction_call, on_output=parseFFmpegProgress(total=total, offset=offset))
+
+def extractFrameRange(input_video, output_dir, frame_pts, first, count, prefix='frame_', sig_fig=7, file_ending='.jpg'):
+    """ Extracts a range of consecutive frames using ffmpeg, named by their frame number in the whole video.
+
+    :param input_video: Filepath to the target video.
+    :type input_video: str
+    :param output_dir: Filepath to the directory where the frames will be stored.
+    :type output_dir: str
+    :param frame_pts: Output of extractFramePTS(), used to seek to the first frame.
+    :type frame_pts: numpy.ndarray
+    :param first: Source index of the first frame, starting at 0.
+    :type first: int
+    :param count: Number of frames to extract.
+    :type count: int
+    :param prefix: Prefix for the extracted frames. Defaults to 'frame_'.
+    :type prefix: str
+    :param sig_fig: Controls the length of the frame IDs. Defaults to 7 (i.e. 0000001-9999999)
+    :type sig_fig: int
+    :param file_ending: Sets the frame output format. Defaults to '.jpg'
+    :type file_ending: str
+    """
+
+    frame_extraction_call = ['ffmpeg']
+    if first > 0:
+        # seek halfway between two frames so rounding never lands on the wrong one
+        frame_extraction_call.extend(['-ss', f"{(frame_pts[first - 1] + frame_pts[first]) / 2000:.6f}"])
+    frame_extraction_call.extend([
+        '-i', input_video,
+        '-frames:v', str(count),
+        '-vsync', 'passthrough',
+        '-start_number', str(first + 1),
+        output_dir + '/' + prefix + '%' + str(sig_fig) + 'd' + file_ending, '-loglevel', 'error'
+    ])
+    runExtraction(frame_extraction_call, total=len(frame_pts), offset=first)
+
+def checkFrameCount(frame_dir, expected, file_ending='.jpg'):
+    """ Checks that ffmpeg wrote as many frames as the manifest expects, so no path is recorded for a frame that was
+    never written. Frames in shard subdirectories are counted too.
+
+    :param frame_dir: Filepath to the directory ffmpeg wrote to.
+    :type frame_dir: str
+    :param expected: Number of frames the manifest expects.
+    :type expected: int
+    :param file_ending: Frame output format. Defaults to '.jpg'
+    :type file_ending: str
+    """
+
+    written = 0
+    for entry in os.scandir(frame_dir):
+        if entry.is_dir():
+            written += sum(1 for i in os.scandir(entry.path) if i.name.endswith(file_ending))
+        elif entry.name.endswith(file_ending):
+            written += 1
+    if written != expected:
+        raise RuntimeError(f"ffmpeg wrote {written} frames to {frame_dir}, the frame manifest expects {expected}.")
+
+def extractAllFrames(input_video, output_dir, prefix='frame_', sig_fig=7, file_ending='.jpg', manifest=None, shard_size=None):
     """ Extracts all frames from a video using ffmpeg. 
 
+    In the sharded layout every shard_size frames go to their own subdirectory (see shardName()). Each shard is
+    extracted by its own ffmpeg call that seeks to the first frame of the shard using the manifest PTS.
+
     :param input_video: Filepath to the target video.
     :type input_video: str
     :param output_dir: Filepath to the directory where the tagged frames will be stored.
@@ -80,15 +202,92 @@ def extractAllFrames(input_video, output_dir, prefix='frame_', sig_fig=7, file_e
     :type sig_fig: int
     :param file_ending: Sets the frame output format. Defaults to '.jpg'
     :type file_ending: str
+    :param manifest: Frame manifest from buildFrameManifest(), the path of every frame is recorded in it. Defaults to None.
+    :type manifest: pandas df
+    :param shard_size: Maximum number of frames per subdirectory, requires the manifest. Defaults to None (flat).
+    :type shard_size: int
     """
 
     logging.debug("Frame extraction starts.")
-    output_frames = output_dir + '/' + prefix + '%' + str(sig_fig) + 'd' + file_ending
-    frame_extraction_call = ['ffmpeg', '-i', input_video,  output_frames, '-loglevel', 'error']
-    subprocess.call(frame_extraction_call)
+    if shard_size is not None:
+        if manifest is None:
+            raise ValueError("The sharded layout needs the frame manifest to seek to each shard.")
+        pts = manifest['pts'].to_numpy(float)
+        for first in range(0, len(pts), shard_size):
+            shard_dir = os.path.join(output_dir, shardName(first, shard_size))
+            os.mkdir(shard_dir)
+            extractFrameRange(input_video, shard_dir, pts, first, min(shard_size, len(pts) - first), prefix=prefix, sig_fig=sig_fig, file_ending=file_ending)
+    else:
+        output_frames = output_dir + '/' + prefix + '%' + str(sig_fig) + 'd' + file_ending
+        frame_extraction_call = ['ffmpeg', '-i', input_video, '-vsync', 'passthrough', output_frames, '-loglevel', 'error']
+        runExtraction(frame_extraction_call, total=len(manifest) if manifest is not None else None)
+    if manifest is not None:
+        checkFrameCount(output_dir, len(manifest), file_ending=file_ending)
+        names = [os.path.join(shardName(i, shard_size), frameName(i, prefix=prefix, sig_fig=sig_fig, file_ending=file_ending)) for i in manifest['index']]
+        setFramePaths(manifest, manifest.index, output_dir, names)
     logging.debug("Frame extraction finished.")
 
-def selectNthFrames(input_dir, output_dir, nth=15):
+def extractSelectedFrames(input_video, output_dir, nth, excluded=None, prefix='frame_', sig_fig=7, file_ending='.jpg', manifest=None, shard_size=None):
+    """ Extracts only the selected frames from a video using ffmpeg, so unselected frames are never encoded.
+
+    Frames are named as extractAllFrames() followed by selectNthFrames() would name them (source frame index + 1).
+
+    :param input_video: Filepath to the target video.
+    :type input_video: str
+    :param output_dir: Filepath to the directory where the selected frames will be stored.
+    :type output_dir: str
+    :param nth: Controls how many frames are selected.
+    :type nth: int
+    :param excluded: (first, last) frame index ranges to drop, e.g. from collapseStationaryFrames(). Defaults to None.
+    :type excluded: numpy.ndarray
+    :param prefix: Prefix for the extracted frames. Defaults to 'frame_'.
+    :type prefix: str
+    :param sig_fig: Controls the length of the frame IDs. Defaults to 7 (i.e. 0000001-9999999)
+    :type sig_fig: int
+    :param file_ending: Sets the frame output format. Defaults to '.jpg'
+    :type file_ending: str
+    :param manifest: Frame manifest built with the same nth and excluded, the path and size of the selected frames are
+        recorded in it and the output directory is never listed. Defaults to None.
+    :type manifest: pandas df
+    :param shard_size: Maximum number of frames per subdirectory, see shardName(). Defaults to None (flat).
+    :type shard_size: int
+    """
+
+    logging.debug("Selected frame extraction starts.")
+    tmp_dir = os.path.join(output_dir, '.extract')
+    os.mkdir(tmp_dir)
+    tmp_frames = tmp_dir + '/%' + str(sig_fig) + 'd' + file_ending
+    frame_extraction_call = [
+        'ffmpeg', '-i', input_video,
+        '-vf', buildSelectExpression(nth, excluded),
+        '-vsync', 'passthrough',
+        tmp_frames, '-loglevel', 'error'
+    ]
+    runExtraction(frame_extraction_call, total=int(manifest['selected'].sum()) if manifest is not None else None)
+
+    # ffmpeg numbers the outputs sequentially, rename them to their source frame numbers
+    if manifest is not None:
+        selected = manifest['selected'].to_numpy(bool)
+        indices = list(manifest.loc[selected, 'index'])
+        checkFrameCount(tmp_dir, len(indices), file_ending=file_ending)
+    else:
+        generator = selectedFrameIndices(nth, excluded)
+        indices = [next(generator) for _ in os.listdir(tmp_dir)]
+    names = []
+    shards = set()
+    for k, index in enumerate(indices):
+        shard = shardName(index, shard_size)
+        if shard not in shards:
+            os.makedirs(os.path.join(output_dir, shard), exist_ok=True)
+            shards.add(shard)
+        names.append(os.path.join(shard, frameName(index, prefix=prefix, sig_fig=sig_fig, file_ending=file_ending)))
+        os.rename(os.path.join(tmp_dir, str(k + 1).zfill(sig_fig) + file_ending), os.path.join(output_dir, names[-1]))
+    if manifest is not None:
+        setFramePaths(manifest, selected, output_dir, names, stat=True)
+    os.rmdir(tmp_dir)
+    logging.debug("Selected frame extraction finished.")
+
+def selectNthFrames(input_dir, output_dir, nth=15, manifest=None):
     """
     :param input_dir: Filepath to input directory from extractAllFrames().
     :type input_dir: str
@@ -96,9 +295,27 @@ def selectNthFrames(input_dir, output_dir, nth=15):
     :type output_dir: str
     :param nth: Controls how many frames are selected. Defaults to 15
     :type nth: int
+    :param manifest: Frame manifest filled in by extractAllFrames(). When given, its selected frames are moved and their
+        new path and size recorded, nth is ignored and input_dir is never listed. Defaults to None.
+    :type manifest: pandas df
 
     """
 
+    if manifest is not None:
+        selected = manifest['selected'].to_numpy(bool)
+        names = []
+        shards = set()
+        for input_img in manifest.loc[selected, 'path']:
+            # keeps the shard subdirectory of the sharded layout
+            names.append(os.path.relpath(input_img, input_dir))
+            shard = os.path.dirname(names[-1])
+            if shard not in shards:
+                os.makedirs(os.path.join(output_dir, shard), exist_ok=True)
+                shards.add(shard)
+            shutil.move(input_img, os.path.join(output_dir, names[-1]))
+        setFramePaths(manifest, selected, output_dir, names, stat=True)
+        return
+
     counter = 0
     for i in sorted(os.listdir(input_dir)):
         if counter % nth == 0:
@@ -108,4 +325,81 @@ def selectNthFrames(input_dir, output_dir, nth=15):
             counter +=1
         else:
             counter +=1
-            continue
\ No newline at end of file
+            continue
+
+def extractFramesInChunks(input_video, frame_dir, output_dir, manifest, budget_mb, prefix='frame_', sig_fig=7, file_ending='.jpg', shard_size=None):
+    """ Extracts every frame in chunks that fit a scratch disk budget, keeps the selected ones and frees the rest.
+
+    Each chunk is decoded into frame_dir, its selected frames are moved to output_dir and the others deleted before the
+    next chunk starts. Frames keep their frame number in the whole video and their manifest PTS, so selection and
+    telemetry alignment are the same as for extractAllFrames() followed by selectNthFrames().
+
+    The budget only covers frame_dir, the frames of one chunk before the unselected ones are deleted. The selected
+    frames are the outputs and accumulate in output_dir, they are tagged and finalized after the last chunk like in the
+    other extraction modes. The chunk size is derived from the largest frame seen so far (the first chunk is a single
+    frame) with a margin of CHUNK_MARGIN, and every chunk is measured once written: a chunk over the budget is logged
+    as a warning, and the larger frames it held shrink the chunks that follow.
+
+    :param input_video: Filepath to the target video.
+    :type input_video: str
+    :param frame_dir: Filepath to the scratch directory, must be empty.
+    :type frame_dir: str
+    :param output_dir: Filepath to the directory where the selected frames will be stored.
+    :type output_dir: str
+    :param manifest: Frame manifest from buildFrameManifest(), the path and size of the selected frames are recorded in it.
+    :type manifest: pandas df
+    :param budget_mb: Scratch space (MB) in frame_dir a chunk of frames may use.
+    :type budget_mb: float
+    :param prefix: Prefix for the extracted frames. Defaults to 'frame_'.
+    :type prefix: str
+    :param sig_fig: Controls the length of the frame IDs. Defaults to 7 (i.e. 0000001-9999999)
+    :type sig_fig: int
+    :param file_ending: Sets the frame output format. Defaults to '.jpg'
+    :type file_ending: str
+    :param shard_size: Maximum number of frames per subdirectory of output_dir, counted in source frames as in
+        extractAllFrames() (see shardName()), so a shard holds fewer selected frames. Defaults to None (flat).
+    :type shard_size: int
+    """
+
+    pts = manifest['pts'].to_numpy(float)
+    selected = manifest['selected'].to_numpy(bool)
+    budget = budget_mb * 1024 * 1024
+    frame_bytes = None
+    first = 0
+    n_chunks = 0
+    peak_bytes = 0
+    shards = set()
+    while first < len(pts):
+        count = 1 if frame_bytes is None else max(1, int(budget // (frame_bytes * CHUNK_MARGIN)))
+        count = min(count, len(pts) - first)
+        extractFrameRange(input_video, frame_dir, pts, first, count, prefix=prefix, sig_fig=sig_fig, file_ending=file_ending)
+        checkFrameCount(frame_dir, count, file_ending=file_ending)
+
+        kept_rows = []
+        kept_names = []
+        chunk_bytes = 0
+        for index in range(first, first + count):
+            name = frameName(index, prefix=prefix, sig_fig=sig_fig, file_ending=file_ending)
+            frame = os.path.join(frame_dir, name)
+            size = os.stat(frame).st_size
+            chunk_bytes += size
+            frame_bytes = max(frame_bytes or 0, size)
+            if not selected[index]:
+                os.remove(frame)
+                continue
+            shard = shardName(index, shard_size)
+            if shard not in shards:
+                os.makedirs(os.path.join(output_dir, shard), exist_ok=True)
+                shards.add(shard)
+            kept_rows.append(index)
+            kept_names.append(os.path.join(shard, name))
+            os.rename(frame, os.path.join(output_dir, kept_names[-1]))
+        if kept_rows:
+            setFramePaths(manifest, manifest.index[kept_rows], output_dir, kept_names, stat=True)
+        if chunk_bytes > budget:
+            logging.warning(f"Chunk of {count} frames from {first} used {chunk_bytes / 1024 / 1024:.1f} MB of scratch space, over the {budget_mb} MB budget.")
+        peak_bytes = max(peak_bytes, chunk_bytes)
+        logging.debug(f"Chunk of {count} frames from {first} done, kept {len(kept_rows)}.")
+        first += count
+        n_chunks += 1
+    logging.info(f"Extracted {len(pts)} frames in {n_chunks} chunks, using at most {peak_bytes / 1024 / 1024:.1f} MB of scratch space.")
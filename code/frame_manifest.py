@@ -0,0 +1,148 @@
+import logging
+import os
+import numpy as np
+import pandas as pd
+
+FRAME_MANIFEST = 'frame_manifest.csv'
+SHARD_DIGITS = 5
+
+def frameName(index, prefix='frame_', sig_fig=7, file_ending='.jpg'):
+    """ Returns the filename ffmpeg gives a frame in extractAllFrames() (frames are numbered from 1).
+
+    :param index: Source frame index, starting at 0.
+    :type index: int
+    :param prefix: Prefix for the extracted frames. Defaults to 'frame_'.
+    :type prefix: str
+    :param sig_fig: Controls the length of the frame IDs. Defaults to 7.
+    :type sig_fig: int
+    :param file_ending: Sets the frame output format. Defaults to '.jpg'
+    :type file_ending: str
+
+    :return: the frame's filename
+    :rtype: str
+    """
+
+    return prefix + str(int(index) + 1).zfill(sig_fig) + file_ending
+
+def shardName(index, shard_size=None):
+    """ Returns the shard subdirectory of a frame in the sharded layout, frames are grouped by source index.
+
+    :param index: Source frame index, starting at 0.
+    :type index: int
+    :param shard_size: Maximum number of frames per subdirectory, None for the flat layout. Defaults to None.
+    :type shard_size: int
+
+    :return: the subdirectory name, '' in the flat layout
+    :rtype: str
+    """
+
+    if shard_size is None:
+        return ''
+    return str(int(index) // shard_size).zfill(SHARD_DIGITS)
+
+def buildFrameManifest(frame_pts, nth, excluded=None):
+    """ Builds the frame manifest of a video: index, pts (ms), path, size and selected for every source frame.
+
+    path and size are filled in by the extraction functions as frames are written, path stays empty for frames that
+    were never written and size is only recorded for selected frames.
+
+    :param frame_pts: Output of extractFramePTS().
+    :type frame_pts: numpy.ndarray
+    :param nth: Frame selection step.
+    :type nth: int
+    :param excluded: (first, last) frame index ranges to drop, see buildSelectExpression(). Defaults to None.
+    :type excluded: numpy.ndarray
+
+    :return: one row per source frame
+    :rtype: pandas df
+    """
+
+    index = np.arange(len(frame_pts), dtype=np.int64)
+    selected = index % nth == 0
+    if excluded is not None:
+        for first, last in excluded:
+            selected[int(first):int(last) + 1] = False
+    return pd.DataFrame({
+        'index': index,
+        'pts': np.round(np.asarray(frame_pts, dtype=float), 3),
+        'path': '',
+        'size': np.zeros(len(index), dtype=np.int64),
+        'selected': selected
+    })
+
+def setFramePaths(manifest, rows, output_dir, names, stat=False):
+    """ Records where a set of frames were written.
+
+    :param manifest: Output of buildFrameManifest()
+    :type manifest: pandas df
+    :param rows: Boolean mask or index of the rows that were written.
+    :type rows: numpy.ndarray
+    :param output_dir: Directory the frames were written to.
+    :type output_dir: str
+    :param names: Filenames of the frames, in row order.
+    :type names: list of str
+    :param stat: Records the size of each frame. Defaults to False.
+    :type stat: bool
+    """
+
+    paths = [os.path.join(output_dir, i) for i in names]
+    manifest.loc[rows, 'path'] = paths
+    if stat:
+        manifest.loc[rows, 'size'] = [os.stat(i).st_size for i in paths]
+
+def updateFrameSizes(manifest):
+    """ Re-reads the size of the selected frames, e.g. after exiftool rewrote them.
+
+    :param manifest: Output of buildFrameManifest()
+    :type manifest: pandas df
+    """
+
+    rows = selectedFrames(manifest).index
+    manifest.loc[rows, 'size'] = [os.stat(i).st_size for i in manifest.loc[rows, 'path']]
+
+def selectedFrames(manifest):
+    """ Returns the selected rows of a manifest that were written to disk.
+
+    :param manifest: Output of buildFrameManifest() or readFrameManifest()
+    :type manifest: pandas df
+
+    :return: the selected rows
+    :rtype: pandas df
+    """
+
+    return manifest[manifest['selected'].to_numpy(bool) & (manifest['path'] != '').to_numpy(bool)]
+
+def writeFrameManifest(manifest_csv, manifest, root):
+    """ Writes a frame manifest with its paths relative to root.
+
+    :param manifest_csv: Filepath to the manifest.
+    :type manifest_csv: str
+    :param manifest: Output of buildFrameManifest()
+    :type manifest: pandas df
+    :param root: Directory the paths are made relative to, usually the video's project directory.
+    :type root: str
+    """
+
+    written = manifest['path'] != ''
+    manifest = manifest.copy()
+    manifest.loc[written, 'path'] = [os.path.relpath(i, root) for i in manifest.loc[written, 'path']]
+    manifest.to_csv(manifest_csv, index=False)
+    logging.debug(f"Frame manifest with {len(manifest)} frames saved to {manifest_csv}")
+
+def readFrameManifest(manifest_csv, root):
+    """ Reads a frame manifest written by writeFrameManifest().
+
+    :param manifest_csv: Filepath to the manifest.
+    :type manifest_csv: str
+    :param root: Directory the paths are relative to.
+    :type root: str
+
+    :return: one row per source frame, with absolute paths
+    :rtype: pandas df
+    """
+
+    manifest = pd.read_csv(manifest_csv, keep_default_na=False, dtype={'path': str})
+    written = manifest['path'] != ''
+    manifest.loc[written, 'path'] = [os.path.join(root, i) for i in manifest.loc[written, 'path']]
+    manifest['selected'] = manifest['selected'].astype(bool)
+    return manifest.sort_values('index').reset_index(drop=True)
@@ -0,0 +1,155 @@
+import logging
+import numpy as np
+import pandas as pd
+
+def findRuns(mask):
+    """ Finds the runs of consecutive True values in a boolean array.
+
+    :param mask: Boolean array
+    :type mask: numpy.ndarray
+
+    :return: start and end (inclusive) index of every run
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+
+    padded = np.concatenate([[False], np.asarray(mask, dtype=bool), [False]])
+    edges = np.flatnonzero(np.diff(padded.astype(np.int8)))
+    return edges[0::2], edges[1::2] - 1
+
+def findStationaryIntervals(gps_csv, min_speed, min_duration=2.0, speed_column='speed_2d'):
+    """ Finds the time intervals where the camera was (nearly) stationary.
+
+    :param gps_csv: Filepath to the GPS data, must be cleaned with cleanGPS().
+    :type gps_csv: str
+    :param min_speed: Samples slower than this (m/s) count as stationary.
+    :type min_speed: float
+    :param min_duration: Shorter stationary runs are ignored (s). Defaults to 2.
+    :type min_duration: float
+    :param speed_column: 'speed_2d' or 'speed_3d'. Defaults to 'speed_2d'.
+    :type speed_column: str
+
+    :return: (start, end) CTS in ms of each stationary interval
+    :rtype: numpy.ndarray
+    """
+
+    gps_df = pd.read_csv(gps_csv).sort_values('cts')
+    if speed_column not in gps_df:
+        logging.warning(f"{speed_column} not found in {gps_csv}, stationary segments will not be suppressed.")
+        return np.zeros((0, 2))
+    cts = gps_df['cts'].to_numpy(float)
+    starts, ends = findRuns(gps_df[speed_column].to_numpy(float) < min_speed)
+    intervals = np.column_stack([cts[starts], cts[ends]]).reshape(-1, 2)
+    intervals = intervals[(intervals[:, 1] - intervals[:, 0]) >= min_duration * 1000]
+    logging.info(f"Found {len(intervals)} stationary intervals.")
+    return intervals
+
+def collapseStationaryFrames(intervals, fps, nth, frame_pts=None):
+    """ Converts stationary intervals into ranges of nth frames to drop, keeping the first selected frame of each run.
+
+    :param intervals: (start, end) CTS in ms from findStationaryIntervals()
+    :type intervals: numpy.ndarray
+    :param fps: FPS of the original video.
+    :type fps: float
+    :param nth: Frame selection step.
+    :type nth: int
+    :param frame_pts: Exact PTS (ms) of every frame from extractFramePTS(). Defaults to None.
+    :type frame_pts: numpy.ndarray
+
+    :return: (first, last) frame index (inclusive) of each range to drop
+    :rtype: numpy.ndarray
+    """
+
+    frames = intervalsToFrames(intervals, fps, frame_pts=frame_pts)
+    first = frames[:, 0]
+    last = frames[:, 1]
+    # the first selected frame inside the run is kept as its representative
+    representative = -(-first // nth) * nth
+    excluded = np.column_stack([representative + 1, last]).reshape(-1, 2)
+    return excluded[excluded[:, 0] <= excluded[:, 1]]
+
+def buildSelectExpression(nth, excluded=None):
+    """ Builds an ffmpeg select filter that keeps every nth frame outside the excluded ranges.
+
+    :param nth: Frame selection step.
+    :type nth: int
+    :param excluded: (first, last) frame index ranges to drop. Defaults to None.
+    :type excluded: numpy.ndarray
+
+    :return: the select filter, with commas escaped for -vf
+    :rtype: str
+    """
+
+    expression = f"not(mod(n\\,{nth}))"
+    if excluded is not None:
+        for first, last in excluded:
+            expression += f"*not(between(n\\,{first}\\,{last}))"
+    return f"select={expression}"
+
+def selectedFrameIndices(nth, excluded=None):
+    """ Yields the frame indices kept by buildSelectExpression(), in order.
+
+    :param nth: Frame selection step.
+    :type nth: int
+    :param excluded: (first, last) frame index ranges to drop. Defaults to None.
+    :type excluded: numpy.ndarray
+    """
+
+    excluded = [] if excluded is None else sorted((int(a), int(b)) for a, b in excluded)
+    n = 0
+    k = 0
+    while True:
+        while k < len(excluded) and excluded[k][1] < n:
+            k += 1
+        if k < len(excluded) and excluded[k][0] <= n:
+            n = excluded[k][1] + 1
+            n = -(-n // nth) * nth
+            continue
+        yield n
+        n += nth
+
+def findPoorFixIntervals(gps_csv):
+    """ Finds the time intervals where the nearest GPS sample has a poor fix (gps_ok is False).
+
+    Each run of flagged samples is grown to the midpoints with its neighbouring good samples, so a frame falls in an
+    interval exactly when its nearest sample is flagged.
+
+    :param gps_csv: Filepath to the GPS data, must be cleaned with cleanGPS().
+    :type gps_csv: str
+
+    :return: (start, end) CTS in ms of each poor fix interval
+    :rtype: numpy.ndarray
+    """
+
+    gps_df = pd.read_csv(gps_csv).sort_values('cts')
+    if 'gps_ok' not in gps_df:
+        logging.warning(f"gps_ok not found in {gps_csv}, GPS quality will not be checked.")
+        return np.zeros((0, 2))
+    cts = gps_df['cts'].to_numpy(float)
+    starts, ends = findRuns(~gps_df['gps_ok'].to_numpy(bool))
+    midpoints = np.concatenate([[-np.inf], (cts[1:] + cts[:-1]) / 2, [np.inf]])
+    intervals = np.column_stack([midpoints[starts], midpoints[ends + 1]]).reshape(-1, 2)
+    logging.info(f"Found {len(intervals)} poor GPS fix intervals.")
+    return intervals
+
+def intervalsToFrames(intervals, fps, frame_pts=None):
+    """ Converts CTS intervals into the ranges of frames they contain.
+
+    :param intervals: (start, end) CTS in ms
+    :type intervals: numpy.ndarray
+    :param fps: FPS of the original video, only used without frame_pts.
+    :type fps: float
+    :param frame_pts: Exact PTS (ms) of every frame from extractFramePTS(). Defaults to None.
+    :type frame_pts: numpy.ndarray
+
+    :return: (first, last) frame index (inclusive) of each range
+    :rtype: numpy.ndarray
+    """
+
+    if frame_pts is not None:
+        first = np.searchsorted(frame_pts, intervals[:, 0], side='left')
+        last = np.searchsorted(frame_pts, intervals[:, 1], side='right') - 1
+    else:
+        first = np.ceil(np.clip(intervals[:, 0], 0, None) / 1000 * fps)
+        last = np.floor(np.clip(intervals[:, 1], None, np.iinfo(np.int32).max) / 1000 * fps)
+    frames = np.column_stack([first, last]).reshape(-1, 2).astype(np.int64)
+    return frames[frames[:, 0] <= frames[:, 1]]
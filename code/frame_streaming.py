@@ -0,0 +1,130 @@
+import logging
+import os
+import queue
+import subprocess
+import threading
+
+import numpy as np
+
+from code.apply_tags_hero9 import createGravityXMP
+from code.frame_selection import buildSelectExpression
+from code.jpeg_metadata import buildGPSExif, buildP4DXMP, insertSegments, iterJPEGs
+from code.process_runner import startProcess, waitProcess
+from code.progress_events import reportFrames
+
+STREAM_QUEUE_SIZE = 32
+
+def streamTaggedFrames(input_video, frame_table, outputs, nth, excluded=None, north_hem=True, west_hem=True, skip_poor_gps=False, queue_size=STREAM_QUEUE_SIZE, workers=2):
+    """ Decodes the selected frames once and writes each of them, already tagged, straight to its output folders.
+
+    ffmpeg applies the same select filter as extractSelectedFrames() and pipes the encoded JPEGs over stdout. A bounded
+    queue hands them to writer threads, which insert the EXIF GPS and Pix4D XMP segments in memory and write every
+    output file exactly once, so nothing is moved or rewritten by exiftool afterwards. At most queue_size frames are
+    held in memory while the writers catch up.
+
+    :param input_video: Filepath to the target video.
+    :type input_video: str
+    :param frame_table: Output of buildFrameTable() for the selected frames, in frame order, with the frame column
+        holding each frame's path relative to the output folders.
+    :type frame_table: pandas df
+    :param outputs: One dict per output folder with keys 'dir', 'gps' (EXIF GPS tags), 'p4d_ori' (Pix4D XMP
+        orientation tags) and 'rc_gravity' (RealityCapture gravity XMP sidecars).
+    :type outputs: list of dict
+    :param nth: Frame selection step.
+    :type nth: int
+    :param excluded: (first, last) frame index ranges to drop. Defaults to None.
+    :type excluded: numpy.ndarray
+    :param north_hem: Controls whether latitude is written in N hemisphere. Defaults to True.
+    :type north_hem: bool
+    :param west_hem: Controls whether longitude is written in W hemisphere. Defaults to True.
+    :type west_hem: bool
+    :param skip_poor_gps: Leaves out the GPS tags of frames flagged in gps_ok. Defaults to False.
+    :type skip_poor_gps: bool
+    :param queue_size: Maximum number of decoded frames waiting to be written. Defaults to STREAM_QUEUE_SIZE.
+    :type queue_size: int
+    :param workers: Number of writer threads. Defaults to 2.
+    :type workers: int
+
+    :return: the size (bytes) of each frame written to the first output folder
+    :rtype: list of int
+    """
+
+    rows = list(frame_table.itertuples(index=False))
+    has_gps = 'lat' in frame_table
+    has_ori = 'p4d_pitch' in frame_table
+    gps_usable = np.ones(len(rows), dtype=bool)
+    if has_gps and skip_poor_gps:
+        gps_usable = frame_table['gps_ok'].to_numpy(bool)
+        logging.info(f"{int((~gps_usable).sum())} frames have a poor GPS fix and will not be geotagged.")
+    for output in outputs:
+        for shard in sorted({os.path.dirname(row.frame) for row in rows}):
+            os.makedirs(os.path.join(output['dir'], shard), exist_ok=True)
+
+    sizes = [0] * len(rows)
+    frames = queue.Queue(maxsize=queue_size)
+    errors = []
+
+    def writeFrames():
+        while True:
+            item = frames.get()
+            if item is None:
+                return
+            k, jpeg = item
+            if errors:
+                continue
+            row = rows[k]
+            try:
+                for n, output in enumerate(outputs):
+                    segments = []
+                    if output['gps'] and has_gps and gps_usable[k]:
+                        segments.append(buildGPSExif(row.lat, row.lon, row.elev, north_hem=north_hem, west_hem=west_hem))
+                    if output['p4d_ori'] and has_ori:
+                        segments.append(buildP4DXMP(row.p4d_yaw, row.p4d_pitch, row.p4d_roll))
+                    data = insertSegments(jpeg, segments)
+                    frame_path = os.path.join(output['dir'], row.frame)
+                    with open(frame_path, 'wb') as frame_file:
+                        frame_file.write(data)
+                    if output['rc_gravity']:
+                        createGravityXMP(frame_path, (row.grav_x, row.grav_y, row.grav_z))
+                    if n == 0:
+                        sizes[k] = len(data)
+            except Exception as e:
+                errors.append(e)
+
+    writers = [threading.Thread(target=writeFrames, daemon=True) for _ in range(workers)]
+    for writer in writers:
+        writer.start()
+
+    logging.debug("Streaming frame extraction starts.")
+    stream_call = [
+        'ffmpeg', '-i', input_video,
+        '-vf', buildSelectExpression(nth, excluded),
+        '-vsync', 'passthrough',
+        '-f', 'image2pipe', '-c:v', 'mjpeg',
+        '-loglevel', 'error', '-'
+    ]
+    process = startProcess(stream_call, stdout=subprocess.PIPE)
+    n_frames = 0
+    try:
+        for jpeg in iterJPEGs(process.stdout):
+            if errors:
+                break
+            if n_frames < len(rows):
+                frames.put((n_frames, jpeg))
+            n_frames += 1
+            reportFrames(n_frames, len(rows))
+    finally:
+        for _ in writers:
+            frames.put(None)
+        for writer in writers:
+            writer.join()
+        if errors:
+            process.kill()
+        process.stdout.close()
+        waitProcess(process)
+    if errors:
+        raise errors[0]
+    if n_frames != len(rows):
+        logging.error(f"ffmpeg returned {n_frames} frames for {len(rows)} selected frames.")
+    logging.debug(f"Streamed {min(n_frames, len(rows))} frames to {len(outputs)} output folders.")
+    return sizes
@@ -0,0 +1,221 @@
+import struct
+
+SOI = b'\xff\xd8'
+APP0 = 0xE0
+EXIF_HEADER = b'Exif\x00\x00'
+XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+PIX4D_CAMERA_NS = 'http://pix4d.com/camera/1.0/'
+
+# TIFF field types
+TIFF_BYTE = 1
+TIFF_ASCII = 2
+TIFF_LONG = 4
+TIFF_RATIONAL = 5
+
+def findJPEGEnd(buffer):
+    """ Finds the end of the first JPEG in a buffer by walking its marker segments.
+
+    Segment lengths are followed up to each SOS, and the entropy coded data after it is scanned for the next marker
+    (0xFF followed by anything but 0x00, a fill byte or a restart marker), so bytes inside tables are never mistaken
+    for an EOI.
+
+    :param buffer: Bytes starting with a JPEG SOI marker.
+    :type buffer: bytes or bytearray
+
+    :return: the index just past the EOI marker, or None if the JPEG is not complete yet
+    :rtype: int
+    """
+
+    if len(buffer) < 2:
+        return None
+    if buffer[:2] != SOI:
+        raise ValueError("Stream is not a sequence of JPEG images.")
+    i = 2
+    while True:
+        if i + 2 > len(buffer):
+            return None
+        if buffer[i] != 0xFF:
+            raise ValueError(f"Expected a JPEG marker at byte {i}.")
+        marker = buffer[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0xD9:
+            return i + 2
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        if i + 4 > len(buffer):
+            return None
+        i += 2 + ((buffer[i + 2] << 8) | buffer[i + 3])
+        if marker != 0xDA:
+            continue
+        # entropy coded data runs until the next real marker
+        while True:
+            i = buffer.find(b'\xff', i)
+            if i < 0 or i + 1 >= len(buffer):
+                return None
+            following = buffer[i + 1]
+            if following == 0x00 or following == 0xFF or 0xD0 <= following <= 0xD7:
+                i += 1
+                continue
+            break
+
+def iterJPEGs(stream, read_size=1 << 20):
+    """ Splits a stream of concatenated JPEGs (e.g. ffmpeg -f image2pipe -c:v mjpeg) into single images.
+
+    :param stream: Binary file object, e.g. the stdout of an ffmpeg process.
+    :type stream: file
+    :param read_size: Bytes read from the stream at once. Defaults to 1 MB.
+    :type read_size: int
+
+    :return: yields the bytes of each JPEG
+    :rtype: generator
+    """
+
+    buffer = bytearray()
+    eof = False
+    while True:
+        end = findJPEGEnd(buffer)
+        if end is not None:
+            yield bytes(buffer[:end])
+            del buffer[:end]
+            continue
+        if eof:
+            if buffer:
+                raise ValueError(f"Stream ended inside a JPEG ({len(buffer)} bytes left).")
+            return
+        chunk = stream.read(read_size)
+        if not chunk:
+            eof = True
+        buffer.extend(chunk)
+
+def _segment(marker, payload):
+    """ Packs a JPEG marker segment.
+
+    :param marker: Marker byte, e.g. 0xE1 for APP1.
+    :type marker: int
+    :param payload: Segment content.
+    :type payload: bytes
+
+    :rtype: bytes
+    """
+
+    if len(payload) + 2 > 0xFFFF:
+        raise ValueError(f"JPEG segment of {len(payload)} bytes is too large.")
+    return bytes([0xFF, marker]) + struct.pack('>H', len(payload) + 2) + payload
+
+def _packIFD(entries, offset):
+    """ Packs a big-endian TIFF IFD followed by the values that do not fit in its entries.
+
+    :param entries: (tag, type, count, value bytes) sorted by tag.
+    :type entries: list of tuple
+    :param offset: Offset of the IFD from the start of the TIFF header.
+    :type offset: int
+
+    :rtype: bytes
+    """
+
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    ifd = struct.pack('>H', len(entries))
+    data = b''
+    for tag, field_type, count, value in entries:
+        if len(value) <= 4:
+            ifd += struct.pack('>HHI', tag, field_type, count) + value.ljust(4, b'\x00')
+        else:
+            ifd += struct.pack('>HHII', tag, field_type, count, data_offset + len(data))
+            data += value + b'\x00' * (len(value) % 2)
+    return ifd + b'\x00\x00\x00\x00' + data
+
+def _degreesToRationals(value):
+    """ Packs decimal degrees as the three degree, minute and second rationals used by EXIF.
+
+    :param value: Decimal degrees, the sign is ignored.
+    :type value: float
+
+    :rtype: bytes
+    """
+
+    # round once in units of 1/10000 s, so the seconds never carry over to 60
+    total = round(abs(float(value)) * 3600 * 10000)
+    degrees, total = divmod(total, 3600 * 10000)
+    minutes, seconds = divmod(total, 60 * 10000)
+    return struct.pack('>IIIIII', degrees, 1, minutes, 1, seconds, 10000)
+
+def buildGPSExif(lat, lon, elev, north_hem=True, west_hem=True):
+    """ Builds an APP1 Exif segment with the GPS tags writeEXIFTags() sets through exiftool.
+
+    :param lat: Latitude in decimal degrees.
+    :type lat: float
+    :param lon: Longitude in decimal degrees.
+    :type lon: float
+    :param elev: Altitude (m).
+    :type elev: float
+    :param north_hem: Controls whether latitude is written in N hemisphere. Defaults to True.
+    :type north_hem: bool
+    :param west_hem: Controls whether longitude is written in W hemisphere. Defaults to True.
+    :type west_hem: bool
+
+    :return: the segment, including its marker
+    :rtype: bytes
+    """
+
+    gps_entries = [
+        (0x0000, TIFF_BYTE, 4, bytes([2, 3, 0, 0])),
+        (0x0001, TIFF_ASCII, 2, b'N\x00' if north_hem == True else b'S\x00'),
+        (0x0002, TIFF_RATIONAL, 3, _degreesToRationals(lat)),
+        (0x0003, TIFF_ASCII, 2, b'W\x00' if west_hem == True else b'E\x00'),
+        (0x0004, TIFF_RATIONAL, 3, _degreesToRationals(lon)),
+        (0x0005, TIFF_BYTE, 1, bytes([1 if float(elev) < 0 else 0])),
+        (0x0006, TIFF_RATIONAL, 1, struct.pack('>II', round(abs(float(elev)) * 1000), 1000))
+    ]
+    # IFD0 only holds the pointer to the GPS IFD, which follows it
+    gps_offset = 8 + 2 + 12 + 4
+    tiff = b'MM\x00\x2a' + struct.pack('>I', 8)
+    tiff += _packIFD([(0x8825, TIFF_LONG, 1, struct.pack('>I', gps_offset))], 8)
+    tiff += _packIFD(gps_entries, gps_offset)
+    return _segment(0xE1, EXIF_HEADER + tiff)
+
+def buildP4DXMP(yaw, pitch, roll):
+    """ Builds an APP1 XMP segment with the Pix4D Camera:Yaw, Camera:Pitch and Camera:Roll tags (see pix4d.config).
+
+    :param yaw: Yaw in degrees.
+    :type yaw: float
+    :param pitch: Pitch in degrees.
+    :type pitch: float
+    :param roll: Roll in degrees.
+    :type roll: float
+
+    :return: the segment, including its marker
+    :rtype: bytes
+    """
+
+    packet = (
+        '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+        '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        f'<rdf:Description rdf:about="" xmlns:Camera="{PIX4D_CAMERA_NS}"'
+        f' Camera:Yaw="{float(yaw)}" Camera:Pitch="{float(pitch)}" Camera:Roll="{float(roll)}"/>'
+        '</rdf:RDF>'
+        '</x:xmpmeta>'
+        '<?xpacket end="w"?>'
+    )
+    return _segment(0xE1, XMP_HEADER + packet.encode('utf-8'))
+
+def insertSegments(jpeg, segments):
+    """ Inserts metadata segments into an encoded JPEG, right after its SOI (and JFIF APP0 segment, if any).
+
+    :param jpeg: The encoded JPEG.
+    :type jpeg: bytes
+    :param segments: Segments from buildGPSExif() or buildP4DXMP().
+    :type segments: list of bytes
+
+    :rtype: bytes
+    """
+
+    if not segments:
+        return jpeg
+    i = 2
+    if jpeg[2] == 0xFF and jpeg[3] == APP0:
+        i += 2 + ((jpeg[4] << 8) | jpeg[5])
+    return jpeg[:i] + b''.join(segments) + jpeg[i:]
@@ -1,12 +1,17 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import exifread
+import csv
+import json
+import logging
 import os
-import shutil
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib.patches import Ellipse
 from shapely import geometry
 from pyproj import Transformer
 
+from code.file_management import linkOrCopy
+
 # CONSTANTS
 TARGET_EPSG = 'EPSG:3310'
 SOURCE_EPSG = 'EPSG:4326'
@@ -14,6 +19,10 @@ MINIMUM_IMG = 50
 CELL_HEIGHT = 5
 CELL_WIDTH = 5
 IMG_FORMAT = '.jpg' # update this to ignore case, also jpg, jpeg, etc. probably should just error handle if it dont open
+MANIFEST_FORMATS = ('csv', 'geojson')
+MB_PER_IMAGE = 100 # rough peak SfM memory per image, tune this to your hardware and image resolution
+TILE_OVERLAP = 10
+MAX_TILE_DEPTH = 32
 
 
 # I found this code snippets on StackOverflow, which linked to this GitHub.
@@ -94,6 +103,25 @@ def getProjectedImgCoord(img_path, source_crs, target_crs):
     x, y = transformer.transform(gps['longitude'], gps['latitude'])
     return (x,y)
 
+def listImages(img_dir):
+    """
+    Lists the images of a directory, including those in its shard subdirectories (see shard_size).
+
+    :param img_dir: Filepath to image directory
+    :type img_dir: str
+
+    :return: the image paths, sorted
+    :rtype: [str, str, ..., str]
+    """
+
+    imgs = []
+    for entry in os.scandir(img_dir):
+        if entry.is_dir():
+            imgs.extend(i.path for i in os.scandir(entry.path) if i.name.endswith(IMG_FORMAT))
+        elif entry.name.endswith(IMG_FORMAT):
+            imgs.append(entry.path)
+    return sorted(imgs)
+
 def getBBFromDirectory(img_dir, source_crs, target_crs):
     """
     Calculates the projected bounding box for all images in a directory.
@@ -115,10 +143,7 @@ def getBBFromDirectory(img_dir, source_crs, target_crs):
     max_x = 0
     min_y = 0
     max_y = 0
-    for i in os.listdir(img_dir):
-        if not i.endswith(IMG_FORMAT):
-            continue
-        img = img_dir + '/' + i
+    for img in listImages(img_dir):
         x_i, y_i = getProjectedImgCoord(img, source_crs, target_crs)
 
         if first_flag == True:
@@ -138,6 +163,32 @@ def getBBFromDirectory(img_dir, source_crs, target_crs):
                 min_y = y_i
     return [[min_x, min_y], [max_x, max_y]]
 
+def getImgCoordsFromDirectory(img_dir, source_crs, target_crs):
+    """
+    Reads the GPS tags of every image in a directory once and projects them with a single transformer.
+
+    :param img_dir: Filepath to image directory
+    :type img_dir: str
+    :param source_crs: The EPSG code for original CRS, for example  'EPSG:4326'
+    :type source_crs: str
+    :param target_crs: The EPSG code for desired CRS, for example  'EPSG:3310'
+    :type target_crs: str
+
+    :return: Returns a dictionary mapping each image path to (lon, lat, x, y)
+    :rtype: dict
+    """
+
+    transformer = Transformer.from_crs(source_crs, target_crs, always_xy=True)
+    img_coords = {}
+    for img in listImages(img_dir):
+        gps = getGPS(img)
+        if not gps:
+            logging.warning(f"No GPS tags found for {img}, skipping.")
+            continue
+        x, y = transformer.transform(gps['longitude'], gps['latitude'])
+        img_coords[img] = (gps['longitude'], gps['latitude'], x, y)
+    return img_coords
+
 def calculateCellsRequired(min_x, min_y, max_x, max_y, cell_width, cell_height):
     """
     Calculates the number of cells required to cover an area given a width and height.
@@ -217,8 +268,7 @@ def selectPhotosWithinCell(x, y, cell_width, cell_height, img_dir):
     buffer = circumscribeCellWithEllipse(x, y, cell_width, cell_height)
     vertices = buffer.get_verts()     # get the vertices from the ellipse object
     selection_area = geometry.Polygon(vertices)
-    for i in sorted(os.listdir(img_dir)):
-        img = img_dir + '/' + i
+    for img in listImages(img_dir):
         x_i, y_i = getProjectedImgCoord(img, SOURCE_EPSG, TARGET_EPSG)
         img_point = geometry.Point(x_i, y_i)
         if selection_area.contains(img_point) == True:
@@ -226,6 +276,33 @@ def selectPhotosWithinCell(x, y, cell_width, cell_height, img_dir):
     return(selected_list)
 
 
+def selectCoordsWithinCell(x, y, cell_width, cell_height, img_coords):
+    """
+    Selects all photos contained within the given location from precomputed coordinates.
+
+    :param x: X coordinate of the cell's center
+    :type x: float
+    :param y: Y coordinate of the cell's center
+    :type y: float
+    :param cell_width: width of cell
+    :type cell_width: float
+    :param cell_height: height of cell
+    :type cell_height: float
+    :param img_coords: Output of getImgCoordsFromDirectory()
+    :type img_coords: dict
+
+    :return: a list of all contained images
+    :rtype: [str, str, ..., str]
+    """
+
+    buffer = circumscribeCellWithEllipse(x, y, cell_width, cell_height)
+    selection_area = geometry.Polygon(buffer.get_verts())
+    selected_list = []
+    for img, (_, _, x_i, y_i) in img_coords.items():
+        if selection_area.contains(geometry.Point(x_i, y_i)):
+            selected_list.append(img)
+    return selected_list
+
 def circumscribeCellWithEllipse(x, y, cell_width, cell_height):
     """
     Calculates the ellipse that circumscribes a cell given its width and height.
@@ -316,7 +393,69 @@ def findLargestBB(input_root, source_crs, target_crs):
 
     return [[min_x, min_y], [max_x, max_y]]
 
-def selectFromNestedDirectory(input_root, output_root, source_crs, target_crs, cell_height, cell_width, min_img):
+def writeCellManifest(manifest_path, cell_id, entries, manifest_format='csv'):
+    """
+    Writes the list of images selected for a cell so SfM batch jobs can consume it without any files being exported.
+
+    :param manifest_path: Filepath to the manifest, without extension.
+    :type manifest_path: str
+    :param cell_id: The cell's index
+    :type cell_id: int
+    :param entries: One (source_path, exported_name, lon, lat, x, y) tuple per image.
+    :type entries: list
+    :param manifest_format: 'csv' or 'geojson'. Defaults to 'csv'.
+    :type manifest_format: str
+
+    :return: Filepath to the written manifest
+    :rtype: str
+    """
+
+    if manifest_format == 'csv':
+        manifest_path = manifest_path + '.csv'
+        with open(manifest_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['cell', 'source', 'image', 'lon', 'lat', 'x', 'y'])
+            for source, image, lon, lat, x, y in entries:
+                writer.writerow([cell_id, source, image, lon, lat, x, y])
+    elif manifest_format == 'geojson':
+        manifest_path = manifest_path + '.geojson'
+        features = []
+        for source, image, lon, lat, x, y in entries:
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+                'properties': {'cell': cell_id, 'source': source, 'image': image, 'x': x, 'y': y}
+            })
+        with open(manifest_path, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    else:
+        raise ValueError(f"Unknown manifest format {manifest_format}, expected one of {MANIFEST_FORMATS}.")
+    return manifest_path
+
+def exportFiles(jobs, export_mode='auto', workers=None):
+    """
+    Exports (src, dst) pairs across a thread pool. Linking and copying are I/O bound, so threads are sufficient.
+
+    :param jobs: List of (src, dst) filepaths
+    :type jobs: list
+    :param export_mode: Passed to linkOrCopy(). Defaults to 'auto'.
+    :type export_mode: str
+    :param workers: Number of worker threads. Defaults to None (ThreadPoolExecutor default).
+    :type workers: int
+
+    :return: Number of files exported with each method
+    :rtype: dict
+    """
+
+    counts = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for method in pool.map(lambda job: linkOrCopy(job[0], job[1], mode=export_mode), jobs):
+            counts[method] = counts.get(method, 0) + 1
+    logging.info(f"Exported {len(jobs)} files: {counts}")
+    return counts
+
+def selectFromNestedDirectory(input_root, output_root, source_crs, target_crs, cell_height, cell_width, min_img,
+                              export_mode='copy', manifest_format=None, workers=None):
     """
     This is a convenience function to generate cells and select photos from multiple directories.
 
@@ -335,28 +474,240 @@ def selectFromNestedDirectory(input_root, output_root, source_crs, target_crs, c
     :type cell_height: float
     :param min_img: A threshold for minimum number of images needed to accept a cell.
     :type min_img: int
+    :param export_mode: How images are placed in the cell folders, one of 'copy', 'hardlink', 'reflink', 'symlink', 'auto',
+        or 'none' to only write manifests. Defaults to 'copy'.
+    :type export_mode: str
+    :param manifest_format: Writes a per-cell manifest as 'csv' or 'geojson'. Defaults to None (no manifest).
+    :type manifest_format: str
+    :param workers: Number of worker threads used for exporting. Defaults to None.
+    :type workers: int
     """
+    if export_mode == 'none' and manifest_format is None:
+        logging.warning("export_mode is 'none' but no manifest_format was given, defaulting to CSV manifests.")
+        manifest_format = 'csv'
     [ll, ur] = findLargestBB(input_root, source_crs, target_crs)
     num_cells = calculateCellsRequired(ll[0],ll[1], ur[0], ur[1], cell_height, cell_width)
     cell_x, cell_y = findCellCenters(ll[0], ll[1], cell_height, cell_width)
+    cell_entries = {}
+    jobs = []
     for i in sorted(os.listdir(input_root)):
         current_dir = input_root + '/' + i
         if not os.path.isdir(current_dir):
             continue
+        img_coords = getImgCoordsFromDirectory(current_dir, source_crs, target_crs)
         for j in range(0, num_cells):
-            img_list = selectPhotosWithinCell(cell_x[j], cell_y[j], cell_height, cell_width, current_dir)
+            img_list = selectCoordsWithinCell(cell_x[j], cell_y[j], cell_height, cell_width, img_coords)
             if len(img_list) < min_img:
                 continue
             output_dir = output_root + '/' + str(j)
-            if not os.path.exists(output_dir):
+            if export_mode != 'none' and not os.path.exists(output_dir):
                 os.mkdir(output_dir)
-            counter  = 0
+            entries = cell_entries.setdefault(j, [])
             for k in img_list:
-                new_file = output_dir + '/' + str(j) + '_' + str(counter) + '.jpg'
-                shutil.copy(k, new_file)
-                counter += 1
+                # the counter runs across directories so a later directory never overwrites an earlier one
+                new_name = str(j) + '_' + str(len(entries)) + '.jpg'
+                entries.append((k, new_name) + img_coords[k])
+                if export_mode != 'none':
+                    jobs.append((k, output_dir + '/' + new_name))
+
+    if export_mode != 'none':
+        exportFiles(jobs, export_mode=export_mode, workers=workers)
+    if manifest_format is not None:
+        for j, entries in cell_entries.items():
+            writeCellManifest(output_root + '/' + str(j), j, entries, manifest_format=manifest_format)
+
+def calculateMaxImagesPerTile(memory_budget_mb, mb_per_image=MB_PER_IMAGE):
+    """
+    Converts a memory budget into the maximum number of images per tile.
+
+    :param memory_budget_mb: Memory available to a single SfM job (MB)
+    :type memory_budget_mb: float
+    :param mb_per_image: Approximate memory needed per image (MB). Defaults to MB_PER_IMAGE.
+    :type mb_per_image: float
+
+    :return: maximum number of images per tile
+    :rtype: int
+    """
+
+    max_images = int(memory_budget_mb // mb_per_image)
+    if max_images < 1:
+        raise ValueError(f"A memory budget of {memory_budget_mb} MB cannot hold a single image at {mb_per_image} MB per image.")
+    return max_images
+
+def findPointsWithinBounds(x, y, bounds, buffer=0):
+    """
+    Returns a mask of the points inside a (buffered) bounding box.
+
+    :param x: X coordinates
+    :type x: numpy.ndarray
+    :param y: Y coordinates
+    :type y: numpy.ndarray
+    :param bounds: (min_x, min_y, max_x, max_y)
+    :type bounds: tuple
+    :param buffer: Distance the bounding box is grown by on every side. Defaults to 0.
+    :type buffer: float
+
+    :return: boolean mask
+    :rtype: numpy.ndarray
+    """
+
+    min_x, min_y, max_x, max_y = bounds
+    return (x >= min_x - buffer) & (x <= max_x + buffer) & (y >= min_y - buffer) & (y <= max_y + buffer)
+
+def bisectTiles(x, y, core_idx, bounds, max_images, overlap, method='kd', depth=0):
+    """
+    Recursively splits a set of points until every tile, including its overlap band, holds at most max_images.
+
+    'kd' splits the longer side at the median point, so tiles stay balanced when images are clustered along a path.
+    'quad' splits the bounds into four equal quadrants.
+
+    :param x: X coordinates of all points
+    :type x: numpy.ndarray
+    :param y: Y coordinates of all points
+    :type y: numpy.ndarray
+    :param core_idx: Indices of the points owned by this tile
+    :type core_idx: numpy.ndarray
+    :param bounds: (min_x, min_y, max_x, max_y) of this tile
+    :type bounds: tuple
+    :param max_images: Maximum number of images per tile, including the overlap band
+    :type max_images: int
+    :param overlap: Width of the overlap band around each tile
+    :type overlap: float
+    :param method: 'kd' or 'quad'. Defaults to 'kd'.
+    :type method: str
+    :param depth: Current recursion depth. Defaults to 0.
+    :type depth: int
+
+    :return: a list of (core_idx, bounds) for every leaf tile
+    :rtype: list
+    """
 
-test_root = '/Users/theo/Desktop/whitell_1_frames_n_30'
+    n_tile = int(np.count_nonzero(findPointsWithinBounds(x, y, bounds, overlap)))
+    if n_tile <= max_images:
+        return [(core_idx, bounds)]
+    if len(core_idx) <= 1 or depth >= MAX_TILE_DEPTH:
+        logging.warning(f"Tile {bounds} holds {n_tile} images but cannot be split further, consider a smaller overlap.")
+        return [(core_idx, bounds)]
+
+    min_x, min_y, max_x, max_y = bounds
+    children = []
+    if method == 'kd':
+        if max_x - min_x >= max_y - min_y:
+            coords, axis = x, 0
+        else:
+            coords, axis = y, 1
+        order = core_idx[np.argsort(coords[core_idx], kind='stable')]
+        half = len(order) // 2
+        split = float(coords[order[half]])
+        if axis == 0:
+            children.append((order[:half], (min_x, min_y, split, max_y)))
+            children.append((order[half:], (split, min_y, max_x, max_y)))
+        else:
+            children.append((order[:half], (min_x, min_y, max_x, split)))
+            children.append((order[half:], (min_x, split, max_x, max_y)))
+    elif method == 'quad':
+        cx = (min_x + max_x) / 2
+        cy = (min_y + max_y) / 2
+        left = x[core_idx] < cx
+        bottom = y[core_idx] < cy
+        children.append((core_idx[left & bottom], (min_x, min_y, cx, cy)))
+        children.append((core_idx[~left & bottom], (cx, min_y, max_x, cy)))
+        children.append((core_idx[left & ~bottom], (min_x, cy, cx, max_y)))
+        children.append((core_idx[~left & ~bottom], (cx, cy, max_x, max_y)))
+    else:
+        raise ValueError(f"Unknown partition method {method}, expected 'kd' or 'quad'.")
+
+    tiles = []
+    for child_idx, child_bounds in children:
+        if len(child_idx) == 0:
+            continue
+        tiles.extend(bisectTiles(x, y, child_idx, child_bounds, max_images, overlap, method=method, depth=depth+1))
+    return tiles
 
+def partitionImages(img_dir, output_root, memory_budget_mb, mb_per_image=MB_PER_IMAGE, overlap=TILE_OVERLAP, method='kd',
+                    source_crs=SOURCE_EPSG, target_crs=TARGET_EPSG, export_mode='none', workers=None):
+    """
+    Splits a directory of geotagged images into overlapping tiles that can be reconstructed in parallel and merged.
+
+    Writes one tile_<n>.csv manifest per tile, flagging the images that only belong to the overlap band, and a
+    tiles.json index recording each tile's core bounds, overlap and image counts.
+
+    :param img_dir: Filepath to image directory, e.g. gfam_outputs/images
+    :type img_dir: str
+    :param output_root: Filepath to the desired output directory.
+    :type output_root: str
+    :param memory_budget_mb: Memory available to a single SfM job (MB)
+    :type memory_budget_mb: float
+    :param mb_per_image: Approximate memory needed per image (MB). Defaults to MB_PER_IMAGE.
+    :type mb_per_image: float
+    :param overlap: Width of the overlap band shared with neighbouring tiles, in target CRS units. Defaults to TILE_OVERLAP.
+    :type overlap: float
+    :param method: 'kd' or 'quad' bisection. Defaults to 'kd'.
+    :type method: str
+    :param source_crs: The EPSG code for original CRS. Defaults to SOURCE_EPSG.
+    :type source_crs: str
+    :param target_crs: The EPSG code for desired CRS. Defaults to TARGET_EPSG.
+    :type target_crs: str
+    :param export_mode: How images are placed in per-tile folders (see selectFromNestedDirectory()). Defaults to 'none'.
+    :type export_mode: str
+    :param workers: Number of worker threads used for exporting. Defaults to None.
+    :type workers: int
+
+    :return: the tile index written to tiles.json
+    :rtype: list
+    """
 
-selectFromNestedDirectory(test_root, output_root, SOURCE_EPSG, TARGET_EPSG, 10, 10, 50)
+    max_images = calculateMaxImagesPerTile(memory_budget_mb, mb_per_image)
+    img_coords = getImgCoordsFromDirectory(img_dir, source_crs, target_crs)
+    paths = list(img_coords.keys())
+    coords = np.array(list(img_coords.values()), dtype=float).reshape(-1, 4)
+    x = coords[:, 2]
+    y = coords[:, 3]
+    if len(paths) == 0:
+        logging.error(f"No geotagged images found in {img_dir}.")
+        return []
+
+    bounds = (x.min(), y.min(), x.max(), y.max())
+    tiles = bisectTiles(x, y, np.arange(len(paths)), bounds, max_images, overlap, method=method)
+    logging.info(f"Partitioned {len(paths)} images into {len(tiles)} tiles of at most {max_images} images.")
+
+    os.makedirs(output_root, exist_ok=True)
+    tile_index = []
+    jobs = []
+    for n, (core_idx, tile_bounds) in enumerate(tiles):
+        tile_idx = np.flatnonzero(findPointsWithinBounds(x, y, tile_bounds, overlap))
+        in_core = np.isin(tile_idx, core_idx)
+        tile_dir = output_root + '/tile_' + str(n)
+        if export_mode != 'none' and not os.path.exists(tile_dir):
+            os.mkdir(tile_dir)
+        manifest_path = output_root + '/tile_' + str(n) + '.csv'
+        with open(manifest_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['tile', 'source', 'image', 'lon', 'lat', 'x', 'y', 'overlap'])
+            for k, core in zip(tile_idx, in_core):
+                image = os.path.basename(paths[k])
+                lon, lat, x_k, y_k = coords[k]
+                writer.writerow([n, paths[k], image, lon, lat, x_k, y_k, int(not core)])
+                if export_mode != 'none':
+                    jobs.append((paths[k], tile_dir + '/' + image))
+        tile_index.append({
+            'tile': n,
+            'manifest': os.path.basename(manifest_path),
+            'bounds': [float(b) for b in tile_bounds],
+            'overlap': overlap,
+            'n_images': int(len(tile_idx)),
+            'n_core': int(np.count_nonzero(in_core)),
+            'n_overlap': int(len(tile_idx) - np.count_nonzero(in_core))
+        })
+
+    if export_mode != 'none':
+        exportFiles(jobs, export_mode=export_mode, workers=workers)
+    with open(output_root + '/tiles.json', 'w') as f:
+        json.dump({'method': method, 'max_images': max_images, 'target_crs': target_crs, 'tiles': tile_index}, f, indent=4)
+    return tile_index
+
+if __name__ == '__main__':
+    test_root = '/Users/theo/Desktop/whitell_1_frames_n_30'
+    output_root = '/Users/theo/Desktop/whitell_1_cells'
+
+    selectFromNestedDirectory(test_root, output_root, SOURCE_EPSG, TARGET_EPSG, 10, 10, 50)
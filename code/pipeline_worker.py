@@ -0,0 +1,171 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+
+PARENT_CHECK_INTERVAL = 1.0 # s between checks that the process that started a worker is still there
+
+class _EventHandler(logging.Handler):
+    """ Forwards the worker's log records to its event queue. """
+
+    def __init__(self, events, current):
+        super().__init__()
+        self.events = events
+        self.current = current
+        self.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+
+    def emit(self, record):
+        try:
+            self.events.put(('log', self.current['job'], self.format(record)))
+        except Exception:
+            self.handleError(record)
+
+def workerMain(jobs, events, log_level='INFO', persistent_exiftool=False):
+    """ Entry point of a worker process. Imports the pipeline once, then runs the jobs it receives one after the other
+    with gfam_exec.runPipeline().
+
+    Sends ('ready', None, pid), then ('log', job_id, line), ('progress', job_id, event) and ('exit', job_id, status)
+    for every job, status is 0 on success and 1 on failure.
+
+    :param jobs: Queue of (job_id, settings) tuples, None stops the worker.
+    :type jobs: multiprocessing.Queue
+    :param events: Queue the worker reports to.
+    :type events: multiprocessing.Queue
+    :param log_level: Logging level of the worker. Defaults to 'INFO'.
+    :type log_level: str
+    :param persistent_exiftool: Keeps one exiftool -stay_open session for all jobs, see setExifToolSession(). Defaults to
+        False.
+    :type persistent_exiftool: bool
+    """
+
+    # a process group of its own, so cancelling a job reaches its ffmpeg, node and exiftool children too
+    os.setsid()
+    current = {'job': None}
+    logging.basicConfig(level=log_level.upper(), handlers=[_EventHandler(events, current)])
+
+    import gfam_exec
+    from code.exiftool_session import exifToolSession, setExifToolSession
+    from code.progress_events import subscribe
+    subscribe(lambda message: events.put(('progress', current['job'], message)))
+    gfam_exec.preloadPipeline()
+    if persistent_exiftool == True:
+        setExifToolSession(True)
+        try:
+            exifToolSession()
+        except OSError as e:
+            logging.warning(f"Could not start an exiftool session, exiftool will be started for every frame: {e}")
+            setExifToolSession(False)
+    events.put(('ready', None, os.getpid()))
+
+    parent = os.getppid()
+    while True:
+        try:
+            job = jobs.get(timeout=PARENT_CHECK_INTERVAL)
+        except queue.Empty:
+            # nothing would ever stop a worker whose parent was killed
+            if os.getppid() != parent:
+                break
+            continue
+        if job is None:
+            break
+        current['job'], data = job
+        try:
+            gfam_exec.runPipeline(data)
+            status = 0
+        except Exception as e:
+            logging.exception(f"Pipeline failed: {e}")
+            status = 1
+        events.put(('exit', current['job'], status))
+        current['job'] = None
+    setExifToolSession(False)
+
+def startWorker(log_level='INFO', persistent_exiftool=False):
+    """ Starts a worker process, see workerMain().
+
+    Every worker has its own queues, a worker killed while writing to a queue can only corrupt its own.
+
+    :param log_level: Logging level of the worker. Defaults to 'INFO'.
+    :type log_level: str
+    :param persistent_exiftool: Keeps one exiftool session for all jobs. Defaults to False.
+    :type persistent_exiftool: bool
+
+    :return: the worker, with its process, jobs and events queues and the id of the job it runs (None while idle)
+    :rtype: dict
+    """
+
+    # spawned rather than forked, the parent may be a Tk application with threads
+    context = multiprocessing.get_context('spawn')
+    jobs = context.Queue()
+    events = context.Queue()
+    process = context.Process(target=workerMain, args=(jobs, events, log_level, persistent_exiftool), daemon=True)
+    process.start()
+    # workerMain() makes the worker's pid the id of its process group
+    return {'process': process, 'jobs': jobs, 'events': events, 'job': None, 'group': process.pid}
+
+def submitJob(worker, job_id, data):
+    """ Sends a job to an idle worker.
+
+    :param worker: Output of startWorker()
+    :type worker: dict
+    :param job_id: Identifies the job in the worker's events.
+    :type job_id: int
+    :param data: Content of the JSON settings file.
+    :type data: dict
+    """
+
+    worker['job'] = job_id
+    worker['jobs'].put((job_id, data))
+
+def workerEvents(worker):
+    """ Returns the events the worker sent since the last call, without waiting.
+
+    :param worker: Output of startWorker()
+    :type worker: dict
+
+    :rtype: list of tuple
+    """
+
+    events = []
+    while True:
+        try:
+            events.append(worker['events'].get_nowait())
+        except (queue.Empty, EOFError, OSError):
+            break
+        if events[-1][0] == 'exit':
+            worker['job'] = None
+    return events
+
+def signalWorker(worker, signum=signal.SIGTERM):
+    """ Sends a signal to a worker and every process it started, e.g. to cancel its job.
+
+    The signal goes to the worker's process group even once the worker has exited, so children that ignored an earlier
+    SIGTERM are still reached. After a SIGKILL nothing is left in the group, later calls do nothing.
+
+    :param worker: Output of startWorker()
+    :type worker: dict
+    :param signum: The signal. Defaults to signal.SIGTERM.
+    :type signum: int
+    """
+
+    process = worker['process']
+    if worker['group'] is None:
+        return
+    try:
+        os.killpg(worker['group'], signum)
+    except ProcessLookupError:
+        # killed before workerMain() started its process group, or the whole group has exited
+        if process.is_alive():
+            os.kill(process.pid, signum)
+    if signum == signal.SIGKILL:
+        # the group id may be reused once its processes are gone
+        worker['group'] = None
+
+def stopWorker(worker):
+    """ Asks an idle worker to exit once it is done with its queue.
+
+    :param worker: Output of startWorker()
+    :type worker: dict
+    """
+
+    worker['jobs'].put(None)
@@ -0,0 +1,280 @@
+import logging
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+# rusage block counts are in 512 byte units on Linux
+BLOCK_SIZE = 512
+# the peak memory of a child is sampled often at first, so short children are caught, then less and less
+RSS_FIRST_SAMPLE = 0.005 # s
+RSS_MAX_INTERVAL = 0.25 # s
+
+PROCESS_LOG = []
+_state = {'stage': None, 'timeouts': {}, 'threads': {}, 'stdout': None}
+
+def setStageLimits(timeouts=None, threads=None):
+    """ Sets the per stage limits applied to every child process started by startProcess().
+
+    :param timeouts: Seconds each child of a stage may run before it is killed, e.g. {'extract': 3600}. Defaults to None.
+    :type timeouts: dict
+    :param threads: Number of CPUs the children of a stage may run on, e.g. {'extract': 4}. Defaults to None.
+    :type threads: dict
+    """
+
+    _state['timeouts'] = dict(timeouts or {})
+    _state['threads'] = dict(threads or {})
+
+def setChildStdout(stdout=None):
+    """ Sets where children that are not captured write their stdout, e.g. sys.stderr while stdout carries progress events.
+
+    :param stdout: File object or descriptor. Defaults to None (inherit this process's stdout).
+    :type stdout: file
+    """
+
+    _state['stdout'] = stdout
+
+def currentStage():
+    """ Returns the stage the child processes started now are attributed to, see processStage().
+
+    :rtype: str
+    """
+
+    return _state['stage']
+
+@contextmanager
+def processStage(stage):
+    """ Attributes the child processes started inside the block to a stage, see timeStage().
+
+    :param stage: Name of the stage, e.g. 'extract'.
+    :type stage: str
+    """
+
+    previous = _state['stage']
+    _state['stage'] = stage
+    try:
+        yield
+    finally:
+        _state['stage'] = previous
+
+def _capCPUs(threads):
+    """ Returns a preexec_fn that pins the child to its first allowed CPUs, ffmpeg sizes its thread pool from them.
+
+    :param threads: Number of CPUs, or None for no cap.
+    :type threads: int
+
+    :rtype: function
+    """
+
+    if threads is None or not hasattr(os, 'sched_setaffinity'):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))[:max(int(threads), 1)]
+    return lambda: os.sched_setaffinity(0, cpus)
+
+def _sampleRSS(process, stop):
+    """ Follows the peak resident memory of a child in process.gfam_max_rss (kB) until stop is set.
+
+    It is read from the VmHWM high-water mark of /proc/<pid>/status, which only covers the program the child runs.
+    ru_maxrss cannot be used, Linux carries the peak of this process over fork (or vfork) and exec, so every child
+    would report at least the memory of the interpreter that started it. Growth in the last interval before the child
+    exits is missed, and nothing is recorded where /proc does not exist.
+
+    :param process: Output of startProcess()
+    :type process: subprocess.Popen
+    :param stop: Set once the child has exited.
+    :type stop: threading.Event
+    """
+
+    status_path = f"/proc/{process.pid}/status"
+    interval = RSS_FIRST_SAMPLE
+    while True:
+        try:
+            with open(status_path, 'rb') as status_file:
+                for line in status_file:
+                    if line.startswith(b'VmHWM:'):
+                        process.gfam_max_rss = max(process.gfam_max_rss or 0, int(line.split()[1]))
+                        break
+        except OSError:
+            return
+        if stop.wait(interval):
+            return
+        interval = min(interval * 2, RSS_MAX_INTERVAL)
+
+def startProcess(command, stdout=None, timeout=None, threads=None, stdin=None):
+    """ Starts a child process under the limits of the current stage. Pair with waitProcess().
+
+    :param command: The command and its arguments.
+    :type command: list of str
+    :param stdout: Passed to subprocess.Popen(), e.g. subprocess.PIPE. Defaults to None.
+    :type stdout: int
+    :param timeout: Seconds before the child is killed. Defaults to None (the stage's timeout, if any).
+    :type timeout: float
+    :param threads: Number of CPUs the child may run on. Defaults to None (the stage's cap, if any).
+    :type threads: int
+    :param stdin: Passed to subprocess.Popen(), e.g. subprocess.PIPE. Defaults to None.
+    :type stdin: int
+
+    :rtype: subprocess.Popen
+    """
+
+    stage = _state['stage']
+    timeout = timeout if timeout is not None else _state['timeouts'].get(stage)
+    threads = threads if threads is not None else _state['threads'].get(stage)
+    stdout = stdout if stdout is not None else _state['stdout']
+    process = subprocess.Popen(command, stdin=stdin, stdout=stdout, preexec_fn=_capCPUs(threads))
+    process.gfam_started = time.perf_counter()
+    process.gfam_timed_out = False
+    process.gfam_timer = None
+    # Popen returns once the child has exec'd, so the sampler never sees the memory of the fork
+    process.gfam_max_rss = None
+    process.gfam_sampling = threading.Event()
+    process.gfam_sampler = threading.Thread(target=_sampleRSS, args=(process, process.gfam_sampling), daemon=True)
+    process.gfam_sampler.start()
+    if timeout is not None:
+        def kill():
+            process.gfam_timed_out = True
+            logging.error(f"{command[0]} ran for more than {timeout} s in stage {stage}, killing it.")
+            process.kill()
+        process.gfam_timer = threading.Timer(timeout, kill)
+        process.gfam_timer.daemon = True
+        process.gfam_timer.start()
+    return process
+
+def waitProcess(process, check=False):
+    """ Waits for a child started by startProcess() and records its resource usage in PROCESS_LOG.
+
+    :param process: Output of startProcess()
+    :type process: subprocess.Popen
+    :param check: Raises CalledProcessError on a non zero exit status. Defaults to False.
+    :type check: bool
+
+    :return: the exit status
+    :rtype: int
+    """
+
+    # the child is left unreaped until the sampler has stopped, so its pid cannot be reused in between
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    process.gfam_sampling.set()
+    process.gfam_sampler.join()
+    # wait4 reaps the child and returns the rusage of that child alone
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.gfam_timer is not None:
+        process.gfam_timer.cancel()
+    command = process.args
+    record = {
+        'command': os.path.basename(command[0]),
+        'stage': _state['stage'],
+        'exit_status': process.returncode,
+        'timed_out': process.gfam_timed_out,
+        'wall_s': time.perf_counter() - process.gfam_started,
+        'user_s': usage.ru_utime,
+        'sys_s': usage.ru_stime,
+        # sampled, see _sampleRSS(), None if the child exited before the first sample
+        'max_rss_mb': process.gfam_max_rss / 1024 if process.gfam_max_rss is not None else None,
+        'bytes_read': usage.ru_inblock * BLOCK_SIZE,
+        'bytes_written': usage.ru_oublock * BLOCK_SIZE
+    }
+    if _state['stage'] is not None:
+        PROCESS_LOG.append(record)
+    logging.debug(f"{record['command']} exited with {record['exit_status']} after {record['wall_s']:.2f} s.")
+    if process.gfam_timed_out:
+        raise subprocess.TimeoutExpired(command, time.perf_counter() - process.gfam_started)
+    if process.returncode != 0:
+        if check:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        logging.warning(f"{record['command']} exited with status {process.returncode}.")
+    return process.returncode
+
+def runProcess(command, capture=False, check=False, timeout=None, threads=None, on_output=None):
+    """ Runs a child process to completion under the limits of the current stage, recording its resource usage.
+
+    :param command: The command and its arguments.
+    :type command: list of str
+    :param capture: Returns the child's stdout. Defaults to False.
+    :type capture: bool
+    :param check: Raises CalledProcessError on a non zero exit status. Defaults to False.
+    :type check: bool
+    :param timeout: Seconds before the child is killed. Defaults to None (the stage's timeout, if any).
+    :type timeout: float
+    :param threads: Number of CPUs the child may run on. Defaults to None (the stage's cap, if any).
+    :type threads: int
+    :param on_output: Called with each line (bytes) of the child's stdout as it arrives, e.g. ffmpeg -progress pipe:1.
+        Defaults to None.
+    :type on_output: function
+
+    :return: the exit status and stdout (None unless captured)
+    :rtype: subprocess.CompletedProcess
+    """
+
+    piped = capture or on_output is not None
+    process = startProcess(command, stdout=subprocess.PIPE if piped else None, timeout=timeout, threads=threads)
+    output = None
+    try:
+        if on_output is not None:
+            lines = []
+            for line in process.stdout:
+                on_output(line)
+                if capture:
+                    lines.append(line)
+            output = b''.join(lines) if capture else None
+        elif capture:
+            output = process.stdout.read()
+    finally:
+        if piped:
+            process.stdout.close()
+        returncode = waitProcess(process, check=check)
+    return subprocess.CompletedProcess(command, returncode, stdout=output)
+
+def summarizeProcesses(records):
+    """ Aggregates the resource usage of several child processes.
+
+    :param records: Entries of PROCESS_LOG.
+    :type records: list of dict
+
+    :return: counts, total CPU time and block I/O, and the largest peak RSS, overall and per command
+    :rtype: dict
+    """
+
+    def total(group):
+        return {
+            'count': len(group),
+            'failed': sum(i['exit_status'] != 0 for i in group),
+            'timed_out': sum(i['timed_out'] for i in group),
+            'wall_s': sum(i['wall_s'] for i in group),
+            'user_s': sum(i['user_s'] for i in group),
+            'sys_s': sum(i['sys_s'] for i in group),
+            'max_rss_mb': max([i['max_rss_mb'] for i in group if i['max_rss_mb'] is not None], default=0.0),
+            'bytes_read': sum(i['bytes_read'] for i in group),
+            'bytes_written': sum(i['bytes_written'] for i in group)
+        }
+
+    summary = total(records)
+    summary['commands'] = {
+        command: total([i for i in records if i['command'] == command])
+        for command in sorted({i['command'] for i in records})
+    }
+    return summary
+
+def mergeProcessSummaries(summaries):
+    """ Combines outputs of summarizeProcesses(), e.g. the stages of a video or the videos of a batch.
+
+    :param summaries: Outputs of summarizeProcesses()
+    :type summaries: list of dict
+
+    :rtype: dict
+    """
+
+    def merge(group):
+        merged = {key: sum(i[key] for i in group) for key in ['count', 'failed', 'timed_out', 'wall_s', 'user_s', 'sys_s', 'bytes_read', 'bytes_written']}
+        merged['max_rss_mb'] = max([i['max_rss_mb'] for i in group], default=0.0)
+        return merged
+
+    merged = merge(summaries)
+    commands = sorted({command for i in summaries for command in i['commands']})
+    merged['commands'] = {
+        command: merge([i['commands'][command] for i in summaries if command in i['commands']])
+        for command in commands
+    }
+    return merged
@@ -0,0 +1,139 @@
+import json
+import logging
+import sys
+import threading
+import time
+
+from code.process_runner import currentStage
+
+# hot loops publish at most one event of each kind per interval
+MIN_INTERVAL = 0.5 # s
+
+_subscribers = []
+_lock = threading.Lock()
+_last_emitted = {}
+_stage_started = {}
+
+def subscribe(callback):
+    """ Registers a callback that receives every progress event as a dict.
+
+    Every event has 'event' and 'time' (UNIX time) keys. The events are:
+    - video_start: video
+    - stage_start: video, stage
+    - frames: stage, done, total, eta_s (throttled, total and eta_s may be None)
+    - stage_end: video, stage, wall_s, items, bytes_read, bytes_written
+    - video_end: video, wall_s, frames
+    - batch: done, total, eta_s (videos)
+
+    :param callback: Called with each event, from the thread that emitted it. It must return quickly.
+    :type callback: function
+    """
+
+    with _lock:
+        _subscribers.append(callback)
+
+def unsubscribe(callback):
+    """ Stops sending events to a callback registered with subscribe().
+
+    :param callback: The callback.
+    :type callback: function
+    """
+
+    with _lock:
+        if callback in _subscribers:
+            _subscribers.remove(callback)
+
+def hasSubscribers():
+    """ Returns whether any callback listens, so callers can skip building events nobody reads.
+
+    :rtype: bool
+    """
+
+    return bool(_subscribers)
+
+def emitProgress(event, throttle=False, **fields):
+    """ Sends an event to every subscriber.
+
+    :param event: Name of the event, e.g. 'stage_start'.
+    :type event: str
+    :param throttle: Drops the event if one with the same name and stage was sent less than MIN_INTERVAL ago.
+        Defaults to False.
+    :type throttle: bool
+    :param fields: Content of the event.
+    :type fields: dict
+    """
+
+    if not _subscribers:
+        return
+    now = time.monotonic()
+    if throttle:
+        key = (event, fields.get('stage'))
+        if now - _last_emitted.get(key, -MIN_INTERVAL) < MIN_INTERVAL:
+            return
+        _last_emitted[key] = now
+    if event == 'stage_start':
+        _stage_started[fields.get('stage')] = now
+    message = {'event': event, 'time': time.time()}
+    message.update(fields)
+    for callback in list(_subscribers):
+        try:
+            callback(message)
+        except Exception as e:
+            logging.warning(f"Progress callback failed: {e}")
+
+def reportFrames(done, total=None, stage=None):
+    """ Publishes how many frames a stage has handled, with its estimated remaining time. Throttled, except for the last
+    frame, so it can be called for every frame.
+
+    :param done: Frames handled so far.
+    :type done: int
+    :param total: Frames the stage will handle. Defaults to None (unknown).
+    :type total: int
+    :param stage: Name of the stage. Defaults to None (the stage being timed, see timeStage()).
+    :type stage: str
+    """
+
+    if not _subscribers:
+        return
+    stage = stage if stage is not None else currentStage()
+    finished = total is not None and done >= total
+    eta = None
+    started = _stage_started.get(stage)
+    if total is not None and started is not None and done > 0:
+        eta = (time.monotonic() - started) / done * max(total - done, 0)
+    emitProgress('frames', throttle=not finished, stage=stage, done=int(done), total=total, eta_s=eta)
+
+def ndjsonWriter(stream=None):
+    """ Returns a subscriber writing every event to a stream as one line of JSON.
+
+    :param stream: Text stream. Defaults to None (sys.stdout).
+    :type stream: file
+
+    :rtype: function
+    """
+
+    stream = stream if stream is not None else sys.stdout
+    lock = threading.Lock()
+
+    def write(message):
+        line = json.dumps(message, default=float)
+        with lock:
+            stream.write(line + '\n')
+            stream.flush()
+    return write
+
+def parseFFmpegProgress(total=None, offset=0):
+    """ Returns a line handler for ffmpeg -progress output that publishes the frame count with reportFrames().
+
+    :param total: Frames the stage will handle. Defaults to None (unknown).
+    :type total: int
+    :param offset: Frames handled before this ffmpeg call, e.g. by earlier chunks. Defaults to 0.
+    :type offset: int
+
+    :rtype: function
+    """
+
+    def handle(line):
+        if line.startswith(b'frame='):
+            reportFrames(offset + int(line[6:].strip() or 0), total)
+    return handle
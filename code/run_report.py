@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+from code.process_runner import PROCESS_LOG, mergeProcessSummaries, processStage, summarizeProcesses
+from code.progress_events import emitProgress
+from code.stage_profiling import profileStage
+
+RUN_REPORT_DIR = 'gfam_reports'
+BATCH_REPORT = 'batch.json'
+PROFILE_DIR = 'profiles'
+STAGES = ['telemetry', 'clean', 'extract', 'subsample', 'tag', 'cleanup']
+
+def newRunReport(input_video):
+    """ Starts an empty run report for one video.
+
+    :param input_video: Filepath to the target video.
+    :type input_video: str
+
+    :return: the report, filled in by timeStage()
+    :rtype: dict
+    """
+
+    return {
+        'video': input_video,
+        'video_bytes': os.path.getsize(input_video) if os.path.exists(input_video) else 0,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'stages': {}
+    }
+
+def _childCPU():
+    """ Returns the user and system CPU time (s) of every child process waited for so far.
+
+    :rtype: float
+    """
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+@contextmanager
+def timeStage(report, stage):
+    """ Records the wall time and CPU time of one pipeline stage in a run report.
+
+    CPU time covers both this process and the child processes (ffmpeg, node, exiftool) that finished during the stage.
+    Children started through runProcess() are attributed to the stage and their own usage is summarized under
+    'processes', and the stage is profiled when setStageProfiling() turned profiling on. The yielded dict can be given
+    'items' (frames or samples handled), 'bytes_read' and 'bytes_written', throughput is derived from them when the
+    stage ends. Timing the same stage again adds to it.
+
+    :param report: Output of newRunReport(), or None to record nothing.
+    :type report: dict
+    :param stage: Name of the stage, e.g. 'extract'.
+    :type stage: str
+
+    :return: yields the stage's counters
+    :rtype: dict
+    """
+
+    counters = {'items': 0, 'bytes_read': 0, 'bytes_written': 0}
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    child_cpu = _childCPU()
+    first_process = len(PROCESS_LOG)
+    video = report['video'] if report is not None else None
+    emitProgress('stage_start', video=video, stage=stage)
+    try:
+        with processStage(stage), profileStage(stage):
+            yield counters
+    finally:
+        processes = summarizeProcesses(PROCESS_LOG[first_process:])
+        del PROCESS_LOG[first_process:]
+        if report is not None:
+            entry = report['stages'].setdefault(stage, {
+                'wall_s': 0.0, 'cpu_s': 0.0, 'child_cpu_s': 0.0, 'items': 0, 'bytes_read': 0, 'bytes_written': 0
+            })
+            entry['wall_s'] += time.perf_counter() - wall
+            entry['cpu_s'] += time.process_time() - cpu
+            entry['child_cpu_s'] += _childCPU() - child_cpu
+            for key in ['items', 'bytes_read', 'bytes_written']:
+                entry[key] += int(counters[key])
+            entry['processes'] = mergeProcessSummaries([entry['processes'], processes]) if 'processes' in entry else processes
+            _addRates(entry)
+            logging.info(f"Stage {stage} took {entry['wall_s']:.1f} s ({entry['items']} items).")
+        emitProgress('stage_end', video=video, stage=stage, wall_s=time.perf_counter() - wall, items=int(counters['items']),
+                     bytes_read=int(counters['bytes_read']), bytes_written=int(counters['bytes_written']))
+
+def _addRates(entry):
+    """ Derives the throughput of a stage from its totals.
+
+    :param entry: Stage totals.
+    :type entry: dict
+    """
+
+    wall = entry['wall_s']
+    entry['items_per_s'] = entry['items'] / wall if wall > 0 else 0.0
+    entry['mb_per_s'] = (entry['bytes_read'] + entry['bytes_written']) / 1e6 / wall if wall > 0 else 0.0
+
+def fileBytes(paths):
+    """ Sums the size of the files that exist among paths.
+
+    :param paths: Filepaths.
+    :type paths: list of str
+
+    :rtype: int
+    """
+
+    return sum(os.path.getsize(i) for i in paths if i and os.path.isfile(i))
+
+def finishRunReport(report):
+    """ Adds the totals of a run report.
+
+    :param report: Output of newRunReport()
+    :type report: dict
+
+    :return: the report
+    :rtype: dict
+    """
+
+    stages = report['stages'].values()
+    report['wall_s'] = sum(i['wall_s'] for i in stages)
+    report['cpu_s'] = sum(i['cpu_s'] + i['child_cpu_s'] for i in stages)
+    report['frames'] = report['stages'].get('tag', report['stages'].get('extract', {})).get('items', 0)
+    report['frames_per_s'] = report['frames'] / report['wall_s'] if report['wall_s'] > 0 else 0.0
+    report['processes'] = mergeProcessSummaries([i['processes'] for i in stages])
+    return report
+
+def writeRunReport(report, report_json):
+    """ Writes a run report as JSON.
+
+    :param report: Output of finishRunReport() or rollupRunReports()
+    :type report: dict
+    :param report_json: Filepath to the output JSON.
+    :type report_json: str
+    """
+
+    os.makedirs(os.path.dirname(report_json), exist_ok=True)
+    with open(report_json, 'w') as json_file:
+        json.dump(report, json_file, indent=2)
+    logging.info(f"Run report written to {report_json}")
+
+def rollupRunReports(reports):
+    """ Sums the run reports of a batch per stage.
+
+    :param reports: Outputs of finishRunReport()
+    :type reports: list of dict
+
+    :return: the batch report, with the per video totals under 'videos'
+    :rtype: dict
+    """
+
+    stages = {}
+    for report in reports:
+        for stage, entry in report['stages'].items():
+            total = stages.setdefault(stage, {
+                'wall_s': 0.0, 'cpu_s': 0.0, 'child_cpu_s': 0.0, 'items': 0, 'bytes_read': 0, 'bytes_written': 0
+            })
+            for key in total:
+                total[key] += entry[key]
+    for stage, total in stages.items():
+        total['processes'] = mergeProcessSummaries([i['stages'][stage]['processes'] for i in reports if stage in i['stages']])
+        _addRates(total)
+    wall = sum(i['wall_s'] for i in reports)
+    frames = sum(i['frames'] for i in reports)
+    return {
+        'n_videos': len(reports),
+        'video_bytes': sum(i['video_bytes'] for i in reports),
+        'wall_s': wall,
+        'cpu_s': sum(i['cpu_s'] for i in reports),
+        'frames': frames,
+        'frames_per_s': frames / wall if wall > 0 else 0.0,
+        'processes': mergeProcessSummaries([i['processes'] for i in reports]),
+        'stages': {i: stages[i] for i in STAGES + sorted(set(stages) - set(STAGES)) if i in stages},
+        'videos': [{key: i[key] for key in ['video', 'wall_s', 'cpu_s', 'frames', 'frames_per_s']} for i in reports]
+    }
@@ -0,0 +1,102 @@
+import logging
+import os
+from contextlib import contextmanager
+
+TOP_ALLOCATIONS = 25
+
+_state = {'output_dir': None, 'cpu': False, 'memory': False}
+
+def setStageProfiling(output_dir=None, cpu=False, memory=False):
+    """ Turns profiling of the stages timed with timeStage() on or off.
+
+    :param output_dir: Folder for the profiles, e.g. one per video. Defaults to None (profiling off).
+    :type output_dir: str
+    :param cpu: Profiles every stage with cProfile into <stage>.pstats. Defaults to False.
+    :type cpu: bool
+    :param memory: Traces every stage's allocations with tracemalloc into <stage>.snapshot and a summary of the top
+        allocations in <stage>_memory.txt. Defaults to False.
+    :type memory: bool
+    """
+
+    _state['output_dir'] = output_dir
+    _state['cpu'] = cpu == True and output_dir is not None
+    _state['memory'] = memory == True and output_dir is not None
+
+@contextmanager
+def profileStage(stage):
+    """ Profiles the block as one stage when profiling is on, see setStageProfiling().
+
+    cProfile only sees the calling thread, tracemalloc sees every thread. Profiling the same stage again adds to its
+    .pstats file and replaces its memory snapshot.
+
+    :param stage: Name of the stage, e.g. 'extract'.
+    :type stage: str
+    """
+
+    if not _state['cpu'] and not _state['memory']:
+        yield
+        return
+
+    # only imported when asked for, so profiling costs nothing when it is off
+    os.makedirs(_state['output_dir'], exist_ok=True)
+    profiler = None
+    started_tracing = False
+    if _state['memory']:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+        tracemalloc.reset_peak()
+    if _state['cpu']:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        # the snapshot is taken first so it does not include the profile being written out
+        if _state['memory']:
+            _dumpAllocations(stage)
+            if started_tracing:
+                tracemalloc.stop()
+        if profiler is not None:
+            _dumpProfile(profiler, os.path.join(_state['output_dir'], stage + '.pstats'))
+
+def _dumpProfile(profiler, pstats_path):
+    """ Writes a cProfile profile, adding it to the profile already at pstats_path.
+
+    :param profiler: A disabled profiler.
+    :type profiler: cProfile.Profile
+    :param pstats_path: Filepath to the .pstats output.
+    :type pstats_path: str
+    """
+
+    import pstats
+    stats = pstats.Stats(profiler)
+    if os.path.exists(pstats_path):
+        stats.add(pstats_path)
+    stats.dump_stats(pstats_path)
+    logging.info(f"CPU profile written to {pstats_path}")
+
+def _dumpAllocations(stage):
+    """ Writes the tracemalloc snapshot of a stage and a summary of its largest allocations.
+
+    :param stage: Name of the stage.
+    :type stage: str
+    """
+
+    import tracemalloc
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot.dump(os.path.join(_state['output_dir'], stage + '.snapshot'))
+    memory_txt = os.path.join(_state['output_dir'], stage + '_memory.txt')
+    with open(memory_txt, 'w') as memory_file:
+        memory_file.write(f"stage: {stage}\ncurrent: {current / 1e6:.1f} MB\npeak: {peak / 1e6:.1f} MB\n\n")
+        for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+            memory_file.write(f"{stat}\n")
+    logging.info(f"Memory profile written to {memory_txt}")
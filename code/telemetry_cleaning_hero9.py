@@ -1,6 +1,12 @@
-import logging, os, subprocess
+import logging, os
 import pandas as pd
 
+from code.process_runner import runProcess
+
+# GPS fix is 0 (none), 2 (2D) or 3 (3D). DOP is reported by the camera x100.
+MAX_DOP = 5.0
+MIN_FIX = 3
+
 def nodeWrapperHERO9(input_video, output_gps=None, output_accl=None, output_gyro=None,
                        output_grav=None, output_iori=None, js_path=None):
     """Wrapper to call the JS script.
@@ -22,11 +28,37 @@ def nodeWrapperHERO9(input_video, output_gps=None, output_accl=None, output_gyro
         output_grav or '',
         output_iori or ''
     ]
-    subprocess.run(extract_telemetry)
+    runProcess(extract_telemetry)
 
 
-def cleanGPS(gps_csv, rescale_z=False, min_z=None, max_z=None):
-    """ Reformats the JS extraction outputs.
+def flagGPSQuality(gps_df, max_dop=MAX_DOP, min_fix=MIN_FIX):
+    """ Adds a dop column and a gps_ok mask marking samples with a usable fix.
+
+    :param gps_df: GPS data with the fix and precision columns from the JS extraction.
+    :type gps_df: pandas df
+    :param max_dop: Samples with a higher dilution of precision are flagged. Defaults to MAX_DOP.
+    :type max_dop: float
+    :param min_fix: Samples with a lower fix are flagged. Defaults to MIN_FIX.
+    :type min_fix: int
+
+    :return: Returns updated gps_df
+    :rtype: pandas df
+    """
+
+    gps_ok = pd.Series(True, index=gps_df.index)
+    if 'precision' in gps_df:
+        gps_df['dop'] = gps_df['precision'] / 100
+        gps_ok &= gps_df['dop'] <= max_dop
+    if 'fix' in gps_df:
+        gps_ok &= gps_df['fix'] >= min_fix
+    if 'precision' not in gps_df and 'fix' not in gps_df:
+        logging.warning("GPS stream has no fix or precision, all samples are assumed usable.")
+    gps_df['gps_ok'] = gps_ok
+    logging.info(f"{int((~gps_ok).sum())} of {len(gps_df)} GPS samples have a poor fix.")
+    return gps_df
+
+def cleanGPS(gps_csv, rescale_z=False, min_z=None, max_z=None, max_dop=MAX_DOP, min_fix=MIN_FIX):
+    """ Reformats the JS extraction outputs. Keeps the 2D and 3D speed channels (m/s) alongside lat, lon and elev.
 
     :param gps_csv: Filepath to the GPS output from nodeWrapper().
     :type input_gps: str
@@ -36,18 +68,24 @@ def cleanGPS(gps_csv, rescale_z=False, min_z=None, max_z=None):
     :type min_z: float
     :param max_z: The highest known elevation in the plot, used for rescaling. Defaults to None.
     :type max_z: float
+    :param max_dop: Samples with a higher dilution of precision are flagged in gps_ok. Defaults to MAX_DOP.
+    :type max_dop: float
+    :param min_fix: Samples with a lower fix are flagged in gps_ok. Defaults to MIN_FIX.
+    :type min_fix: int
     """
 
     gps_in = pd.read_csv(gps_csv)
-    gps_in['lat'] = 0.0
-    gps_in['lon'] = 0.0
-    gps_in['elev'] = 0.0
-    for index, row in gps_in.iterrows():
-        info = row['value'].split(',')
-        gps_in.loc[index, 'lat'] = float(info[0])
-        gps_in.loc[index, 'lon'] = float(info[1])
-        gps_in.loc[index, 'elev'] = float(info[2])
-    gps_out = gps_in.drop(columns='value')
+    # GPS5 samples are lat, lon, alt, 2D speed, 3D speed
+    values = gps_in['value'].str.split(',', expand=True).astype(float)
+    gps_in['lat'] = values[0]
+    gps_in['lon'] = values[1]
+    gps_in['elev'] = values[2]
+    if values.shape[1] >= 5:
+        gps_in['speed_2d'] = values[3]
+        gps_in['speed_3d'] = values[4]
+    else:
+        logging.warning("GPS stream has no speed channels.")
+    gps_out = flagGPSQuality(gps_in.drop(columns='value'), max_dop=max_dop, min_fix=min_fix)
     logging.debug("GPS stream cleaned.")
     if rescale_z == True:
         z_min = gps_out['elev'].min()
@@ -74,14 +112,10 @@ def cleanACCL(accl_csv):
     """
 
     accl_in = pd.read_csv(accl_csv)
-    accl_in['AY'] = 0
-    accl_in['AX'] = 0
-    accl_in['AZ'] = 0
-    for index, row in accl_in.iterrows():
-        info = row['value'].split(',')
-        accl_in.loc[index, 'AY'] = info[0]
-        accl_in.loc[index, 'AX'] = info[1]
-        accl_in.loc[index, 'AZ'] = info[2]
+    values = accl_in['value'].str.split(',', expand=True).astype(float)
+    accl_in['AY'] = values[0]
+    accl_in['AX'] = values[1]
+    accl_in['AZ'] = values[2]
     accl_out = accl_in.drop(columns='value')
     accl_out.to_csv(accl_csv, index=False)
     logging.debug('ACCL stream cleaned.')
@@ -94,15 +128,10 @@ def cleanGYRO(gyro_csv):
     """
 
     gyro_in = pd.read_csv(gyro_csv)
-    gyro_in['rY'] = 0
-    gyro_in['rX'] = 0
-    gyro_in['rZ'] = 0
-
-    for index, row in gyro_in.iterrows():
-        info = row['value'].split(',')
-        gyro_in.loc[index, 'rY'] = info[0]
-        gyro_in.loc[index, 'rX'] = info[1]
-        gyro_in.loc[index, 'rZ'] = info[2]
+    values = gyro_in['value'].str.split(',', expand=True).astype(float)
+    gyro_in['rY'] = values[0]
+    gyro_in['rX'] = values[1]
+    gyro_in['rZ'] = values[2]
     gyro_out = gyro_in.drop(columns='value')
     gyro_out.to_csv(gyro_csv, index=False)
     logging.debug("GYRO stream cleaned.")
@@ -115,17 +144,11 @@ def cleanIORI(iori_csv):
     """
     
     iori_in = pd.read_csv(iori_csv)
-    
-    iori_in['w'] = 0
-    iori_in['x'] = 0
-    iori_in['y'] = 0
-    iori_in['z'] = 0
-    for index, row in iori_in.iterrows():
-        info = row['value'].split(',')
-        iori_in.loc[index, 'w'] = info[0]
-        iori_in.loc[index, 'x'] = info[1]
-        iori_in.loc[index, 'y'] = info[2]
-        iori_in.loc[index, 'z'] = info[3]
+    values = iori_in['value'].str.split(',', expand=True).astype(float)
+    iori_in['w'] = values[0]
+    iori_in['x'] = values[1]
+    iori_in['y'] = values[2]
+    iori_in['z'] = values[3]
     iori_out = iori_in.drop(columns='value')
     iori_out.to_csv(iori_csv, index=False)
     logging.debug("IORI stream cleaned.")
@@ -137,20 +160,15 @@ def cleanGRAV(grav_csv):
     :type grav_csv: str
     """
     grav_in = pd.read_csv(grav_csv)
-    
-    grav_in['x'] = 0
-    grav_in['y'] = 0
-    grav_in['z'] = 0
-    for index, row in grav_in.iterrows():
-        info = row['value'].split(',')
-        grav_in.loc[index, 'y'] = info[0]
-        grav_in.loc[index, 'x'] = info[1]*-1
-        grav_in.loc[index, 'z'] = info[2]
+    values = grav_in['value'].str.split(',', expand=True).astype(float)
+    grav_in['x'] = values[1] * -1
+    grav_in['y'] = values[0]
+    grav_in['z'] = values[2]
     grav_out = grav_in.drop(columns='value')
     grav_out.to_csv(grav_csv, index=False)
     logging.debug("GRAV stream cleaned.")
 
-def cleanHERO9(telem_dir, rescale_z=False, min_z=None, max_z=None):
+def cleanHERO9(telem_dir, rescale_z=False, min_z=None, max_z=None, max_dop=MAX_DOP, min_fix=MIN_FIX):
     """ Wrapper function for cleaning HERO9 camera telemetry.
 
     :param telem_dir: Filepath to telemetry directory
@@ -161,11 +179,15 @@ def cleanHERO9(telem_dir, rescale_z=False, min_z=None, max_z=None):
     :type min_z: float
     :param max_z: The highest known elevation in the plot, used for rescaling. Defaults to None.
     :type max_z: float
+    :param max_dop: Samples with a higher dilution of precision are flagged in gps_ok. Defaults to MAX_DOP.
+    :type max_dop: float
+    :param min_fix: Samples with a lower fix are flagged in gps_ok. Defaults to MIN_FIX.
+    :type min_fix: int
     """
     for i in sorted(os.listdir(telem_dir)):
         input = os.path.join(telem_dir, i)
         if i.endswith('GPS.csv'):
-            cleanGPS(input, rescale_z=rescale_z, min_z=min_z, max_z=max_z)
+            cleanGPS(input, rescale_z=rescale_z, min_z=min_z, max_z=max_z, max_dop=max_dop, min_fix=min_fix)
         elif i.endswith('ACCL.csv'):
             cleanACCL(input)
         elif i.endswith('GYRO.csv'):
@@ -0,0 +1,332 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from code.run_report import BATCH_REPORT, RUN_REPORT_DIR
+
+WATCH_STATE = 'gfam_watch.json'
+VIDEO_EXTENSIONS = ('.MP4',)
+FINGERPRINT_BYTES = 1 << 20 # read from the start, middle and end of a video
+# a folder listed less than this after its modification time is listed again on the next scan, since a file added in
+# the same tick of a coarse (SMB, FAT) or cached (NFS) modification time would not change it
+MTIME_SLACK = 10 # s
+FULL_RESCAN_INTERVAL = 600 # s between two scans that list every folder whatever its modification time
+
+def videoFingerprint(video_path, chunk=FINGERPRINT_BYTES):
+    """ Identifies a video by its size and a hash of its start, middle and end, so a copy under another name or folder is
+    recognized without reading the whole file.
+
+    :param video_path: Filepath to the video.
+    :type video_path: str
+    :param chunk: Bytes read at each of the three places. Defaults to FINGERPRINT_BYTES.
+    :type chunk: int
+
+    :rtype: str
+    """
+
+    size = os.path.getsize(video_path)
+    digest = hashlib.sha256(str(size).encode('ascii'))
+    with open(video_path, 'rb') as video_file:
+        for offset in sorted({0, max(size // 2 - chunk // 2, 0), max(size - chunk, 0)}):
+            video_file.seek(offset)
+            digest.update(video_file.read(chunk))
+    return digest.hexdigest()
+
+def readWatchState(state_json):
+    """ Reads the videos a watch has seen, keyed by fingerprint.
+
+    :param state_json: Filepath to the state, e.g. <project_dir>/gfam_watch.json.
+    :type state_json: str
+
+    :return: {fingerprint: {'path', 'name', 'status', 'time', 'size', 'mtime_ns'}}, status is 'running', 'done' or
+        'failed'
+    :rtype: dict
+    """
+
+    if not os.path.exists(state_json):
+        return {}
+    with open(state_json) as json_file:
+        return json.load(json_file)
+
+def writeWatchState(state, state_json):
+    """ Writes the state of a watch, replacing the old file in one rename so a crash never leaves half of it.
+
+    :param state: Output of readWatchState()
+    :type state: dict
+    :param state_json: Filepath to the state.
+    :type state_json: str
+    """
+
+    tmp_json = state_json + '.tmp'
+    with open(tmp_json, 'w') as json_file:
+        json.dump(state, json_file, indent=2)
+    os.replace(tmp_json, state_json)
+
+def seedWatchState(state, project_dir):
+    """ Adds the videos of earlier runs without a watch to the state, from the input video recorded in their run
+    reports (gfam_reports/<video>.json), so a first watch over an existing project does not process them again.
+
+    :param state: Output of readWatchState(), updated in place.
+    :type state: dict
+    :param project_dir: Filepath to the project directory.
+    :type project_dir: str
+
+    :return: the number of videos added
+    :rtype: int
+    """
+
+    report_dir = os.path.join(project_dir, RUN_REPORT_DIR)
+    if not os.path.isdir(report_dir):
+        return 0
+    known_paths = {entry['path'] for entry in state.values()}
+    added = 0
+    for i in sorted(os.listdir(report_dir)):
+        report_json = os.path.join(report_dir, i)
+        if not i.endswith('.json') or i == BATCH_REPORT:
+            continue
+        try:
+            with open(report_json) as json_file:
+                video_path = json.load(json_file).get('video')
+        except (OSError, ValueError):
+            continue
+        # the video may have been moved since, it is then recognized by its fingerprint only if found again
+        if video_path is None or video_path in known_paths or not os.path.isfile(video_path):
+            continue
+        fingerprint = videoFingerprint(video_path)
+        if fingerprint in state:
+            continue
+        stat = os.stat(video_path)
+        state[fingerprint] = {
+            'path': video_path,
+            'name': os.path.splitext(i)[0],
+            'status': 'done',
+            'time': os.path.getmtime(report_json),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns
+        }
+        known_paths.add(video_path)
+        added += 1
+    return added
+
+def videoName(video_path, fingerprint, state, project_dir):
+    """ Returns the project name of a new video: its file name, unless another video already used that name (cameras
+    restart their numbering on every card), then the file name followed by the start of the fingerprint.
+
+    :param video_path: Filepath to the video.
+    :type video_path: str
+    :param fingerprint: Output of videoFingerprint()
+    :type fingerprint: str
+    :param state: Output of readWatchState()
+    :type state: dict
+    :param project_dir: Filepath to the project directory.
+    :type project_dir: str
+
+    :rtype: str
+    """
+
+    name = os.path.splitext(os.path.basename(video_path))[0]
+    taken = {entry['name'] for key, entry in state.items() if key != fingerprint}
+    if name in taken or os.path.exists(os.path.join(project_dir, name)):
+        name = f"{name}_{fingerprint[:8]}"
+    return name
+
+def _listDir(dir_path, recursive):
+    """ Lists the videos and, when recursive, the subfolders of a folder.
+
+    :rtype: list of str, list of str
+    """
+
+    videos = []
+    subdirs = []
+    try:
+        entries = list(os.scandir(dir_path))
+    except FileNotFoundError:
+        return videos, subdirs
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if recursive:
+                subdirs.append(entry.path)
+        elif entry.name.upper().endswith(VIDEO_EXTENSIONS):
+            videos.append(entry.path)
+    return videos, subdirs
+
+def scanChanges(dirs, recursive=False, full=False):
+    """ Lists only the folders whose modification time changed since the last scan, so a tick costs one stat per
+    folder rather than one per file. New files change their folder's modification time, growing ones do not and are
+    followed by pollPending(). A folder whose last listing was within MTIME_SLACK of its modification time is listed
+    again, as a file added just after that listing may not have changed it.
+
+    :param dirs: {folder: (modification time (ns), time.time() of its last listing), None if never listed}, updated in
+        place.
+    :type dirs: dict
+    :param recursive: Also watches the subfolders. Defaults to False.
+    :type recursive: bool
+    :param full: Lists every folder, e.g. every FULL_RESCAN_INTERVAL in case a modification time was missed.
+        Defaults to False.
+    :type full: bool
+
+    :return: the videos of the folders that were listed
+    :rtype: list of str
+    """
+
+    videos = []
+    todo = list(dirs)
+    while todo:
+        dir_path = todo.pop()
+        try:
+            mtime = os.stat(dir_path).st_mtime_ns
+        except FileNotFoundError:
+            del dirs[dir_path]
+            continue
+        last = dirs[dir_path]
+        if not full and last is not None and mtime == last[0] and last[1] - mtime / 1e9 >= MTIME_SLACK:
+            continue
+        dirs[dir_path] = (mtime, time.time())
+        new_videos, subdirs = _listDir(dir_path, recursive)
+        videos.extend(new_videos)
+        for subdir in subdirs:
+            if subdir not in dirs:
+                # listed in this scan too
+                dirs[subdir] = None
+                todo.append(subdir)
+    return videos
+
+def pollPending(pending, stable_time, now=None):
+    """ Returns the videos whose size and modification time have not changed for stable_time, i.e. that are completely
+    copied.
+
+    :param pending: {video: (size, mtime_ns, unchanged since)}, updated in place, stable videos are removed.
+    :type pending: dict
+    :param stable_time: Seconds a video must stay unchanged.
+    :type stable_time: float
+    :param now: Current time.monotonic(). Defaults to None (now).
+    :type now: float
+
+    :rtype: list of str
+    """
+
+    now = now if now is not None else time.monotonic()
+    stable = []
+    for video_path, (size, mtime, since) in list(pending.items()):
+        try:
+            stat = os.stat(video_path)
+        except FileNotFoundError:
+            del pending[video_path]
+            continue
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime) or stat.st_size == 0:
+            pending[video_path] = (stat.st_size, stat.st_mtime_ns, now)
+        elif now - since >= stable_time:
+            del pending[video_path]
+            stable.append(video_path)
+    return stable
+
+def watchFolder(input_dir, project_dir, process, poll_interval=10.0, stable_time=30.0, recursive=False, once=False, after_batch=None,
+                rescan_interval=FULL_RESCAN_INTERVAL, discard=None, retry_failed=False):
+    """ Processes every video that appears in a folder, once per fingerprint.
+
+    Videos are picked up once their size has been stable for stable_time, fingerprinted and skipped when a video with
+    the same fingerprint was processed or failed before. The state is kept in <project_dir>/gfam_watch.json, a video
+    that was running when the watch stopped is cleaned and processed again on the next start (failed ones too with
+    retry_failed), and the videos of earlier runs without a watch are added from their run reports (see
+    seedWatchState()).
+
+    :param input_dir: Filepath to the watched folder.
+    :type input_dir: str
+    :param project_dir: Filepath to the project directory.
+    :type project_dir: str
+    :param process: Called with (video_path, name) for every new video, raises on failure.
+    :type process: function
+    :param poll_interval: Seconds between two scans. Defaults to 10.
+    :type poll_interval: float
+    :param stable_time: Seconds a video's size must stay unchanged before it is processed. Defaults to 30.
+    :type stable_time: float
+    :param recursive: Also watches the subfolders. Defaults to False.
+    :type recursive: bool
+    :param once: Stops once every video present at the start has been handled. Defaults to False.
+    :type once: bool
+    :param after_batch: Called after every scan that processed at least one video. Defaults to None.
+    :type after_batch: function
+    :param rescan_interval: Seconds between two scans that list every folder, see scanChanges(). Defaults to
+        FULL_RESCAN_INTERVAL.
+    :type rescan_interval: float
+    :param discard: Called with (video_path, name) before a video that was interrupted or failed is processed again, to
+        remove what it wrote outside its project folder. Defaults to None.
+    :type discard: function
+    :param retry_failed: Processes the videos that failed in earlier watches again. Defaults to False.
+    :type retry_failed: bool
+    """
+
+    os.makedirs(project_dir, exist_ok=True)
+    state_json = os.path.join(project_dir, WATCH_STATE)
+    state = readWatchState(state_json)
+    for fingerprint, entry in list(state.items()):
+        if entry['status'] == 'running' or (retry_failed and entry['status'] == 'failed'):
+            # interrupted or failed, its project folder and outputs are half written
+            if entry['status'] == 'running':
+                logging.warning(f"{entry['path']} was interrupted, processing it again.")
+            else:
+                logging.info(f"{entry['path']} failed before, processing it again.")
+            if discard is not None:
+                discard(entry['path'], entry['name'])
+            shutil.rmtree(os.path.join(project_dir, entry['name']), ignore_errors=True)
+            del state[fingerprint]
+    seeded = seedWatchState(state, project_dir)
+    if seeded:
+        logging.info(f"Added {seeded} videos processed before the watch started.")
+        writeWatchState(state, state_json)
+    known_paths = {entry['path'] for entry in state.values()}
+    # (size, mtime) of the videos already fingerprinted, so unchanged files are not read again, even after a restart
+    handled = {entry['path']: (entry.get('size'), entry.get('mtime_ns')) for entry in state.values()}
+
+    dirs = {input_dir: None}
+    pending = {}
+    last_rescan = time.monotonic()
+    logging.info(f"Watching {input_dir} every {poll_interval} s.")
+    while True:
+        full = time.monotonic() - last_rescan >= rescan_interval
+        if full:
+            last_rescan = time.monotonic()
+        for video_path in scanChanges(dirs, recursive=recursive, full=full):
+            try:
+                stat = os.stat(video_path)
+            except FileNotFoundError:
+                continue
+            if video_path not in pending and handled.get(video_path) != (stat.st_size, stat.st_mtime_ns):
+                pending[video_path] = (stat.st_size, stat.st_mtime_ns, time.monotonic())
+        processed = 0
+        for video_path in pollPending(pending, stable_time):
+            stat = os.stat(video_path)
+            handled[video_path] = (stat.st_size, stat.st_mtime_ns)
+            fingerprint = videoFingerprint(video_path)
+            if fingerprint in state:
+                if video_path not in known_paths:
+                    logging.info(f"Skipping {video_path}, same video as {state[fingerprint]['path']} ({state[fingerprint]['status']}).")
+                continue
+            name = videoName(video_path, fingerprint, state, project_dir)
+            state[fingerprint] = {
+                'path': video_path,
+                'name': name,
+                'status': 'running',
+                'time': time.time(),
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns
+            }
+            writeWatchState(state, state_json)
+            try:
+                process(video_path, name)
+                state[fingerprint]['status'] = 'done'
+            except Exception as e:
+                logging.exception(f"Processing {video_path} failed: {e}")
+                state[fingerprint]['status'] = 'failed'
+            state[fingerprint]['time'] = time.time()
+            known_paths.add(video_path)
+            writeWatchState(state, state_json)
+            processed += 1
+        if processed and after_batch is not None:
+            after_batch()
+        if once and not pending:
+            break
+        time.sleep(poll_interval)
@@ -1,10 +1,172 @@
-import os, json, argparse, logging
+import os, sys, json, argparse, logging
 
-from code.frame_extraction import extractAllFrames, selectNthFrames
-from code.telemetry_cleaning_hero9 import cleanHERO9, nodeWrapperHERO9
-from code.apply_tags_hero9 import applyTags, cleanUpIntermediate
+# the pipeline modules pull in pandas and numpy, they are imported by the functions that use them so that --help,
+# settings checks and the GUI start without them
+from code.process_runner import setChildStdout, setStageLimits
+from code.progress_events import emitProgress, ndjsonWriter, subscribe
+from code.stage_profiling import setStageProfiling
+from code.run_report import BATCH_REPORT, PROFILE_DIR, RUN_REPORT_DIR, fileBytes, finishRunReport, newRunReport, rollupRunReports, timeStage, writeRunReport
 
-def processVideo(input_video, project_dir, settings):
+PIPELINE_MODULES = [
+    'code.frame_extraction', 'code.frame_manifest', 'code.frame_selection', 'code.telemetry_cleaning_hero9',
+    'code.apply_tags_hero9', 'code.frame_alignment', 'code.frame_deduplication', 'code.frame_streaming'
+]
+
+# keys every settings JSON must have, the others have defaults (see runPipeline())
+REQUIRED_SETTINGS = [
+    'input_vid', 'project_dir', 'nth_frame', 'js_path', 'rescale_z', 'min_z', 'max_z', 'ori', 'sfm', 'prefix',
+    'north_hem', 'west_hem', 'clean_up', 'config_file'
+]
+
+# accepted values of the settings that select an output mode, the first one is the default
+SETTING_CHOICES = {
+    'rc_output': ['xmp', 'flight_log'],
+    'p4d_output': ['exif', 'geolocation'],
+    'gps_quality': [None, 'skip', 'untag']
+}
+
+SFM_STREAMS = {
+    'P4D': ['ACCL', 'GYRO', 'IORI'],
+    'RC': ['GRAV']
+}
+
+def sfmTargets(sfm):
+    """ Normalizes the sfm setting, which can be a single target or a list of targets.
+
+    :param sfm: 'P4D', 'RC' or a list of them
+    :type sfm: str or list
+
+    :return: the targets, in the order given
+    :rtype: list of str
+    """
+
+    targets = [sfm] if isinstance(sfm, str) else list(dict.fromkeys(sfm))
+    for target in targets:
+        if target not in SFM_STREAMS:
+            raise ValueError(f"Unknown sfm target {target}, expected one of {list(SFM_STREAMS)}.")
+    return targets
+
+def settingChoice(data, key):
+    """ Returns a setting that selects between the modes listed in SETTING_CHOICES, or its default when it is missing.
+
+    :param data: Content of the JSON settings file.
+    :type data: dict
+    :param key: Name of the setting, e.g. 'rc_output'
+    :type key: str
+
+    :rtype: str
+    """
+
+    choices = SETTING_CHOICES[key]
+    value = data.get(key, choices[0])
+    if value not in choices:
+        raise ValueError(f"Unknown {key} {value!r}, expected one of {choices}.")
+    return value
+
+def preloadPipeline():
+    """ Imports the pipeline modules, and with them pandas and numpy, ahead of the first video, e.g. in a worker waiting
+    for jobs.
+    """
+
+    import importlib
+    for module in PIPELINE_MODULES:
+        importlib.import_module(module)
+
+def telemetryStreams(targets, ori, rc_output='xmp'):
+    """ Returns the union of telemetry streams needed by all targets.
+
+    :param targets: Output of sfmTargets()
+    :type targets: list of str
+    :param ori: Whether orientation data is exported.
+    :type ori: bool
+    :param rc_output: 'xmp' or 'flight_log', the flight log takes its orientation from GYRO. Defaults to 'xmp'.
+    :type rc_output: str
+
+    :return: the stream names, GPS is always included
+    :rtype: set of str
+    """
+
+    streams = {'GPS'}
+    if ori == True:
+        for target in targets:
+            streams.update(SFM_STREAMS[target])
+        if 'RC' in targets and rc_output == 'flight_log':
+            streams.add('GYRO')
+    return streams
+
+def streamVideo(input_video, project_dir, manifest, targets, settings, excluded=None, gps_csv=None, gyro_csv=None, grav_csv=None):
+    """ Streams the selected frames of a video, already tagged, straight into gfam_outputs.
+
+    Nothing is written to the project directory besides telemetry, finalizeVideo() only checks the streamed frames and
+    moves the telemetry.
+
+    :param input_video: Filepath to the target video
+    :type input_video: str
+    :param project_dir: Filepath to the video's project directory, gfam_outputs is its sibling
+    :type project_dir: str
+    :param manifest: Output of buildFrameManifest(), the paths and sizes of the written frames are recorded in it
+    :type manifest: pandas df
+    :param targets: Output of sfmTargets()
+    :type targets: list of str
+    :param settings: dictionary extracted from JSON settings file
+    :type settings: dictonary
+    :param excluded: (first, last) frame index ranges to drop. Defaults to None.
+    :type excluded: numpy.ndarray
+    :param gps_csv: Filepath to the cleaned GPS data. Defaults to None.
+    :type gps_csv: str
+    :param gyro_csv: Filepath to the cleaned GYRO data. Defaults to None.
+    :type gyro_csv: str
+    :param grav_csv: Filepath to the cleaned GRAV data. Defaults to None.
+    :type grav_csv: str
+
+    :return: the frame table, with absolute frame paths in the first output folder
+    :rtype: pandas df
+    """
+
+    from code.apply_tags_hero9 import finalFramePath, recordVideoOutputs
+    from code.frame_alignment import buildFrameTable
+    from code.frame_manifest import frameName, setFramePaths, shardName
+    from code.frame_streaming import streamTaggedFrames
+
+    project_dir = os.path.normpath(project_dir)
+    output_dir = os.path.join(os.path.dirname(project_dir), 'gfam_outputs')
+    video_name = os.path.basename(project_dir)
+    if len(targets) > 1:
+        image_dirs = [os.path.join(output_dir, target, 'images') for target in targets]
+    else:
+        image_dirs = [os.path.join(output_dir, 'images')]
+
+    selected = manifest.index[manifest['selected']]
+    names = [
+        finalFramePath(os.path.join(shardName(i, settings['shard_size']), frameName(i, prefix=settings['prefix'])), video_name)
+        for i in manifest.loc[selected, 'index']
+    ]
+    setFramePaths(manifest, selected, image_dirs[0], names)
+    recordVideoOutputs(project_dir, output_dir, images={image_dir: names for image_dir in image_dirs})
+    frame_table = buildFrameTable(None, gps_csv=gps_csv, gyro_csv=gyro_csv, grav_csv=grav_csv, manifest=manifest)
+
+    outputs = []
+    for target, image_dir in zip(targets, image_dirs):
+        outputs.append({
+            'dir': image_dir,
+            'gps': target != 'P4D' or settings['p4d_output'] == 'exif',
+            'p4d_ori': settings['ori'] == True and target == 'P4D' and settings['p4d_output'] == 'exif',
+            'rc_gravity': settings['ori'] == True and target == 'RC' and settings['rc_output'] == 'xmp'
+        })
+    sizes = streamTaggedFrames(
+        input_video,
+        frame_table.assign(frame=names),
+        outputs,
+        settings['nth_frame'],
+        excluded=excluded,
+        north_hem=settings['north_hem'],
+        west_hem=settings['west_hem'],
+        skip_poor_gps=settings['gps_quality'] == 'untag'
+    )
+    manifest.loc[selected, 'size'] = sizes
+    return frame_table
+
+def processVideo(input_video, project_dir, settings, report=None):
     """ Wrapper function to process a single video.
 
     :param input_video: Filepath to the target video
@@ -13,8 +175,18 @@ def processVideo(input_video, project_dir, settings):
     :type project_dir: str
     :param settings: dictionary extracted from JSON settings file
     :type settings: dictonary
+    :param report: Output of newRunReport(), the time spent in each stage is added to it. Defaults to None.
+    :type report: dict
     """
 
+    import numpy as np
+    from code.apply_tags_hero9 import applyTags, applyTagsForTargets, writeP4DGeolocation, writeRCFlightLog
+    from code.frame_alignment import FRAME_TABLE, buildFrameTable
+    from code.frame_extraction import extractAllFrames, extractFramePTS, extractFramesInChunks, extractSelectedFrames, selectNthFrames
+    from code.frame_manifest import FRAME_MANIFEST, buildFrameManifest, selectedFrames, updateFrameSizes, writeFrameManifest
+    from code.frame_selection import collapseStationaryFrames, findPoorFixIntervals, findStationaryIntervals, intervalsToFrames
+    from code.telemetry_cleaning_hero9 import cleanHERO9, nodeWrapperHERO9
+
     if os.path.exists(project_dir):
         if len(os.listdir(project_dir)) > 0:
             logging.error(f"Project {project_dir} already exists and is non empty.")
@@ -23,98 +195,228 @@ def processVideo(input_video, project_dir, settings):
     else:
         os.makedirs(project_dir)
     
-    frame_dir = os.path.join(project_dir, 'frames')
-    os.mkdir(frame_dir)
-    extractAllFrames(input_video, frame_dir, prefix=settings['prefix'])
-
-    subsample_dir = os.path.join(project_dir, f"subsample_{settings['nth_frame']}_frames")
-    os.mkdir(subsample_dir)
-    selectNthFrames(frame_dir, subsample_dir, settings['nth_frame'])
-
     telem_dir = os.path.join(project_dir, 'telem')
     os.mkdir(telem_dir)
 
-    if settings['sfm'] == 'P4D':
-        if settings['ori'] == True:
-            nodeWrapperHERO9(
-                input_video,
-                output_gps = os.path.join(telem_dir, 'GPS.csv'),
-                output_accl = os.path.join(telem_dir, 'ACCL.csv'),
-                output_gyro = os.path.join(telem_dir, 'GYRO.csv'),
-                output_iori = os.path.join(telem_dir, 'IORI.csv'),
-                js_path = settings['js_path']
-            )
-        else:
-            nodeWrapperHERO9(
-                input_video,
-                output_gps = os.path.join(telem_dir, 'GPS.csv'),
-                js_path = settings['js_path']
-            )
-    elif settings['sfm'] == 'RC':
-        if settings['ori'] == True:
-            nodeWrapperHERO9(
-                input_video,
-                output_gps = os.path.join(telem_dir, 'GPS.csv'),
-                output_grav = os.path.join(telem_dir, 'GRAV.csv'),
-                js_path = settings['js_path']
-            )
-        else:
-            nodeWrapperHERO9(
-                input_video,
-                output_gps = os.path.join(telem_dir, 'GPS.csv'),
-                js_path = settings['js_path']
+    targets = sfmTargets(settings['sfm'])
+    streams = telemetryStreams(targets, settings['ori'], rc_output=settings['rc_output'])
+    telem_csvs = [os.path.join(telem_dir, f'{stream}.csv') for stream in sorted(streams)]
+    with timeStage(report, 'telemetry') as stage:
+        nodeWrapperHERO9(
+            input_video,
+            output_gps = os.path.join(telem_dir, 'GPS.csv'),
+            output_accl = os.path.join(telem_dir, 'ACCL.csv') if 'ACCL' in streams else None,
+            output_gyro = os.path.join(telem_dir, 'GYRO.csv') if 'GYRO' in streams else None,
+            output_grav = os.path.join(telem_dir, 'GRAV.csv') if 'GRAV' in streams else None,
+            output_iori = os.path.join(telem_dir, 'IORI.csv') if 'IORI' in streams else None,
+            js_path = settings['js_path']
+        )
+        stage['items'] = len(streams)
+        stage['bytes_read'] = fileBytes([input_video])
+        stage['bytes_written'] = fileBytes(telem_csvs)
+
+    with timeStage(report, 'clean') as stage:
+        stage['bytes_read'] = fileBytes(telem_csvs)
+        cleanHERO9(
+            telem_dir,
+            rescale_z=settings['rescale_z'],
+            min_z=settings['min_z'],
+            max_z=settings['max_z'],
+            max_dop=settings['max_dop'],
+            min_fix=settings['min_fix']
+        )
+        stage['items'] = len(streams)
+        stage['bytes_written'] = fileBytes(telem_csvs)
+
+    manifest_csv = os.path.join(telem_dir, FRAME_MANIFEST)
+    with timeStage(report, 'subsample') as stage:
+        # exact frame timestamps replace the fps approximation for selection and tagging
+        frame_pts = extractFramePTS(input_video)
+        excluded = []
+        if settings['min_speed'] is not None:
+            stationary = findStationaryIntervals(
+                os.path.join(telem_dir, 'GPS.csv'),
+                settings['min_speed'],
+                min_duration=settings['min_stationary']
             )
+            excluded.append(collapseStationaryFrames(stationary, None, settings['nth_frame'], frame_pts=frame_pts))
+        if settings['gps_quality'] == 'skip':
+            excluded.append(intervalsToFrames(findPoorFixIntervals(os.path.join(telem_dir, 'GPS.csv')), None, frame_pts=frame_pts))
+        excluded = np.concatenate(excluded) if excluded else None
+        # later stages read the manifest rather than listing and parsing the frame directories
+        manifest = buildFrameManifest(frame_pts, settings['nth_frame'], excluded=excluded)
+        stage['items'] = int(manifest['selected'].sum())
 
-    cleanHERO9(telem_dir, rescale_z=settings['rescale_z'], min_z=settings['min_z'], max_z=settings['max_z'])
+    gps_csv = os.path.join(telem_dir, 'GPS.csv')
+    gyro_csv = os.path.join(telem_dir, 'GYRO.csv') if 'GYRO' in streams else None
+    grav_csv = os.path.join(telem_dir, 'GRAV.csv') if 'GRAV' in streams else None
 
-    if settings['sfm'] == 'P4D':
-        if settings['ori'] == True:
-            gyro_csv = os.path.join(telem_dir, 'GYRO.csv') if settings['ori'] else None
-            applyTags(
-                subsample_dir,
-                gps_csv=os.path.join(telem_dir, 'GPS.csv'),
-                ori_csv=gyro_csv,
-                sfm=settings['sfm'],
+    if settings['streaming'] == True:
+        # decoding, tagging and writing the outputs happen in one pass
+        with timeStage(report, 'extract') as stage:
+            frame_table = streamVideo(input_video, project_dir, manifest, targets, settings, excluded=excluded, gps_csv=gps_csv, gyro_csv=gyro_csv, grav_csv=grav_csv)
+            writeFrameManifest(manifest_csv, manifest, project_dir)
+            frame_table.to_csv(os.path.join(telem_dir, FRAME_TABLE), index=False)
+            stage['items'] = len(frame_pts)
+            stage['bytes_read'] = fileBytes([input_video])
+            stage['bytes_written'] = int(manifest['size'].sum()) * len(targets)
+    else:
+        subsample_dir = os.path.join(project_dir, f"subsample_{settings['nth_frame']}_frames")
+        os.mkdir(subsample_dir)
+        with timeStage(report, 'extract') as stage:
+            stage['items'] = len(frame_pts)
+            stage['bytes_read'] = fileBytes([input_video])
+            if excluded is not None:
+                # filtered frames are dropped from the selection before ffmpeg encodes anything
+                extractSelectedFrames(input_video, subsample_dir, settings['nth_frame'], excluded=excluded, prefix=settings['prefix'], manifest=manifest, shard_size=settings['shard_size'])
+            elif settings['scratch_budget_mb'] is not None:
+                frame_dir = os.path.join(project_dir, 'frames')
+                os.mkdir(frame_dir)
+                extractFramesInChunks(
+                    input_video,
+                    frame_dir,
+                    subsample_dir,
+                    manifest,
+                    settings['scratch_budget_mb'],
+                    prefix=settings['prefix'],
+                    shard_size=settings['shard_size']
+                )
+            else:
+                frame_dir = os.path.join(project_dir, 'frames')
+                os.mkdir(frame_dir)
+                extractAllFrames(input_video, frame_dir, prefix=settings['prefix'], manifest=manifest, shard_size=settings['shard_size'])
+            # frames on disk once extraction is done, unselected frames deleted by chunking are not counted
+            stage['bytes_written'] = fileBytes(manifest['path'])
+        if excluded is None and settings['scratch_budget_mb'] is None:
+            with timeStage(report, 'subsample'):
+                selectNthFrames(frame_dir, subsample_dir, settings['nth_frame'], manifest=manifest)
+        writeFrameManifest(manifest_csv, manifest, project_dir)
+
+    with timeStage(report, 'tag') as stage:
+        if settings['streaming'] != True:
+            stage['bytes_read'] = int(selectedFrames(manifest)['size'].sum())
+            # align frames and telemetry once, every output writer reads from this table
+            frame_table = buildFrameTable(subsample_dir, gps_csv=gps_csv, gyro_csv=gyro_csv, grav_csv=grav_csv, manifest=manifest)
+            frame_table.to_csv(os.path.join(telem_dir, FRAME_TABLE), index=False)
+
+            if targets == ['P4D'] and settings['p4d_output'] == 'geolocation':
+                logging.info("Writing a Pix4D geolocation file, frames are left untagged.")
+            elif len(targets) == 1:
+                if targets[0] == 'P4D':
+                    ori_csv = gyro_csv
+                else:
+                    ori_csv = grav_csv if settings['rc_output'] == 'xmp' else None
+                applyTags(
+                    subsample_dir,
+                    gps_csv=gps_csv,
+                    ori_csv=ori_csv,
+                    sfm=targets[0],
+                    north_hem=settings['north_hem'],
+                    west_hem=settings['west_hem'],
+                    config_file=settings['config_file'],
+                    skip_poor_gps=settings['gps_quality'] == 'untag',
+                    frame_table=frame_table
+                )
+            else:
+                applyTagsForTargets(
+                    frame_table,
+                    targets,
+                    ori=settings['ori'],
+                    north_hem=settings['north_hem'],
+                    west_hem=settings['west_hem'],
+                    config_file=settings['config_file'],
+                    skip_poor_gps=settings['gps_quality'] == 'untag',
+                    rc_output=settings['rc_output'],
+                    p4d_output=settings['p4d_output'],
+                    input_dir=subsample_dir
+                )
+        if 'P4D' in targets and settings['p4d_output'] == 'geolocation':
+            writeP4DGeolocation(
+                frame_table,
+                os.path.join(telem_dir, 'P4D_geolocation.csv'),
                 north_hem=settings['north_hem'],
                 west_hem=settings['west_hem'],
-                config_file=settings['config_file']
+                skip_poor_gps=settings['gps_quality'] == 'untag'
             )
-    elif settings['sfm'] == 'RC' and settings['ori'] == True:
-        grav_csv = os.path.join(telem_dir, 'GRAV.csv') if settings['ori'] else None
-        applyTags(
-        subsample_dir,
-        gps_csv=os.path.join(telem_dir, 'GPS.csv'),
-        ori_csv=grav_csv,
-        sfm=settings['sfm'],
-        north_hem=settings['north_hem'],
-        west_hem=settings['west_hem']
-        )
-    elif settings['sfm'] == 'RC' and settings['ori'] == False:
-        applyTags(
-        subsample_dir,
-        gps_csv=os.path.join(telem_dir, 'GPS.csv'),
-        north_hem=settings['north_hem'],
-        sfm=settings['sfm'],
-        west_hem=settings['west_hem']
-        )
-    else:
-        applyTags(
-        subsample_dir,
-        gps_csv=os.path.join(telem_dir, 'GPS.csv'),
-        north_hem=settings['north_hem'],
-        west_hem=settings['west_hem']
-        )
+        if 'RC' in targets and settings['rc_output'] == 'flight_log':
+            writeRCFlightLog(
+                frame_table,
+                os.path.join(telem_dir, 'RC_flight_log.csv'),
+                west_hem=settings['west_hem'],
+                skip_poor_gps=settings['gps_quality'] == 'untag'
+            )
+        # exiftool rewrites the frames, record their final sizes
+        updateFrameSizes(manifest)
+        writeFrameManifest(manifest_csv, manifest, project_dir)
+        stage['items'] = len(frame_table)
+        if settings['streaming'] != True:
+            stage['bytes_written'] = int(selectedFrames(manifest)['size'].sum())
     logging.info(f"Finished processing {input_video}.")
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-i', help='path to JSON settings', type=str)
-    args = parser.parse_args()
+def runVideo(input_video, project_dir, settings, output_dir, targets, report_dir):
+    """ Processes a single video, finalizes it when clean_up is set and writes its run report.
 
-    with open(args.i) as json_file:
-        data = json.load(json_file)
-    input_path = data['input_vid']
-    project_dir = data['project_dir']
+    :param input_video: Filepath to the target video
+    :type input_video: str
+    :param project_dir: Filepath to the video's project directory
+    :type project_dir: str
+    :param settings: dictionary extracted from JSON settings file
+    :type settings: dictonary
+    :param output_dir: Filepath to gfam_outputs
+    :type output_dir: str
+    :param targets: Output of sfmTargets()
+    :type targets: list of str
+    :param report_dir: Filepath to the folder of run reports
+    :type report_dir: str
+
+    :return: the video's run report
+    :rtype: dict
+    """
+
+    from code.apply_tags_hero9 import finalizeVideo
+
+    report = newRunReport(input_video)
+    video_name = os.path.basename(os.path.normpath(project_dir))
+    emitProgress('video_start', video=input_video)
+    if settings['profile'] == True or settings['trace_memory'] == True:
+        setStageProfiling(os.path.join(report_dir, PROFILE_DIR, video_name), cpu=settings['profile'], memory=settings['trace_memory'])
+    else:
+        setStageProfiling()
+    processVideo(input_video, project_dir, settings, report=report)
+    if settings['clean_up'] == True:
+        # finalize each video as soon as it is done, so its scratch space is freed before the next one
+        with timeStage(report, 'cleanup') as stage:
+            finalizeVideo(project_dir, output_dir, settings['nth_frame'], targets=targets if len(targets) > 1 else None)
+            stage['items'] = report['stages']['tag']['items']
+    writeRunReport(finishRunReport(report), os.path.join(report_dir, video_name + '.json'))
+    emitProgress('video_end', video=input_video, wall_s=report['wall_s'], frames=report['frames'])
+    return report
+
+def emitBatchProgress(reports, total):
+    """ Publishes how many videos of a batch are done, estimating the rest from the average time per video so far.
+
+    :param reports: Run reports of the videos done so far.
+    :type reports: list of dict
+    :param total: Number of videos in the batch.
+    :type total: int
+    """
+
+    wall = sum(report['wall_s'] for report in reports)
+    eta = wall / len(reports) * (total - len(reports)) if reports else None
+    emitProgress('batch', done=len(reports), total=total, eta_s=eta)
+
+def pipelineSettings(data, profile=False, trace_memory=False):
+    """ Builds the pipeline settings from a settings JSON, filling in the defaults of the optional keys.
+
+    :param data: Content of the JSON settings file.
+    :type data: dict
+    :param profile: Writes a cProfile .pstats file per stage. Defaults to False.
+    :type profile: bool
+    :param trace_memory: Writes a tracemalloc snapshot of the top allocations per stage. Defaults to False.
+    :type trace_memory: bool
+
+    :rtype: dict
+    """
 
     settings = {
         'nth_frame': data['nth_frame'],
@@ -128,15 +430,106 @@ if __name__ == "__main__":
         'north_hem': data['north_hem'],
         'west_hem': data['west_hem'],
         'clean_up': data['clean_up'],
-        'config_file': data['config_file']
+        'config_file': data['config_file'],
+        'min_speed': data.get('min_speed'),
+        'min_stationary': data.get('min_stationary', 2.0),
+        'rc_output': settingChoice(data, 'rc_output'),
+        'p4d_output': settingChoice(data, 'p4d_output'),
+        'gps_quality': settingChoice(data, 'gps_quality'),
+        'max_dop': data.get('max_dop', 5.0),
+        'min_fix': data.get('min_fix', 3),
+        'dedup': data.get('dedup', False),
+        'dedup_hamming': data.get('dedup_hamming', 4),
+        'dedup_radius': data.get('dedup_radius', 5.0),
+        'dedup_action': data.get('dedup_action', 'report'),
+        'shard_size': data.get('shard_size'),
+        'scratch_budget_mb': data.get('scratch_budget_mb'),
+        'streaming': data.get('streaming', False),
+        'stage_timeouts': data.get('stage_timeouts'),
+        'stage_threads': data.get('stage_threads'),
+        'profile': profile,
+        'trace_memory': trace_memory
     }
-
     if not settings['prefix'].endswith('_'):
         if settings['prefix'] == '':
             logging.info('No prefix provided.')
         else:
             logging.warning(f"Adding trailing underscore to prefix: {settings['prefix']}.")
             settings['prefix'] = settings['prefix']  + '_'
+    return settings
+
+def videoSettings(settings, video_name):
+    """ Returns the settings of one video of a run, its frames are prefixed with its name.
+
+    :param settings: Output of pipelineSettings()
+    :type settings: dict
+    :param video_name: Name of the video's project directory.
+    :type video_name: str
+
+    :rtype: dict
+    """
+
+    video_settings = settings.copy()
+    video_settings['prefix'] = f"{video_name}_{video_settings['prefix']}"
+    return video_settings
+
+def dedupOutputs(settings, targets, output_dir, cache=False):
+    """ Removes near duplicate frames from gfam_outputs when the settings ask for it.
+
+    :param settings: Output of pipelineSettings()
+    :type settings: dict
+    :param targets: Output of sfmTargets()
+    :type targets: list of str
+    :param output_dir: Filepath to gfam_outputs
+    :type output_dir: str
+    :param cache: Keeps the GPS tags and hashes of the frames in a dhash_cache.csv next to each images folder, so the
+        next call only reads the new frames. Defaults to False.
+    :type cache: bool
+    """
+
+    if settings['dedup'] != True:
+        return
+    if settings['clean_up'] != True:
+        logging.warning("Near-duplicate removal requires clean_up, skipping.")
+        return
+    from code.frame_deduplication import HASH_CACHE, removeNearDuplicates
+    if len(targets) > 1:
+        image_dirs = [os.path.join(output_dir, target, 'images') for target in targets]
+    else:
+        image_dirs = [os.path.join(output_dir, 'images')]
+    for image_dir in image_dirs:
+        removeNearDuplicates(
+            image_dir,
+            max_hamming=settings['dedup_hamming'],
+            radius=settings['dedup_radius'],
+            action=settings['dedup_action'],
+            cache_csv=os.path.join(os.path.dirname(image_dir), HASH_CACHE) if cache else None
+        )
+
+def runPipeline(data, profile=False, trace_memory=False):
+    """ Runs the pipeline on the video, or every video of the folder, given in the settings.
+
+    :param data: Content of the JSON settings file.
+    :type data: dict
+    :param profile: Writes a cProfile .pstats file per stage. Defaults to False.
+    :type profile: bool
+    :param trace_memory: Writes a tracemalloc snapshot of the top allocations per stage. Defaults to False.
+    :type trace_memory: bool
+
+    :return: the run report of every video
+    :rtype: list of dict
+    """
+
+    input_path = data['input_vid']
+    project_dir = data['project_dir']
+
+    settings = pipelineSettings(data, profile=profile, trace_memory=trace_memory)
+    setStageLimits(timeouts=settings['stage_timeouts'], threads=settings['stage_threads'])
+
+    targets = sfmTargets(settings['sfm'])
+    output_dir = os.path.join(project_dir, 'gfam_outputs')
+    report_dir = os.path.join(project_dir, RUN_REPORT_DIR)
+    reports = []
 
     if os.path.isdir(input_path):
         video_extensions = ('.MP4')
@@ -148,21 +541,112 @@ if __name__ == "__main__":
         if not video_files:
             logging.error(f"No compatible video files found in the specified directory {input_path}.")
         else:
+            emitBatchProgress(reports, len(video_files))
             for video_file in video_files:
                 video_name = os.path.splitext(os.path.basename(video_file))[0]
                 video_project_dir = os.path.join(project_dir, video_name)
                 logging.info(f"Processing video: {video_file} -> Project directory: {video_project_dir}")
-                video_settings = settings.copy()
-                video_settings['prefix'] = f"{video_name}_{video_settings['prefix']}"
-                
-                processVideo(video_file, video_project_dir, video_settings)
+                video_settings = videoSettings(settings, video_name)
+                reports.append(runVideo(video_file, video_project_dir, video_settings, output_dir, targets, report_dir))
+                emitBatchProgress(reports, len(video_files))
     else:
         video_name = os.path.splitext(os.path.basename(input_path))[0]
         video_project_dir = os.path.join(project_dir, video_name)
-        video_settings = settings.copy()
-        video_settings['prefix'] = f"{video_name}_{video_settings['prefix']}"
+        video_settings = videoSettings(settings, video_name)
         logging.info(f"Processing video: {input_path} -> Project directory: {video_project_dir}")
-        processVideo(input_path, video_project_dir, video_settings)
+        reports.append(runVideo(input_path, video_project_dir, video_settings, output_dir, targets, report_dir))
+        emitBatchProgress(reports, 1)
+    if reports:
+        writeRunReport(rollupRunReports(reports), os.path.join(report_dir, BATCH_REPORT))
 
-    if settings['clean_up'] == True:
-        cleanUpIntermediate(project_dir, settings['nth_frame'])
+    dedupOutputs(settings, targets, output_dir)
+    return reports
+
+def watchPipeline(data, poll_interval=10.0, stable_time=30.0, recursive=False, once=False, retry_failed=False, profile=False, trace_memory=False):
+    """ Watches the input folder of the settings and processes every new video into the project, see watchFolder().
+
+    Each video is finalized into the existing gfam_outputs when clean_up is set, and batch.json covers the videos
+    processed since the watch started.
+
+    :param data: Content of the JSON settings file, input_vid must be a folder.
+    :type data: dict
+    :param poll_interval: Seconds between two scans. Defaults to 10.
+    :type poll_interval: float
+    :param stable_time: Seconds a video's size must stay unchanged before it is processed. Defaults to 30.
+    :type stable_time: float
+    :param recursive: Also watches the subfolders. Defaults to False.
+    :type recursive: bool
+    :param once: Stops once every video present at the start has been handled. Defaults to False.
+    :type once: bool
+    :param retry_failed: Processes the videos that failed in earlier watches again. Defaults to False.
+    :type retry_failed: bool
+    :param profile: Writes a cProfile .pstats file per stage. Defaults to False.
+    :type profile: bool
+    :param trace_memory: Writes a tracemalloc snapshot of the top allocations per stage. Defaults to False.
+    :type trace_memory: bool
+    """
+
+    from code.apply_tags_hero9 import discardVideoOutputs
+    from code.watch_folder import watchFolder
+
+    input_dir = data['input_vid']
+    project_dir = data['project_dir']
+    if not os.path.isdir(input_dir):
+        raise ValueError(f"Watching needs a folder as input_vid, got {input_dir}.")
+    settings = pipelineSettings(data, profile=profile, trace_memory=trace_memory)
+    setStageLimits(timeouts=settings['stage_timeouts'], threads=settings['stage_threads'])
+    targets = sfmTargets(settings['sfm'])
+    output_dir = os.path.join(project_dir, 'gfam_outputs')
+    report_dir = os.path.join(project_dir, RUN_REPORT_DIR)
+    reports = []
+
+    def process(video_file, video_name):
+        video_project_dir = os.path.join(project_dir, video_name)
+        logging.info(f"Processing video: {video_file} -> Project directory: {video_project_dir}")
+        reports.append(runVideo(video_file, video_project_dir, videoSettings(settings, video_name), output_dir, targets, report_dir))
+
+    def discard(video_file, video_name):
+        # frames already finalized or streamed into gfam_outputs would be there twice once the video is processed again
+        removed = discardVideoOutputs(os.path.join(project_dir, video_name), output_dir)
+        if removed:
+            logging.info(f"Removed {removed} files {video_file} had placed in {output_dir}.")
+
+    def afterBatch():
+        if reports:
+            writeRunReport(rollupRunReports(reports), os.path.join(report_dir, BATCH_REPORT))
+        # every batch adds frames to the same folders, only the new ones are read and hashed
+        dedupOutputs(settings, targets, output_dir, cache=True)
+
+    watchFolder(input_dir, project_dir, process, poll_interval=poll_interval, stable_time=stable_time, recursive=recursive,
+                once=once, after_batch=afterBatch, discard=discard, retry_failed=retry_failed)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', help='path to JSON settings', type=str)
+    parser.add_argument('--log-level', help='logging level, e.g. DEBUG', type=str, default='INFO')
+    parser.add_argument('--profile', help='write a cProfile .pstats file per stage', action='store_true')
+    parser.add_argument('--trace-memory', help='write a tracemalloc snapshot of the top allocations per stage', action='store_true')
+    parser.add_argument('--progress', help='print progress events to stdout, one JSON object per line', choices=['ndjson'])
+    parser.add_argument('--watch', help='keep watching the input folder and process every new video', action='store_true')
+    parser.add_argument('--poll-interval', help='seconds between two scans of the watched folder', type=float, default=10.0)
+    parser.add_argument('--stable-time', help='seconds a video must stop growing before it is processed', type=float, default=30.0)
+    parser.add_argument('--recursive', help='also watch the subfolders of the input folder', action='store_true')
+    parser.add_argument('--once', help='with --watch, stop once the videos already there are processed', action='store_true')
+    parser.add_argument('--retry-failed', help='with --watch, process the videos that failed in earlier watches again', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(message)s')
+    if args.progress == 'ndjson':
+        # stdout only carries events, anything the children print goes to stderr
+        setChildStdout(sys.stderr)
+        subscribe(ndjsonWriter(sys.stdout))
+
+    with open(args.i) as json_file:
+        data = json.load(json_file)
+    if args.watch:
+        try:
+            watchPipeline(data, poll_interval=args.poll_interval, stable_time=args.stable_time, recursive=args.recursive,
+                          once=args.once, retry_failed=args.retry_failed, profile=args.profile, trace_memory=args.trace_memory)
+        except KeyboardInterrupt:
+            logging.info("Stopped watching.")
+    else:
+        runPipeline(data, profile=args.profile, trace_memory=args.trace_memory)
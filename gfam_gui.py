@@ -1,8 +1,20 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox
+from tkinter import filedialog, messagebox, ttk
+import copy
 import json
 import os
-import subprocess
+import signal
+
+from code.pipeline_worker import signalWorker, startWorker, stopWorker, submitJob, workerEvents
+
+POLL_MS = 100 # how often the window picks up the workers' events
+KILL_AFTER = 5000 # ms between asking a cancelled job to stop and killing it
+MAX_LOG_LINES = 5000
+
+# every job is a dict with id, name, data, status (queued, running, cancelling, done, failed, cancelled) and worker
+jobs = []
+# worker processes that run the jobs in process, they import the pipeline once and are reused, see startWorker()
+workers = []
 
 def select_input_file():
     path = filedialog.askopenfilename(title="Select video file")
@@ -64,6 +76,8 @@ def get_settings():
 
     data['ori'] = bool(ori_var.get())
     data['sfm'] = sfm_var.get()  # selected from dropdown
+    if '+' in data['sfm']:
+        data['sfm'] = data['sfm'].split('+')
     data['prefix'] = prefix_entry.get()
     data['config_file'] = config_entry.get()
     
@@ -89,22 +103,6 @@ def save_pipeline():
             json.dump(data, f, indent=4)
         messagebox.showinfo("Success", f"Pipeline saved to {save_path}")
 
-def run_pipeline():
-    data = get_settings()
-    if not data:
-        return
-    if not data['input_vid'] or not data['project_dir']:
-        messagebox.showerror("Error", "Please select both an input video/directory and an output project directory.")
-        return
-    temp_json = "temp_pipeline_settings.json"
-    with open(temp_json, "w") as f:
-        json.dump(data, f, indent=4)
-    try:
-        subprocess.run(["python", "gfam_exec.py", "-i", temp_json], check=True)
-        messagebox.showinfo("Success", "Pipeline executed successfully.")
-    except subprocess.CalledProcessError as e:
-        messagebox.showerror("Error", f"Pipeline execution failed: {e}")
-
 def load_pipeline():
     load_path = filedialog.askopenfilename(title="Load Pipeline JSON", filetypes=[("JSON files", "*.json")])
     if load_path:
@@ -141,7 +139,11 @@ def load_pipeline():
             max_z_entry.insert(0, str(data.get('max_z')))
         
         ori_var.set(1 if data.get('ori', False) else 0)
-        sfm_var.set(data.get('sfm', "P4D"))
+        sfm = data.get('sfm', "P4D")
+        if isinstance(sfm, list):
+            # a list of targets is saved by the "P4D+RC" choice, in any order
+            sfm = "P4D+RC" if sorted(set(sfm)) == ["P4D", "RC"] else '+'.join(sfm)
+        sfm_var.set(sfm)
         
         prefix_entry.delete(0, tk.END)
         prefix_entry.insert(0, data.get('prefix', ''))
@@ -157,105 +159,284 @@ def load_pipeline():
         
         messagebox.showinfo("Loaded", "Pipeline settings loaded successfully.")
 
-# Create the main window
-root = tk.Tk()
-root.title("GFAM Pipeline Editor")
-
-# Row 0: Input Video/Directory
-tk.Label(root, text="Input Video/Directory:").grid(row=0, column=0, sticky="e", padx=5, pady=5)
-input_entry = tk.Entry(root, width=50)
-input_entry.grid(row=0, column=1, columnspan=2, padx=5, pady=5)
-tk.Button(root, text="Select File", command=select_input_file).grid(row=0, column=3, padx=5, pady=5)
-tk.Button(root, text="Select Dir", command=select_input_dir).grid(row=0, column=4, padx=5, pady=5)
-tk.Label(root, text="Select the video file or directory to process.").grid(row=0, column=5, sticky="w", padx=5, pady=5)
-
-# Row 1: Output Project Directory
-tk.Label(root, text="Output Project Directory:").grid(row=1, column=0, sticky="e", padx=5, pady=5)
-output_entry = tk.Entry(root, width=50)
-output_entry.grid(row=1, column=1, columnspan=2, padx=5, pady=5)
-tk.Button(root, text="Select Dir", command=select_output_dir).grid(row=1, column=3, padx=5, pady=5)
-tk.Label(root, text="Directory where project files will be saved.").grid(row=1, column=5, sticky="w", padx=5, pady=5)
-
-# Row 2: nth_frame
-tk.Label(root, text="nth_frame:").grid(row=2, column=0, sticky="e", padx=5, pady=5)
-nth_frame_entry = tk.Entry(root)
-nth_frame_entry.grid(row=2, column=1, padx=5, pady=5)
-tk.Label(root, text="Process every nth frame (integer, e.g., 10).").grid(row=2, column=5, sticky="w", padx=5, pady=5)
-
-# Row 3: js_path selection (read-only with a file select button)
-tk.Label(root, text="js_path:").grid(row=3, column=0, sticky="e", padx=5, pady=5)
-js_entry = tk.Entry(root, width=50, state='readonly')
-js_entry.grid(row=3, column=1, columnspan=2, padx=5, pady=5)
-tk.Button(root, text="Select File", command=select_js_file).grid(row=3, column=3, padx=5, pady=5)
-tk.Label(root, text="Path to the JavaScript file to be used.").grid(row=3, column=5, sticky="w", padx=5, pady=5)
-
-# Row 4: Rescale Z checkbox
-rescale_z_var = tk.IntVar()
-tk.Label(root, text="Rescale Z:").grid(row=4, column=0, sticky="e", padx=5, pady=5)
-tk.Checkbutton(root, variable=rescale_z_var, command=toggle_rescale_z).grid(row=4, column=1, sticky="w", padx=5, pady=5)
-tk.Label(root, text="Enable rescaling of Z axis. When checked, min and max Z become editable.").grid(row=4, column=5, sticky="w", padx=5, pady=5)
-
-# Row 5: min_z
-tk.Label(root, text="min_z (empty for default):").grid(row=5, column=0, sticky="e", padx=5, pady=5)
-min_z_entry = tk.Entry(root)
-min_z_entry.grid(row=5, column=1, padx=5, pady=5)
-tk.Label(root, text="Set minimum Z value if rescaling is enabled.").grid(row=5, column=5, sticky="w", padx=5, pady=5)
-
-# Row 6: max_z
-tk.Label(root, text="max_z (empty for default):").grid(row=6, column=0, sticky="e", padx=5, pady=5)
-max_z_entry = tk.Entry(root)
-max_z_entry.grid(row=6, column=1, padx=5, pady=5)
-tk.Label(root, text="Set maximum Z value if rescaling is enabled.").grid(row=6, column=5, sticky="w", padx=5, pady=5)
-
-# Row 7: Orientation checkbox
-ori_var = tk.IntVar()
-tk.Label(root, text="Use orientation:").grid(row=7, column=0, sticky="e", padx=5, pady=5)
-tk.Checkbutton(root, variable=ori_var).grid(row=7, column=1, sticky="w", padx=5, pady=5)
-tk.Label(root, text="Toggle export of orientation data (IMU for P4D, gravity vector for RC).").grid(row=7, column=5, sticky="w", padx=5, pady=5)
-
-# Row 8: SFM dropdown (OptionMenu)
-tk.Label(root, text="SFM:").grid(row=8, column=0, sticky="e", padx=5, pady=5)
-sfm_var = tk.StringVar(root)
-sfm_var.set("P4D")  # default value
-sfm_options = ["P4D", "RC"]
-sfm_menu = tk.OptionMenu(root, sfm_var, *sfm_options)
-sfm_menu.grid(row=8, column=1, padx=5, pady=5, sticky="w")
-tk.Label(root, text="Select SFM (Structure-from-Motion) method.").grid(row=8, column=5, sticky="w", padx=5, pady=5)
-
-# Row 9: Prefix
-tk.Label(root, text="Prefix:").grid(row=9, column=0, sticky="e", padx=5, pady=5)
-prefix_entry = tk.Entry(root)
-prefix_entry.grid(row=9, column=1, padx=5, pady=5)
-tk.Label(root, text="Optional prefix for naming outputs.").grid(row=9, column=5, sticky="w", padx=5, pady=5)
-
-# Row 10: Config file selection
-tk.Label(root, text="Config File:").grid(row=10, column=0, sticky="e", padx=5, pady=5)
-config_entry = tk.Entry(root, width=50)
-config_entry.grid(row=10, column=1, columnspan=2, padx=5, pady=5)
-tk.Button(root, text="Select File", command=select_config_file).grid(row=10, column=3, padx=5, pady=5)
-tk.Label(root, text="Select a configuration file for custom EXIF tags (i.e. Pix4D).").grid(row=10, column=5, sticky="w", padx=5, pady=5)
-
-# Row 11: Clean up checkbox
-clean_up_var = tk.IntVar()
-tk.Label(root, text="Clean up:").grid(row=11, column=0, sticky="e", padx=5, pady=5)
-tk.Checkbutton(root, variable=clean_up_var).grid(row=11, column=1, sticky="w", padx=5, pady=5)
-tk.Label(root, text="Remove temporary files after processing.").grid(row=11, column=5, sticky="w", padx=5, pady=5)
-
-# Row 12: Northern Hemisphere and Western Hemisphere checkboxes
-north_hem_var = tk.IntVar(value=1)
-west_hem_var = tk.IntVar(value=1)
-tk.Label(root, text="Hemisphere Settings:").grid(row=12, column=0, sticky="e", padx=5, pady=5)
-tk.Checkbutton(root, text="Northern Hemisphere", variable=north_hem_var).grid(row=12, column=1, sticky="w", padx=5, pady=5)
-tk.Checkbutton(root, text="Western Hemisphere", variable=west_hem_var).grid(row=12, column=2, sticky="w", padx=5, pady=5)
-tk.Label(root, text="Check to set hemisphere parameters. Leave unchecked for other hemisphere.").grid(row=12, column=5, sticky="w", padx=5, pady=5)
-
-# Row 13: Buttons for Load, Save Pipeline and Run Pipeline
-tk.Button(root, text="Load Pipeline", command=load_pipeline).grid(row=13, column=0, pady=10)
-tk.Button(root, text="Save Pipeline", command=save_pipeline).grid(row=13, column=1, pady=10)
-tk.Button(root, text="Run Pipeline", command=run_pipeline).grid(row=13, column=2, pady=10)
-tk.Label(root, text="Use these buttons to load, save, or run the pipeline.").grid(row=13, column=5, sticky="w", padx=5, pady=10)
-
-# Initialize rescale Z entries as disabled if not checked
-toggle_rescale_z()
-
-root.mainloop()
+def run_pipeline():
+    """ Queues the current settings as a job, it starts as soon as fewer than the concurrency limit are running. """
+    data = get_settings()
+    if not data:
+        return
+    if not data['input_vid'] or not data['project_dir']:
+        messagebox.showerror("Error", "Please select both an input video/directory and an output project directory.")
+        return
+    job = {
+        'id': len(jobs),
+        'name': os.path.basename(os.path.normpath(data['input_vid'])),
+        # queued jobs must not see later edits
+        'data': copy.deepcopy(data),
+        'status': 'queued',
+        'worker': None,
+        'detail': ''
+    }
+    jobs.append(job)
+    jobs_list.insert(tk.END, '')
+    update_job(job)
+    start_queued_jobs()
+
+def concurrency_limit():
+    try:
+        return max(int(concurrency_entry.get()), 1)
+    except ValueError:
+        return 1
+
+def start_queued_jobs():
+    for job in jobs:
+        if job['status'] != 'queued':
+            continue
+        idle = [worker for worker in workers if worker['job'] is None]
+        if idle:
+            worker = idle[0]
+        elif len(workers) < concurrency_limit():
+            worker = startWorker()
+            workers.append(worker)
+        else:
+            break
+        submitJob(worker, job['id'], job['data'])
+        job['worker'] = worker
+        job['status'] = 'running'
+        update_job(job)
+    # workers beyond a lowered limit are not kept warm
+    idle = [worker for worker in workers if worker['job'] is None]
+    while idle and len(workers) > concurrency_limit():
+        worker = idle.pop()
+        stopWorker(worker)
+        workers.remove(worker)
+
+def cancel_job(job):
+    if job['status'] == 'queued':
+        job['status'] = 'cancelled'
+        update_job(job)
+    elif job['status'] == 'running':
+        # the worker and its children go down with the job, the next job gets a fresh worker
+        job['status'] = 'cancelling'
+        update_job(job)
+        signalWorker(job['worker'], signal.SIGTERM)
+        root.after(KILL_AFTER, signalWorker, job['worker'], signal.SIGKILL)
+
+def cancel_selected():
+    selection = jobs_list.curselection()
+    if not selection:
+        messagebox.showinfo("Cancel", "Select a job to cancel.")
+        return
+    cancel_job(jobs[selection[0]])
+
+def update_job(job):
+    text = f"#{job['id']} {job['name']}: {job['status']}"
+    if job['detail'] and job['status'] in ('running', 'cancelling'):
+        text += f" ({job['detail']})"
+    jobs_list.delete(job['id'])
+    jobs_list.insert(job['id'], text)
+
+def append_log(job, line):
+    log_text.config(state='normal')
+    log_text.insert(tk.END, f"[#{job['id']}] {line}\n")
+    lines = int(log_text.index('end-1c').split('.')[0])
+    if lines > MAX_LOG_LINES:
+        log_text.delete('1.0', f"{lines - MAX_LOG_LINES}.0")
+    log_text.see(tk.END)
+    log_text.config(state='disabled')
+
+def format_eta(eta_s):
+    if eta_s is None:
+        return ""
+    minutes, seconds = divmod(int(eta_s), 60)
+    return f", ETA {minutes // 60}:{minutes % 60:02d}:{seconds:02d}"
+
+def handle_progress(job, event):
+    kind = event['event']
+    if kind == 'stage_start':
+        job['detail'] = f"{os.path.basename(event['video'] or '')} {event['stage']}"
+        progress_var.set(0)
+        progress_label.config(text=f"#{job['id']} {job['detail']}")
+    elif kind == 'frames':
+        total = event['total']
+        job['detail'] = f"{event['stage']} {event['done']}/{total if total else '?'}{format_eta(event['eta_s'])}"
+        if total:
+            progress_var.set(100 * event['done'] / total)
+        progress_label.config(text=f"#{job['id']} {job['detail']}")
+    elif kind == 'stage_end':
+        append_log(job, f"{event['stage']} took {event['wall_s']:.1f} s ({event['items']} items)")
+    elif kind == 'batch':
+        append_log(job, f"{event['done']}/{event['total']} videos done{format_eta(event['eta_s'])}")
+    update_job(job)
+
+def finish_job(job, status):
+    job['status'] = status
+    append_log(job, f"Pipeline {status}.")
+    update_job(job)
+
+def poll_worker_events():
+    """ Applies the workers' events to the widgets, from the Tk thread. """
+    for worker in list(workers):
+        for kind, job_id, payload in workerEvents(worker):
+            job = jobs[job_id] if job_id is not None else None
+            if kind == 'log' and job is not None:
+                append_log(job, payload)
+            elif kind == 'progress' and job is not None:
+                handle_progress(job, payload)
+            elif kind == 'exit':
+                finish_job(job, 'cancelled' if job['status'] == 'cancelling' else ('done' if payload == 0 else 'failed'))
+        if not worker['process'].is_alive():
+            # killed by a cancel, or crashed
+            workers.remove(worker)
+            job = jobs[worker['job']] if worker['job'] is not None else None
+            if job is not None and job['status'] in ('running', 'cancelling'):
+                finish_job(job, 'cancelled' if job['status'] == 'cancelling' else 'failed')
+    start_queued_jobs()
+    root.after(POLL_MS, poll_worker_events)
+
+def on_close():
+    active = [job for job in jobs if job['status'] in ('queued', 'running', 'cancelling')]
+    if active:
+        if not messagebox.askyesno("Quit", f"{len(active)} job(s) still queued or running. Cancel them and quit?"):
+            return
+    # workers of cancelled jobs may have exited already, children that ignored SIGTERM are left in their group
+    cancelled = [job['worker'] for job in jobs if job['worker'] is not None and job['status'] in ('cancelling', 'cancelled')]
+    for worker in workers + [worker for worker in cancelled if worker not in workers]:
+        signalWorker(worker, signal.SIGKILL)
+    root.destroy()
+
+# spawned workers import this module too, they must not open a window
+if __name__ == "__main__":
+    # Create the main window
+    root = tk.Tk()
+    root.title("GFAM Pipeline Editor")
+
+    # Row 0: Input Video/Directory
+    tk.Label(root, text="Input Video/Directory:").grid(row=0, column=0, sticky="e", padx=5, pady=5)
+    input_entry = tk.Entry(root, width=50)
+    input_entry.grid(row=0, column=1, columnspan=2, padx=5, pady=5)
+    tk.Button(root, text="Select File", command=select_input_file).grid(row=0, column=3, padx=5, pady=5)
+    tk.Button(root, text="Select Dir", command=select_input_dir).grid(row=0, column=4, padx=5, pady=5)
+    tk.Label(root, text="Select the video file or directory to process.").grid(row=0, column=5, sticky="w", padx=5, pady=5)
+
+    # Row 1: Output Project Directory
+    tk.Label(root, text="Output Project Directory:").grid(row=1, column=0, sticky="e", padx=5, pady=5)
+    output_entry = tk.Entry(root, width=50)
+    output_entry.grid(row=1, column=1, columnspan=2, padx=5, pady=5)
+    tk.Button(root, text="Select Dir", command=select_output_dir).grid(row=1, column=3, padx=5, pady=5)
+    tk.Label(root, text="Directory where project files will be saved.").grid(row=1, column=5, sticky="w", padx=5, pady=5)
+
+    # Row 2: nth_frame
+    tk.Label(root, text="nth_frame:").grid(row=2, column=0, sticky="e", padx=5, pady=5)
+    nth_frame_entry = tk.Entry(root)
+    nth_frame_entry.grid(row=2, column=1, padx=5, pady=5)
+    tk.Label(root, text="Process every nth frame (integer, e.g., 10).").grid(row=2, column=5, sticky="w", padx=5, pady=5)
+
+    # Row 3: js_path selection (read-only with a file select button)
+    tk.Label(root, text="js_path:").grid(row=3, column=0, sticky="e", padx=5, pady=5)
+    js_entry = tk.Entry(root, width=50, state='readonly')
+    js_entry.grid(row=3, column=1, columnspan=2, padx=5, pady=5)
+    tk.Button(root, text="Select File", command=select_js_file).grid(row=3, column=3, padx=5, pady=5)
+    tk.Label(root, text="Path to the JavaScript file to be used.").grid(row=3, column=5, sticky="w", padx=5, pady=5)
+
+    # Row 4: Rescale Z checkbox
+    rescale_z_var = tk.IntVar()
+    tk.Label(root, text="Rescale Z:").grid(row=4, column=0, sticky="e", padx=5, pady=5)
+    tk.Checkbutton(root, variable=rescale_z_var, command=toggle_rescale_z).grid(row=4, column=1, sticky="w", padx=5, pady=5)
+    tk.Label(root, text="Enable rescaling of Z axis. When checked, min and max Z become editable.").grid(row=4, column=5, sticky="w", padx=5, pady=5)
+
+    # Row 5: min_z
+    tk.Label(root, text="min_z (empty for default):").grid(row=5, column=0, sticky="e", padx=5, pady=5)
+    min_z_entry = tk.Entry(root)
+    min_z_entry.grid(row=5, column=1, padx=5, pady=5)
+    tk.Label(root, text="Set minimum Z value if rescaling is enabled.").grid(row=5, column=5, sticky="w", padx=5, pady=5)
+
+    # Row 6: max_z
+    tk.Label(root, text="max_z (empty for default):").grid(row=6, column=0, sticky="e", padx=5, pady=5)
+    max_z_entry = tk.Entry(root)
+    max_z_entry.grid(row=6, column=1, padx=5, pady=5)
+    tk.Label(root, text="Set maximum Z value if rescaling is enabled.").grid(row=6, column=5, sticky="w", padx=5, pady=5)
+
+    # Row 7: Orientation checkbox
+    ori_var = tk.IntVar()
+    tk.Label(root, text="Use orientation:").grid(row=7, column=0, sticky="e", padx=5, pady=5)
+    tk.Checkbutton(root, variable=ori_var).grid(row=7, column=1, sticky="w", padx=5, pady=5)
+    tk.Label(root, text="Toggle export of orientation data (IMU for P4D, gravity vector for RC).").grid(row=7, column=5, sticky="w", padx=5, pady=5)
+
+    # Row 8: SFM dropdown (OptionMenu)
+    tk.Label(root, text="SFM:").grid(row=8, column=0, sticky="e", padx=5, pady=5)
+    sfm_var = tk.StringVar(root)
+    sfm_var.set("P4D")  # default value
+    sfm_options = ["P4D", "RC", "P4D+RC"]
+    sfm_menu = tk.OptionMenu(root, sfm_var, *sfm_options)
+    sfm_menu.grid(row=8, column=1, padx=5, pady=5, sticky="w")
+    tk.Label(root, text="Select SFM (Structure-from-Motion) method. P4D+RC writes both from one run.").grid(row=8, column=5, sticky="w", padx=5, pady=5)
+
+    # Row 9: Prefix
+    tk.Label(root, text="Prefix:").grid(row=9, column=0, sticky="e", padx=5, pady=5)
+    prefix_entry = tk.Entry(root)
+    prefix_entry.grid(row=9, column=1, padx=5, pady=5)
+    tk.Label(root, text="Optional prefix for naming outputs.").grid(row=9, column=5, sticky="w", padx=5, pady=5)
+
+    # Row 10: Config file selection
+    tk.Label(root, text="Config File:").grid(row=10, column=0, sticky="e", padx=5, pady=5)
+    config_entry = tk.Entry(root, width=50)
+    config_entry.grid(row=10, column=1, columnspan=2, padx=5, pady=5)
+    tk.Button(root, text="Select File", command=select_config_file).grid(row=10, column=3, padx=5, pady=5)
+    tk.Label(root, text="Select a configuration file for custom EXIF tags (i.e. Pix4D).").grid(row=10, column=5, sticky="w", padx=5, pady=5)
+
+    # Row 11: Clean up checkbox
+    clean_up_var = tk.IntVar()
+    tk.Label(root, text="Clean up:").grid(row=11, column=0, sticky="e", padx=5, pady=5)
+    tk.Checkbutton(root, variable=clean_up_var).grid(row=11, column=1, sticky="w", padx=5, pady=5)
+    tk.Label(root, text="Remove temporary files after processing.").grid(row=11, column=5, sticky="w", padx=5, pady=5)
+
+    # Row 12: Northern Hemisphere and Western Hemisphere checkboxes
+    north_hem_var = tk.IntVar(value=1)
+    west_hem_var = tk.IntVar(value=1)
+    tk.Label(root, text="Hemisphere Settings:").grid(row=12, column=0, sticky="e", padx=5, pady=5)
+    tk.Checkbutton(root, text="Northern Hemisphere", variable=north_hem_var).grid(row=12, column=1, sticky="w", padx=5, pady=5)
+    tk.Checkbutton(root, text="Western Hemisphere", variable=west_hem_var).grid(row=12, column=2, sticky="w", padx=5, pady=5)
+    tk.Label(root, text="Check to set hemisphere parameters. Leave unchecked for other hemisphere.").grid(row=12, column=5, sticky="w", padx=5, pady=5)
+
+    # Row 13: Buttons for Load, Save Pipeline and Run Pipeline
+    tk.Button(root, text="Load Pipeline", command=load_pipeline).grid(row=13, column=0, pady=10)
+    tk.Button(root, text="Save Pipeline", command=save_pipeline).grid(row=13, column=1, pady=10)
+    tk.Button(root, text="Run Pipeline", command=run_pipeline).grid(row=13, column=2, pady=10)
+    tk.Button(root, text="Cancel Job", command=cancel_selected).grid(row=13, column=3, pady=10)
+    tk.Label(root, text="Use these buttons to load, save, or queue the pipeline, or cancel the selected job.").grid(row=13, column=5, sticky="w", padx=5, pady=10)
+
+    # Row 14: Concurrency limit
+    tk.Label(root, text="Concurrent jobs:").grid(row=14, column=0, sticky="e", padx=5, pady=5)
+    concurrency_entry = tk.Spinbox(root, from_=1, to=16, width=5)
+    concurrency_entry.grid(row=14, column=1, sticky="w", padx=5, pady=5)
+    tk.Label(root, text="How many queued pipelines run at the same time.").grid(row=14, column=5, sticky="w", padx=5, pady=5)
+
+    # Row 15: Job queue
+    tk.Label(root, text="Jobs:").grid(row=15, column=0, sticky="ne", padx=5, pady=5)
+    jobs_list = tk.Listbox(root, height=5, width=80)
+    jobs_list.grid(row=15, column=1, columnspan=5, sticky="we", padx=5, pady=5)
+
+    # Row 16: Progress of the stage that reported last
+    progress_var = tk.DoubleVar()
+    tk.Label(root, text="Progress:").grid(row=16, column=0, sticky="e", padx=5, pady=5)
+    ttk.Progressbar(root, variable=progress_var, maximum=100, length=400).grid(row=16, column=1, columnspan=2, sticky="we", padx=5, pady=5)
+    progress_label = tk.Label(root, text="")
+    progress_label.grid(row=16, column=3, columnspan=3, sticky="w", padx=5, pady=5)
+
+    # Row 17: Log pane
+    tk.Label(root, text="Log:").grid(row=17, column=0, sticky="ne", padx=5, pady=5)
+    log_text = tk.Text(root, height=12, width=100, state='disabled')
+    log_text.grid(row=17, column=1, columnspan=5, sticky="nsew", padx=5, pady=5)
+    log_scroll = tk.Scrollbar(root, command=log_text.yview)
+    log_scroll.grid(row=17, column=6, sticky="ns", pady=5)
+    log_text.config(yscrollcommand=log_scroll.set)
+    root.grid_rowconfigure(17, weight=1)
+
+    # Initialize rescale Z entries as disabled if not checked
+    toggle_rescale_z()
+
+    # one warm worker, so the first run does not wait for pandas
+    workers.append(startWorker())
+    root.protocol("WM_DELETE_WINDOW", on_close)
+    root.after(POLL_MS, poll_worker_events)
+    root.mainloop()
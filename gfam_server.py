@@ -0,0 +1,391 @@
+import os, json, argparse, logging, heapq, itertools, signal, socketserver, threading, time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from gfam_exec import REQUIRED_SETTINGS, SETTING_CHOICES, settingChoice, sfmTargets
+from code.pipeline_worker import signalWorker, startWorker, stopWorker, submitJob, workerEvents
+from code.run_report import BATCH_REPORT, RUN_REPORT_DIR
+
+LOG_LINES = 200 # last log lines kept per job
+POLL_INTERVAL = 0.1 # s between two passes of the scheduler
+KILL_AFTER = 5.0 # s between asking a cancelled job to stop and killing it
+# settings choose what node and exiftool run, so only local clients are served: any other Host header is a page loaded
+# from elsewhere (e.g. DNS rebinding), and a JSON Content-Type forces browsers into a CORS preflight this server refuses
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '[::1]')
+SOCKET_MODE = 0o600
+
+# every job is a dict with id, status (queued, running, cancelling, done, failed, cancelled), priority, settings,
+# times, its last progress event and the tail of its log
+_server = {
+    'jobs': {},
+    'queue': [],
+    'workers': [],
+    'lock': threading.Lock(),
+    'ids': itertools.count(1),
+    'order': itertools.count(),
+    'pool_size': 1,
+    'worker_options': {}
+}
+
+def checkSettings(data):
+    """ Checks a settings JSON before it is queued.
+
+    :param data: Content of the JSON settings file.
+    :type data: dict
+
+    :return: what is wrong with the settings, None if nothing
+    :rtype: str
+    """
+
+    if not isinstance(data, dict):
+        return "Settings must be a JSON object."
+    missing = [key for key in REQUIRED_SETTINGS if key not in data]
+    if missing:
+        return f"Missing settings: {', '.join(missing)}."
+    try:
+        sfmTargets(data['sfm'])
+        for key in SETTING_CHOICES:
+            settingChoice(data, key)
+    except (ValueError, TypeError) as e:
+        return str(e)
+    for key in ('input_vid', 'project_dir'):
+        if not isinstance(data[key], str):
+            return f"{key} must be a path string."
+    if not os.path.exists(data['input_vid']):
+        return f"{data['input_vid']} does not exist."
+    return None
+
+def queueJob(data, priority=0):
+    """ Queues a pipeline run.
+
+    :param data: Content of the JSON settings file.
+    :type data: dict
+    :param priority: Jobs with a higher priority start first, jobs of the same priority in submission order. Defaults
+        to 0.
+    :type priority: int
+
+    :return: the job
+    :rtype: dict
+    """
+
+    with _server['lock']:
+        job = {
+            'id': next(_server['ids']),
+            'status': 'queued',
+            'priority': priority,
+            'settings': data,
+            'submitted': time.time(),
+            'started': None,
+            'finished': None,
+            'progress': None,
+            'log': deque(maxlen=LOG_LINES),
+            'worker': None
+        }
+        _server['jobs'][job['id']] = job
+        heapq.heappush(_server['queue'], (-priority, next(_server['order']), job['id']))
+    logging.info(f"Queued job {job['id']} ({data['input_vid']}, priority {priority}).")
+    return job
+
+def cancelJob(job_id):
+    """ Cancels a queued or running job, a running job's worker is killed with its children and replaced.
+
+    :param job_id: The job.
+    :type job_id: int
+
+    :return: the job, None if there is no such job
+    :rtype: dict
+    """
+
+    with _server['lock']:
+        job = _server['jobs'].get(job_id)
+        if job is None:
+            return None
+        if job['status'] == 'queued':
+            # left in the heap, the scheduler skips it
+            finishJob(job, 'cancelled')
+        elif job['status'] == 'running':
+            job['status'] = 'cancelling'
+            signalWorker(job['worker'], signal.SIGTERM)
+            threading.Timer(KILL_AFTER, signalWorker, args=(job['worker'], signal.SIGKILL)).start()
+    return job
+
+def finishJob(job, status):
+    job['status'] = status
+    job['finished'] = time.time()
+    job['worker'] = None
+    logging.info(f"Job {job['id']} {status}.")
+
+def jobStatus(job, log=False):
+    """ Returns what the API shows of a job.
+
+    :param job: The job.
+    :type job: dict
+    :param log: Includes the tail of the job's log. Defaults to False.
+    :type log: bool
+
+    :rtype: dict
+    """
+
+    status = {key: job[key] for key in ('id', 'status', 'priority', 'submitted', 'started', 'finished', 'progress')}
+    status['input_vid'] = job['settings']['input_vid']
+    status['project_dir'] = job['settings']['project_dir']
+    if log:
+        status['log'] = list(job['log'])
+    return status
+
+def jobReport(job):
+    """ Reads the batch run report of a finished job, see rollupRunReports().
+
+    :param job: The job.
+    :type job: dict
+
+    :return: the report, None if the job did not write one
+    :rtype: dict
+    """
+
+    report_json = os.path.join(job['settings']['project_dir'], RUN_REPORT_DIR, BATCH_REPORT)
+    if not os.path.exists(report_json):
+        return None
+    with open(report_json) as json_file:
+        return json.load(json_file)
+
+def schedule():
+    """ One pass of the scheduler: applies the workers' events, replaces dead workers and starts queued jobs. """
+
+    with _server['lock']:
+        for worker in list(_server['workers']):
+            for kind, job_id, payload in workerEvents(worker):
+                job = _server['jobs'].get(job_id)
+                if kind == 'ready':
+                    worker['ready'] = True
+                elif kind == 'log' and job is not None:
+                    job['log'].append(payload)
+                elif kind == 'log':
+                    logging.info(f"Worker {worker['process'].pid}: {payload}")
+                elif kind == 'progress' and job is not None:
+                    job['progress'] = payload
+                elif kind == 'exit' and job is not None:
+                    finishJob(job, 'cancelled' if job['status'] == 'cancelling' else ('done' if payload == 0 else 'failed'))
+            if not worker['process'].is_alive():
+                _server['workers'].remove(worker)
+                if not worker['ready']:
+                    logging.error(f"Worker {worker['process'].pid} exited with status {worker['process'].exitcode} before it was ready.")
+                job = _server['jobs'].get(worker['job'])
+                if job is not None and job['status'] in ('running', 'cancelling'):
+                    finishJob(job, 'cancelled' if job['status'] == 'cancelling' else 'failed')
+        # keep the pool warm
+        while len(_server['workers']) < _server['pool_size']:
+            worker = startWorker(**_server['worker_options'])
+            worker['ready'] = False
+            _server['workers'].append(worker)
+
+        idle = [worker for worker in _server['workers'] if worker['job'] is None]
+        while idle and _server['queue']:
+            _, _, job_id = heapq.heappop(_server['queue'])
+            job = _server['jobs'][job_id]
+            if job['status'] != 'queued':
+                continue
+            worker = idle.pop(0)
+            submitJob(worker, job_id, job['settings'])
+            job['worker'] = worker
+            job['status'] = 'running'
+            job['started'] = time.time()
+            logging.info(f"Started job {job_id} on worker {worker['process'].pid}.")
+
+def runScheduler(stop):
+    """ Runs the scheduler until stop is set.
+
+    :param stop: Stops the scheduler.
+    :type stop: threading.Event
+    """
+
+    while not stop.is_set():
+        try:
+            schedule()
+        except Exception as e:
+            logging.exception(f"Scheduler pass failed: {e}")
+        stop.wait(POLL_INTERVAL)
+
+class GFAMRequestHandler(BaseHTTPRequestHandler):
+    """ JSON API of the job server.
+
+    POST /jobs?priority=N    queues the settings JSON in the body, returns the job
+    GET /jobs                every job
+    GET /jobs/<id>           a job, with the tail of its log
+    GET /jobs/<id>/report    the batch run report of a finished job
+    DELETE /jobs/<id>        cancels a job
+    GET /health              the workers
+
+    Requests whose Host is not localhost are refused, and POST bodies must be sent as application/json.
+    """
+
+    def sendJSON(self, code, content):
+        body = json.dumps(content, default=float).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def isLocalHost(self):
+        host = self.headers.get('Host', '')
+        if host.startswith('['):
+            host = host[:host.find(']') + 1]
+        else:
+            host = host.split(':')[0]
+        return host.lower() in LOCAL_HOSTS
+
+    def route(self):
+        if not self.isLocalHost():
+            self.sendJSON(403, {'error': f"Host {self.headers.get('Host')} is not served, use localhost."})
+            return None, None, None
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        job = None
+        if len(parts) >= 2 and parts[0] == 'jobs':
+            try:
+                job_id = int(parts[1])
+            except ValueError:
+                job_id = None
+            with _server['lock']:
+                job = _server['jobs'].get(job_id)
+            if job is None:
+                self.sendJSON(404, {'error': f"No job {parts[1]}."})
+                return None, None, None
+        return parts, parse_qs(url.query), job
+
+    def do_GET(self):
+        parts, query, job = self.route()
+        if parts is None:
+            return
+        if parts == ['health']:
+            with _server['lock']:
+                workers = [{'pid': w['process'].pid, 'ready': w['ready'], 'job': w['job']} for w in _server['workers']]
+                queued = sum(j['status'] == 'queued' for j in _server['jobs'].values())
+            self.sendJSON(200, {'workers': workers, 'queued': queued})
+        elif parts == ['jobs']:
+            with _server['lock']:
+                jobs = [jobStatus(job) for job in _server['jobs'].values()]
+            self.sendJSON(200, {'jobs': jobs})
+        elif job is not None and len(parts) == 2:
+            with _server['lock']:
+                status = jobStatus(job, log=True)
+            self.sendJSON(200, status)
+        elif job is not None and parts[2:] == ['report']:
+            with _server['lock']:
+                finished = job['finished']
+                status = job['status']
+            if finished is None:
+                self.sendJSON(409, {'error': f"Job {job['id']} is {status}."})
+                return
+            report = jobReport(job)
+            if report is None:
+                self.sendJSON(404, {'error': f"Job {job['id']} wrote no run report."})
+            else:
+                self.sendJSON(200, report)
+        else:
+            self.sendJSON(404, {'error': f"Unknown path {self.path}."})
+
+    def do_POST(self):
+        parts, query, job = self.route()
+        if parts is None:
+            return
+        if parts != ['jobs']:
+            self.sendJSON(404, {'error': f"Unknown path {self.path}."})
+            return
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type != 'application/json':
+            self.sendJSON(415, {'error': "Settings must be sent as Content-Type: application/json."})
+            return
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            priority = int(query.get('priority', ['0'])[0])
+        except ValueError as e:
+            self.sendJSON(400, {'error': f"Invalid request: {e}"})
+            return
+        error = checkSettings(data)
+        if error is not None:
+            self.sendJSON(400, {'error': error})
+            return
+        job = queueJob(data, priority=priority)
+        with _server['lock']:
+            status = jobStatus(job)
+        self.sendJSON(202, status)
+
+    def do_DELETE(self):
+        parts, query, job = self.route()
+        if parts is None:
+            return
+        if job is None or len(parts) != 2:
+            self.sendJSON(404, {'error': f"Unknown path {self.path}."})
+            return
+        cancelJob(job['id'])
+        with _server['lock']:
+            status = jobStatus(job)
+        self.sendJSON(202, status)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ The HTTP API on a Unix socket, e.g. curl --unix-socket gfam.sock http://localhost/jobs """
+
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        # created with SOCKET_MODE rather than changed after, so no other user can connect in between
+        umask = os.umask(0o777 & ~SOCKET_MODE)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    def get_request(self):
+        request, _ = socketserver.UnixStreamServer.get_request(self)
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('local', 0)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Job server keeping warm pipeline workers.')
+    parser.add_argument('--port', help='port of the HTTP API on localhost', type=int, default=8765)
+    parser.add_argument('--socket', help='serve the HTTP API on this Unix socket instead of a port', type=str, default=None)
+    parser.add_argument('--workers', help='number of warm workers, i.e. of jobs run at the same time', type=int, default=1)
+    parser.add_argument('--no-exiftool-session', help='start exiftool for every frame instead of keeping one per worker', action='store_true')
+    parser.add_argument('--log-level', help='logging level, e.g. DEBUG', type=str, default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(message)s')
+
+    _server['pool_size'] = max(args.workers, 1)
+    _server['worker_options'] = {'log_level': args.log_level, 'persistent_exiftool': not args.no_exiftool_session}
+    if args.socket is not None:
+        server = ThreadingUnixHTTPServer(args.socket, GFAMRequestHandler)
+        logging.info(f"Serving on {args.socket}")
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', args.port), GFAMRequestHandler)
+        logging.info(f"Serving on http://127.0.0.1:{args.port}")
+
+    # serve_forever() returns on SIGTERM too, so the workers are stopped either way
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    stop = threading.Event()
+    scheduler = threading.Thread(target=runScheduler, args=(stop,), daemon=True)
+    scheduler.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Shutting down.")
+    finally:
+        stop.set()
+        scheduler.join()
+        server.server_close()
+        for worker in _server['workers']:
+            if worker['job'] is None:
+                stopWorker(worker)
+            else:
+                signalWorker(worker, signal.SIGKILL)
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
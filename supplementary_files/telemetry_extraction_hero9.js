@@ -31,6 +31,20 @@ function bufferAppender(filepath, chunkSize) {
     }
 }
 
+// Sticky values (e.g. GPS fix and precision) are only attached to the sample where they change.
+// Carry them forward onto every sample so they become regular CSV columns.
+function flattenSticky(samples) {
+    var sticky = {};
+    return samples.map(sample => {
+        if (sample.sticky) {
+            sticky = Object.assign({}, sticky, sample.sticky);
+        }
+        var row = Object.assign({}, sample, sticky);
+        delete row.sticky;
+        return row;
+    });
+}
+
 // Extract telemetry from the input file.
 gpmfExtract(bufferAppender(inputFile, 10 * 1024 * 1024))
     .then(extracted => {
@@ -39,7 +53,7 @@ gpmfExtract(bufferAppender(inputFile, 10 * 1024 * 1024))
 
             // Conditionally extract GPS stream if an output file is provided.
             if (myArgs[1] && myArgs[1].trim() !== '') {
-                var GPS_data = telemetry[1].streams.GPS5.samples;
+                var GPS_data = flattenSticky(telemetry[1].streams.GPS5.samples);
                 var output_GPS = fs.createWriteStream(myArgs[1]);
                 fastcsv.write(GPS_data, { headers: true }).pipe(output_GPS);
             }